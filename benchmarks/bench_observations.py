@@ -0,0 +1,79 @@
+"""Micro-benchmark of the observation hot path: decoding obs rows into records and mapping them to data values.
+
+The rows are generated once before timing, so only the connector's decoding and the form
+mapping are measured, per observation, with the memory the extracted encounters hold:
+
+    python benchmarks/bench_observations.py --encounters 20000 --obs 60
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from config.mappings import MappingRegistry
+from connectors.openmrs_connector import OpenMRSMetadata
+from run_benchmarks import copy_mappings
+from synthetic_openmrs import SyntheticDataset, SyntheticOpenMRSConnector
+
+class PrecomputedDataset(SyntheticDataset):
+    """A SyntheticDataset generating the observation rows of an encounter only once."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.obs_cache = {}
+
+    def obs_rows(self, encounter_id, concept_ids=None):
+        key = (encounter_id, frozenset(concept_ids) if concept_ids is not None else None)
+        rows = self.obs_cache.get(key)
+        if rows is None:
+            rows = self.obs_cache[key] = super().obs_rows(encounter_id, concept_ids)
+        return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the decoding and mapping of OpenMRS observations.")
+    parser.add_argument('--encounters', type=int, default=10000)
+    parser.add_argument('--obs', type=int, default=40, help="Observations per encounter (default: 40).")
+    parser.add_argument('--unmapped-concepts', type=int, default=5, help="Concepts of the dataset no mapping uses (default: 5).")
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs; the fastest is reported (default: 5).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        mappings = MappingRegistry(copy_mappings(work_dir))
+    dataset = PrecomputedDataset(args.encounters, 1, args.obs, unmapped_concepts=args.unmapped_concepts)
+    form_mapping = mappings.get_form(dataset.form_id)
+    dataset.concept_uuids = list(form_mapping.observations) + dataset.concept_uuids
+    connector = SyntheticOpenMRSConnector(dataset, chunk_size=args.chunk_size, metadata=OpenMRSMetadata(mappings.mapped_concept_uuids()))
+    encounter_ids = list(range(1, args.encounters + 1))
+    # Warm up the row cache and the metadata
+    connector.fetch_encounters_data(encounter_ids)
+
+    decode_seconds = map_seconds = float('inf')
+    for _ in range(args.repeat):
+        started_at = time.perf_counter()
+        encounters = connector.fetch_encounters_data(encounter_ids)
+        decoded_at = time.perf_counter()
+        data_values = [form_mapping.data_values(encounter['observations']) for encounter in encounters.values()]
+        mapped_at = time.perf_counter()
+        decode_seconds = min(decode_seconds, decoded_at - started_at)
+        map_seconds = min(map_seconds, mapped_at - decoded_at)
+        del encounters, data_values
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    encounters = connector.fetch_encounters_data(encounter_ids)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    observations = sum(len(encounter['observations']) for encounter in encounters.values())
+
+    print(f"{args.encounters} encounters, {args.encounters * args.obs} observation rows, {observations} extracted")
+    print(f"decode: {decode_seconds:.3f} s, {1e6 * decode_seconds / max(observations, 1):.2f} us per extracted observation")
+    print(f"map:    {map_seconds:.3f} s, {1e6 * map_seconds / max(observations, 1):.2f} us per extracted observation")
+    print(f"memory: {held / 1024 / 1024:.1f} MB held by the extracted encounters, {held / max(observations, 1):.0f} bytes per observation")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+class DHIS2Stub:
+    """A local stand-in for the DHIS2 trackedEntityInstances and events endpoints.
+
+    Every request waits `latency` seconds, plus up to `jitter` seconds. A random `error_rate`
+    fraction of the requests is answered with `error_status` (503 by default, with a Retry-After
+    of `retry_after` seconds) before anything is imported, the way an overloaded server refuses
+    work. Imports always succeed otherwise; the received records are only counted, not kept.
+    `existing` maps UUID attribute values to the tracked entity instances the UUID lookup finds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, retry_after=0, existing=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.existing = existing or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_port}"
+
+    def start(self):
+        """Serve requests from a background thread. Returns the stub."""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def _delay_and_fail(self):
+        """Wait out the latency and draw whether the request fails, under the lock so runs with a seed repeat."""
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+        return failed
+
+    def _handler(self):
+        stub = self
+
+        class DHIS2StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately; with Nagle's algorithm every response would wait for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _fail(self):
+                stub.count('errors injected')
+                self._reply(stub.error_status, {'httpStatus': 'Service Unavailable', 'message': 'Injected error'}, {'Retry-After': str(stub.retry_after)})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                stub.count(f"GET {url.path}")
+                if stub._delay_and_fail():
+                    return self._fail()
+                if url.path != '/trackedEntityInstances.json':
+                    return self._reply(404, {'httpStatus': 'Not Found'})
+                query = parse_qs(url.query)
+                attribute, _, values = query.get('filter', ['::'])[0].split(':', 2)
+                self._reply(200, {'trackedEntityInstances': [
+                    {'trackedEntityInstance': stub.existing[value], 'attributes': [{'attribute': attribute, 'value': value}]}
+                    for value in values.split(';') if value in stub.existing
+                ]})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                stub.count(f"POST {url.path}")
+                if stub._delay_and_fail():
+                    return self._fail()
+                if url.path == '/trackedEntityInstances':
+                    records = body.get('trackedEntityInstances', [body])
+                    key = 'trackedEntityInstance'
+                    stub.count('events received', sum(len(enrollment.get('events', [])) for record in records for enrollment in record.get('enrollments', [])))
+                elif url.path == '/events':
+                    records = body.get('events', [body])
+                    key = 'event'
+                else:
+                    return self._reply(404, {'httpStatus': 'Not Found'})
+                stub.count(f"{key}s received", len(records))
+                self._reply(200, {'httpStatus': 'OK', 'status': 'OK', 'response': {'importSummaries': [
+                    {'status': 'SUCCESS', 'reference': record.get(key) or f"stub{index:07d}"} for index, record in enumerate(records)
+                ]}})
+
+        return DHIS2StubHandler
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stub of the DHIS2 trackedEntityInstances and events endpoints.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds every request takes (default: 0.05).")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random extra seconds added to the latency.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of the requests answered with --error-status.")
+    parser.add_argument('--error-status', type=int, default=503)
+    args = parser.parse_args()
+    stub = DHIS2Stub(port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status)
+    print(f"Serving the DHIS2 stub on {stub.url}; set DHIS2_BASE_URL to it. Press Ctrl+C to stop.")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Requests served: {stub.counts}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Offline benchmark of the extract, transform and load stages of a sync.
+
+Runs the real SyncService and connectors against a synthetic OpenMRS dataset and a local DHIS2
+stub, so it needs neither a database nor a network, and reports the throughput and the peak
+memory of each stage. Run it from the repository root:
+
+    python benchmarks/run_benchmarks.py --patients 2000 --encounters 3 --obs 30 --output before.json
+    python benchmarks/run_benchmarks.py --patients 2000 --encounters 3 --obs 30 --baseline before.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from config.settings import DHIS2_IMPORT_MODE, DHIS2_BULK_BATCH_SIZE, DHIS2_UPLOAD_WORKERS, DHIS2_MAX_RETRIES, OPENMRS_ENCOUNTER_CHUNK_SIZE, PIPELINE_BATCH_SIZE
+from services.sync_service import SyncService
+from utils.batching import batched
+from utils.metrics import METRICS
+from dhis2_stub import DHIS2Stub
+from synthetic_openmrs import SyntheticDataset, SyntheticOpenMRSConnector
+
+STAGES = ('extract', 'transform', 'load')
+MAPPINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mappings')
+
+class StageMeter:
+    """Accumulates the wall time and the peak traced memory of the calls made for each stage."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.peak_bytes = dict.fromkeys(STAGES, 0)
+
+    def run(self, stage, function, *args):
+        """Call `function(*args)` as part of `stage` and return its result."""
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started_at = time.perf_counter()
+        result = function(*args)
+        self.seconds[stage] += time.perf_counter() - started_at
+        if self.trace_memory:
+            self.peak_bytes[stage] = max(self.peak_bytes[stage], tracemalloc.get_traced_memory()[1] - baseline)
+        return result
+
+def copy_mappings(work_dir):
+    """Copy the mapping files into `work_dir`."""
+    mappings_dir = os.path.join(work_dir, 'mappings')
+    shutil.copytree(MAPPINGS_DIR, mappings_dir)
+    return mappings_dir
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sync offline against a synthetic OpenMRS dataset and a local DHIS2 stub.")
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--encounters', type=int, default=3, help="Encounters per patient (default: 3).")
+    parser.add_argument('--obs', type=int, default=20, help="Observations per encounter (default: 20).")
+    parser.add_argument('--batch-size', type=int, default=PIPELINE_BATCH_SIZE, help="Patients extracted and transformed together.")
+    parser.add_argument('--chunk-size', type=int, default=OPENMRS_ENCOUNTER_CHUNK_SIZE, help="IDs per OpenMRS query.")
+    parser.add_argument('--query-latency', type=float, default=0.002, help="Seconds every OpenMRS query takes (default: 0.002).")
+    parser.add_argument('--dhis2-latency', type=float, default=0.02, help="Seconds every DHIS2 request takes (default: 0.02).")
+    parser.add_argument('--dhis2-jitter', type=float, default=0.0, help="Random extra seconds added to the DHIS2 latency.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of the DHIS2 requests answered with --error-status.")
+    parser.add_argument('--error-status', type=int, default=503, help="Status of the injected errors (default: 503, which also makes the client slow down).")
+    parser.add_argument('--import-mode', choices=['single', 'bulk'], default=DHIS2_IMPORT_MODE)
+    parser.add_argument('--dhis2-batch-size', type=int, default=DHIS2_BULK_BATCH_SIZE, help="Patients per bulk import request.")
+    parser.add_argument('--upload-workers', type=int, default=DHIS2_UPLOAD_WORKERS)
+    parser.add_argument('--rate-limit', type=float, default=1000, help="DHIS2 requests per second allowed (default: 1000, so the stub latency dominates).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="Do not trace memory: tracing slows Python down, so timings without it are closer to production.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--baseline', help="Compare the throughput with the results of an earlier run written with --output.")
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args(argv)
+
+def run(args):
+    """Run the benchmark and return its results."""
+    dataset = SyntheticDataset(args.patients, args.encounters, args.obs, seed=args.seed)
+    stub = DHIS2Stub(latency=args.dhis2_latency, jitter=args.dhis2_jitter, error_rate=args.error_rate, error_status=args.error_status, seed=args.seed).start()
+    meter = StageMeter(trace_memory=not args.no_memory)
+    METRICS.drain()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            dhis2_config = {
+                'base_url': stub.url, 'username': 'benchmark', 'password': 'benchmark', 'max_workers': args.upload_workers,
+                'import_mode': args.import_mode, 'batch_size': args.dhis2_batch_size, 'max_retries': DHIS2_MAX_RETRIES,
+                'backoff_base': 0.05, 'backoff_max': 1, 'rate_limit': args.rate_limit, 'max_rate_limit': args.rate_limit
+            }
+            sync_service = SyncService(
+                {'host': 'synthetic', 'user': '', 'password': '', 'database': ''}, dhis2_config, os.path.join(work_dir, 'progress.db'),
+                reference_index_file=os.path.join(work_dir, 'references.db'), staging_file=os.path.join(work_dir, 'staging.db'),
+                mappings_dir=copy_mappings(work_dir), dead_letter_file=os.path.join(work_dir, 'dead_letters.db')
+            )
+            # The mapped concepts of the form go first, so every encounter has observations to sync
+            form_mappings = sync_service.load_form_mappings(dataset.form_id)
+            dataset.concept_uuids = list(form_mappings.observations) + dataset.concept_uuids
+            connector = sync_service.openmrs_connector = SyntheticOpenMRSConnector(
+                dataset, args.query_latency, args.chunk_size, metadata=sync_service.openmrs_connector.metadata
+            )
+            if meter.trace_memory:
+                tracemalloc.start()
+            try:
+                patient_encounters = meter.run('extract', lambda: list(connector.stream_patient_encounters_by_location(dataset.location_id, [dataset.form_id])))
+                transformed = 0
+                for batch in batched(patient_encounters, args.batch_size):
+                    patients_data, encounters_data = meter.run('extract', sync_service.extract_patient_batch, batch)
+                    results = meter.run('transform', sync_service.transform_patient_batch, batch, dataset.location_id, patients_data, encounters_data)
+                    meter.run('transform', sync_service.staging_store.stage_many, ((patient_id, result) for patient_id, result in results.items() if result))
+                    transformed += sum(1 for result in results.values() if result)
+                    connector.clear_patient_cache()
+                    del patients_data, encounters_data, results
+                uploaded = meter.run('load', sync_service.dhis2_connector.process_staged_patients, sync_service.staging_store, args.upload_workers)
+            finally:
+                if meter.trace_memory:
+                    tracemalloc.stop()
+    finally:
+        stub.stop()
+    counts = {'patients': args.patients, 'encounters': args.patients * args.encounters, 'observations': args.patients * args.encounters * args.obs}
+    stages = {
+        stage: {
+            'seconds': round(meter.seconds[stage], 3),
+            **{f"{record}_per_second": round(count / meter.seconds[stage], 1) if meter.seconds[stage] else None for record, count in counts.items()},
+            'peak_memory_mb': round(meter.peak_bytes[stage] / 1024 / 1024, 2) if meter.trace_memory else None
+        }
+        for stage in STAGES
+    }
+    return {
+        'config': vars(args),
+        'counts': dict(counts, transformed=transformed, uploaded=uploaded),
+        'stages': stages,
+        'dhis2_requests': stub.counts
+    }
+
+def print_results(results, baseline=None):
+    counts = results['counts']
+    print(f"{counts['patients']} patients, {counts['encounters']} encounters, {counts['observations']} observations: "
+          f"{counts['transformed']} transformed, {counts['uploaded']} uploaded")
+    header = ('stage', 'seconds', 'patients/s', 'encounters/s', 'obs/s', 'peak MB') + (('vs baseline',) if baseline else ())
+    rows = [header]
+    for stage, result in results['stages'].items():
+        row = (stage, f"{result['seconds']:.3f}", str(result['patients_per_second']), str(result['encounters_per_second']),
+               str(result['observations_per_second']), str(result['peak_memory_mb']))
+        if baseline:
+            before = baseline['stages'].get(stage, {}).get('patients_per_second')
+            after = result['patients_per_second']
+            row += (f"{100.0 * (after - before) / before:+.1f}%" if before and after else 'n/a',)
+        rows.append(row)
+    widths = [max(len(row[column]) for row in rows) for column in range(len(header))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) if column == 0 else cell.rjust(width) for column, (cell, width) in enumerate(zip(row, widths))))
+    print(f"DHIS2 stub requests: {results['dhis2_requests']}")
+    print()
+    print(METRICS.summary_table())
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+    results = run(args)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+if __name__ == '__main__':
+    main()
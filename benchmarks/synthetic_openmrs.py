@@ -0,0 +1,247 @@
+import random
+import re
+import time
+from datetime import date, datetime, timedelta
+from connectors.openmrs_connector import OpenMRSConnector
+
+# Values of the glucose test type concept, recoded to 'random' and 'fasting' by the form mappings
+GLUCOSE_TEST_TYPES = (13467, 6689)
+GLUCOSE_TEST_TYPE_CONCEPT = 'f618591a-f334-4a5a-be26-0518871cd00f'
+
+class SyntheticDataset:
+    """A deterministic OpenMRS dataset of `patients` x `encounters_per_patient` x `obs_per_encounter`.
+
+    Rows are derived from their IDs when queried rather than stored, so the dataset costs no
+    memory whatever its scale and the measurements only see the memory of the sync itself.
+    Patient IDs run from 1 to `patients`; the encounters of patient p are numbered from
+    (p - 1) * encounters_per_patient + 1. Observations cycle through `concept_uuids`, the mapped
+    concepts of the form followed by `unmapped_concepts` concepts no mapping uses, as real
+    encounters also record observations that are not synced. The concept_id of a concept is its
+    position in `concept_uuids` plus one.
+    """
+
+    def __init__(self, patients=1000, encounters_per_patient=3, obs_per_encounter=20, concept_uuids=(), unmapped_concepts=5,
+                 location_id=268, form_id=197, seed=0):
+        self.patients = patients
+        self.encounters_per_patient = encounters_per_patient
+        self.obs_per_encounter = obs_per_encounter
+        self.concept_uuids = list(concept_uuids) + [f"synthetic-concept-{index}" for index in range(unmapped_concepts)]
+        self.location_id = int(location_id)
+        self.form_id = form_id
+        self.seed = seed
+        self.epoch = datetime(2020, 1, 1)
+
+    def _random(self, *parts):
+        return random.Random(':'.join(str(part) for part in (self.seed,) + parts))
+
+    def patient_encounters(self):
+        """Yield (patient_id, encounter_ids) pairs, as the encounter stream of the location does."""
+        for patient_id in range(1, self.patients + 1):
+            first = (patient_id - 1) * self.encounters_per_patient + 1
+            yield patient_id, list(range(first, first + self.encounters_per_patient))
+
+    def has_patient(self, patient_id):
+        return 1 <= patient_id <= self.patients
+
+    def has_encounter(self, encounter_id):
+        return 1 <= encounter_id <= self.patients * self.encounters_per_patient
+
+    def patient_row(self, patient_id):
+        rng = self._random('patient', patient_id)
+        birthdate = date(1940, 1, 1) + timedelta(days=rng.randrange(25000))
+        return {
+            'patient_id': patient_id,
+            'uuid': f"00000000-0000-4000-8000-{patient_id:012d}",
+            'gender': rng.choice('FM'),
+            'birthdate': birthdate,
+            'date_created': self.epoch + timedelta(minutes=patient_id),
+            'age': 2026 - birthdate.year
+        }
+
+    def name_row(self, patient_id):
+        return {'person_id': patient_id, 'given_name': f"Given{patient_id}", 'middle_name': None, 'family_name': f"Family{patient_id}"}
+
+    def address_row(self, patient_id):
+        return {
+            'person_id': patient_id, 'country': 'Rwanda', 'province': 'Kigali City', 'district': 'Gasabo / Kigali',
+            'sector': 'Remera', 'cell': 'Rukiri', 'village': 'Amahoro'
+        }
+
+    def attribute_rows(self, patient_id, attribute_type_ids):
+        values = {19: f"1{patient_id:015d}", 11: f"07{patient_id % 100000000:08d}", 3: 'Rwanda'}
+        return [
+            {'person_id': patient_id, 'person_attribute_type_id': type_id, 'value': values[type_id]}
+            for type_id in attribute_type_ids if type_id in values
+        ]
+
+    def concept_datatype(self, concept_index):
+        """The HL7 abbreviation of the datatype of a concept, matching the value column its observations set."""
+        if self.concept_uuids[concept_index] == GLUCOSE_TEST_TYPE_CONCEPT:
+            return 'CWE'
+        return 'ST' if concept_index % 4 == 3 else 'NM'
+
+    def concept_rows(self, concept_uuids):
+        return [
+            (index + 1, concept_uuid, self.concept_datatype(index))
+            for index, concept_uuid in enumerate(self.concept_uuids) if concept_uuid in concept_uuids
+        ]
+
+    def encounter_row(self, encounter_id):
+        return (encounter_id, self.form_id, self.epoch + timedelta(hours=encounter_id))
+
+    def obs_rows(self, encounter_id, concept_ids=None):
+        """Rows of the observations of an encounter, in the column order of the connector's obs query.
+
+        The third column is the concept_id when `concept_ids` filters the concepts, as the query
+        does when the connector has the concept metadata, and the concept UUID otherwise.
+        """
+        rng = self._random('obs', encounter_id)
+        rows = []
+        for index in range(self.obs_per_encounter):
+            concept_index = index % len(self.concept_uuids)
+            concept_uuid = self.concept_uuids[concept_index]
+            obs_id = encounter_id * self.obs_per_encounter + index
+            datatype = self.concept_datatype(concept_index)
+            if datatype == 'CWE':
+                values = (None, rng.choice(GLUCOSE_TEST_TYPES), None, None)
+            elif datatype == 'ST':
+                values = (None, None, f"note {obs_id}", None)
+            else:
+                values = (float(rng.randrange(40, 250)), None, None, None)
+            if concept_ids is None:
+                rows.append((encounter_id, obs_id, concept_uuid) + values)
+            elif concept_index + 1 in concept_ids:
+                rows.append((encounter_id, obs_id, concept_index + 1) + values)
+        return rows
+
+class SyntheticCursor:
+    """A cursor answering the queries of OpenMRSConnector from a SyntheticDataset.
+
+    Every execute sleeps `latency` seconds, standing for the round trip to the database server.
+    Queries are recognised by the table they read; the result has the shape the MySQL cursor
+    would return, as dicts for dictionary cursors and tuples otherwise.
+    """
+
+    def __init__(self, dataset, latency=0.0, dictionary=False, **cursor_args):
+        self.dataset = dataset
+        self.latency = latency
+        self.dictionary = dictionary
+        self.column_names = ()
+        self.rows = []
+        self.position = 0
+
+    def execute(self, query, params=()):
+        if self.latency:
+            time.sleep(self.latency)
+        params = list(params)
+        if query.startswith('SET '):
+            self._result((), [])
+        elif 'NOW()' in query:
+            self._result(('now',), [(datetime.now(),)])
+        elif 'FROM form' in query:
+            self._result(('form_id', 'uuid', 'encounter_type'), [(self.dataset.form_id, f"synthetic-form-{self.dataset.form_id}", 1)])
+        elif 'FROM concept' in query:
+            self._result(('concept_id', 'uuid', 'hl7_abbreviation'), self.dataset.concept_rows(set(params)))
+        elif 'FROM encounter e' in query:
+            patient_encounters = self.dataset.patient_encounters() if int(params[0]) == self.dataset.location_id else ()
+            self._result(('patient_id', 'encounter_id'), [
+                (patient_id, encounter_id) for patient_id, encounter_ids in patient_encounters for encounter_id in encounter_ids
+            ])
+        elif 'FROM encounter' in query:
+            self._result(('encounter_id', 'form_id', 'date_created'), [
+                self.dataset.encounter_row(encounter_id) for encounter_id in params if self.dataset.has_encounter(encounter_id)
+            ])
+        elif 'FROM obs' in query:
+            if 'JOIN concept' in query:
+                encounter_ids, concept_ids = params, None
+            else:
+                # The encounter IDs come first, then the concept IDs of the concept_id filter
+                encounters_in = re.search(r'encounter_id IN \(([^)]*)\)', query)
+                encounter_count = encounters_in.group(1).count('%s') if encounters_in else 1
+                encounter_ids, concept_ids = params[:encounter_count], set(params[encounter_count:])
+            self._result(
+                ('encounter_id', 'obs_id', 'concept_uuid' if concept_ids is None else 'concept_id', 'value_numeric', 'value_coded', 'value_text', 'value_datetime'),
+                [row for encounter_id in encounter_ids if self.dataset.has_encounter(encounter_id) for row in self.dataset.obs_rows(encounter_id, concept_ids)]
+            )
+        elif 'FROM patient p' in query:
+            self._dict_result([self.dataset.patient_row(patient_id) for patient_id in params if self.dataset.has_patient(patient_id)])
+        elif 'FROM person_name' in query:
+            self._dict_result([self.dataset.name_row(patient_id) for patient_id in params if self.dataset.has_patient(patient_id)])
+        elif 'FROM person_address' in query:
+            self._dict_result([self.dataset.address_row(patient_id) for patient_id in params if self.dataset.has_patient(patient_id)])
+        elif 'FROM person_attribute' in query:
+            type_count = len(OpenMRSConnector.PERSON_ATTRIBUTE_TYPES)
+            patient_ids, type_ids = params[:-type_count], params[-type_count:]
+            self._dict_result([
+                row for patient_id in patient_ids if self.dataset.has_patient(patient_id) for row in self.dataset.attribute_rows(patient_id, type_ids)
+            ])
+        else:
+            raise ValueError(f"The synthetic dataset cannot answer the query: {query.strip()[:80]}")
+
+    def _result(self, column_names, rows):
+        self.column_names = column_names
+        self.rows = [dict(zip(column_names, row)) for row in rows] if self.dictionary else rows
+        self.position = 0
+
+    def _dict_result(self, rows):
+        self.column_names = tuple(rows[0]) if rows else ()
+        self.rows = rows if self.dictionary else [tuple(row.values()) for row in rows]
+        self.position = 0
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows) - self.position)
+
+    def close(self):
+        self.rows = []
+
+class SyntheticConnection:
+    """The unpooled connection the encounter stream runs on."""
+
+    def __init__(self, dataset, latency=0.0):
+        self.dataset = dataset
+        self.latency = latency
+
+    def cursor(self, **cursor_args):
+        return SyntheticCursor(self.dataset, self.latency, **cursor_args)
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+class SyntheticOpenMRSConnector(OpenMRSConnector):
+    """OpenMRSConnector running its queries against a SyntheticDataset instead of a MySQL server.
+
+    Only the database is replaced: chunking, row decoding and the building of the patient and
+    encounter records are the connector's own, so they are measured too.
+    """
+
+    def __init__(self, dataset, query_latency=0.0, chunk_size=500, metadata=None):
+        super().__init__('synthetic', '', '', 'openmrs', chunk_size=chunk_size, pool=object(), metadata=metadata)
+        self.dataset = dataset
+        self.query_latency = query_latency
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _open_connection(self):
+        return SyntheticConnection(self.dataset, self.query_latency)
+
+    def _checkout(self):
+        return SyntheticConnection(self.dataset, self.query_latency)
+
+    def _checkin(self, connection):
+        pass
@@ -1,5 +1,11 @@
 # mappings.py
+import glob
 import json
+import logging
+import os
+import re
+import threading
+import time
 
 def load_mappings(file_path):
     """Load mappings from a JSON file."""
@@ -9,3 +15,164 @@ def load_mappings(file_path):
     except FileNotFoundError:
         raise Exception(f"Mapping file not found: {file_path}")
 
+# Observation values recoded for specific DHIS2 data elements, e.g. the glucose test type concepts
+OBSERVATION_VALUE_RECODES = {
+    'BCTuQ3xPYet': {13467: 'random', 6689: 'fasting'}
+}
+SEX_VALUES = {'F': 'Female', 'M': 'Male'}
+# Citizenship and country are always sent as Rwanda
+COUNTRY_VALUE = '646'
+FORM_MAPPING_KEYS = ('dhis2_program_id', 'dhis2_program_stage_id', 'observations')
+
+class FormMapping:
+    """The compiled mapping of one OpenMRS form to a DHIS2 program stage."""
+
+    def __init__(self, form_id, mappings):
+        self.form_id = form_id
+        self.program_id = mappings['dhis2_program_id']
+        self.program_stage_id = mappings['dhis2_program_stage_id']
+        # concept UUID -> (data element ID, value recoding table or None)
+        self.observations = {
+            concept_uuid: (data_element_id, OBSERVATION_VALUE_RECODES.get(data_element_id))
+            for concept_uuid, data_element_id in mappings['observations'].items()
+        }
+
+    def data_values(self, observations):
+        """Map the OpenMRSObservations of an encounter to DHIS2 data values, dropping unmapped concepts."""
+        data_values = []
+        for observation in observations:
+            mapping = self.observations.get(observation.concept_uuid)
+            if mapping is None:
+                continue
+            data_element_id, recodes = mapping
+            value = observation.value
+            if recodes is not None:
+                value = recodes.get(value, value)
+            data_values.append({"dataElement": data_element_id, "value": value})
+        return data_values
+
+class MappingRegistry:
+    """All mapping files, loaded and validated once and compiled into lookup tables.
+
+    The files are checked for changes at most every `check_interval` seconds and reloaded when
+    one of them was modified on disk.
+    """
+
+    def __init__(self, mappings_dir='mappings', check_interval=5):
+        self.mappings_dir = mappings_dir
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.load()
+
+    def _path(self, name):
+        return os.path.join(self.mappings_dir, name)
+
+    def _district_path(self):
+        """Return the path of the district mappings, falling back to the misspelled name older checkouts shipped."""
+        district_path = self._path('district_mappings.json')
+        misspelled_district_path = self._path('distric_mappings.json')
+        if not os.path.exists(district_path) and os.path.exists(misspelled_district_path):
+            return misspelled_district_path
+        return district_path
+
+    def _mapping_files(self):
+        """Return the paths of all mapping files, checking the required ones exist."""
+        paths = [self._path(name) for name in ('attribute_mappings.json', 'location_mappings.json', 'province_mappings.json')] + [self._district_path()]
+        for path in paths:
+            if not os.path.exists(path):
+                raise Exception(f"Mapping file not found: {path}")
+        return paths + sorted(glob.glob(self._path('forms/form_*_mappings.json')))
+
+    def load(self):
+        """Load, validate and compile all mapping files."""
+        paths = self._mapping_files()
+        if paths[3].endswith('distric_mappings.json'):
+            logging.warning(f"{paths[3]} is deprecated, rename it to district_mappings.json; the misspelled name will not be read in a future version.")
+        mtimes = {path: os.path.getmtime(path) for path in paths}
+        attribute_mappings, location_mappings, province_mappings, district_mappings = [load_mappings(path) for path in paths[:4]]
+        for path, mappings in zip(paths, (attribute_mappings, location_mappings, province_mappings, district_mappings)):
+            if not isinstance(mappings, dict):
+                raise Exception(f"Invalid mapping file {path}: expected a JSON object")
+        forms = {}
+        for path in paths[4:]:
+            form_id = int(re.search(r'form_(\d+)_mappings\.json$', path).group(1))
+            mappings = load_mappings(path)
+            missing_keys = [key for key in FORM_MAPPING_KEYS if key not in mappings]
+            if missing_keys:
+                # Encounters of this form fail as unmapped rather than stopping the whole run
+                logging.error(f"Invalid mapping file {path}: missing {', '.join(missing_keys)}")
+                continue
+            forms[form_id] = FormMapping(form_id, mappings)
+        with self.lock:
+            self.attribute_mappings = attribute_mappings
+            self.location_mappings = location_mappings
+            self.province_mappings = province_mappings
+            self.district_mappings = district_mappings
+            self.forms = forms
+            # Replaced, not mutated, on reload, so users can tell a change by identity
+            self.concept_uuids = frozenset(concept_uuid for form in forms.values() for concept_uuid in form.observations)
+            self.mtimes = mtimes
+            self.checked_at = time.monotonic()
+        logging.info(f"Loaded mappings for {len(location_mappings)} locations and {len(forms)} forms from {self.mappings_dir}.")
+
+    def reload_if_changed(self):
+        """Reload the mapping files if one of them was added, removed or modified since they were loaded.
+
+        Files that cannot be loaded, e.g. caught half-written or with an invalid edit, are logged
+        and the mappings loaded before are kept until the files change again.
+        """
+        if time.monotonic() - self.checked_at < self.check_interval:
+            return
+        self.checked_at = time.monotonic()
+        try:
+            current = {path: os.path.getmtime(path) for path in self._mapping_files()}
+        except Exception as e:
+            logging.error(f"Cannot check the mapping files for changes, keeping the loaded mappings: {e}")
+            return
+        if current != self.mtimes:
+            logging.info("Mapping files changed on disk, reloading them.")
+            try:
+                self.load()
+            except Exception as e:
+                logging.error(f"Cannot reload the mapping files, keeping the loaded mappings until they change again: {e}")
+                with self.lock:
+                    self.mtimes = current
+
+    def get_org_unit_id(self, location_id):
+        """Return the DHIS2 org unit ID of an OpenMRS location, or None if it is not mapped."""
+        self.reload_if_changed()
+        return self.location_mappings.get(str(location_id))
+
+    def get_form(self, form_id):
+        """Return the FormMapping of an OpenMRS form ID, or None if the form is not mapped."""
+        self.reload_if_changed()
+        return self.forms.get(int(form_id)) if form_id is not None else None
+
+    def mapped_concept_uuids(self):
+        """Return the frozenset of the concept UUIDs any form mapping uses."""
+        self.reload_if_changed()
+        return self.concept_uuids
+
+    def attribute_values(self, patient_data):
+        """Map patient data to DHIS2 tracked entity attributes, applying the value normalisations."""
+        self.reload_if_changed()
+        attributes = []
+        for openmrs_attr, dhis2_attr in self.attribute_mappings.items():
+            value = self.attribute_value(openmrs_attr, patient_data.get(openmrs_attr))
+            if value is not None:
+                attributes.append({"attribute": dhis2_attr, "value": value})
+        return attributes
+
+    def attribute_value(self, openmrs_attr, value):
+        """Normalise the value of one OpenMRS patient attribute for DHIS2."""
+        if openmrs_attr == 'Sex':
+            return SEX_VALUES.get(value, value)
+        if openmrs_attr in ('Citizenship', 'country'):
+            return COUNTRY_VALUE
+        if openmrs_attr == 'Province':
+            return self.province_mappings.get(value, value) if value is not None else None
+        if openmrs_attr == 'District' and isinstance(value, str):
+            # Handle cases where the attribute value is in the format "Rusizi / Western Province/Uburengerazuba"
+            value = value.split('/')[0].strip()
+            return self.district_mappings.get(value, value)
+        return value
@@ -16,3 +16,62 @@ DHIS2_PROGRAM = os.getenv("DHIS2_PROGRAM")
 DHIS2_ENROLLMENT_DATE = os.getenv("DHIS2_ENROLLMENT_DATE")  # This could be a fixed date or a logic to calculate the date
 DHIS2_INCIDENT_DATE = os.getenv("DHIS2_INCIDENT_DATE")  # This could be a fixed date or a logic to calculate the date
 
+# OpenMRS extraction configuration
+OPENMRS_ENCOUNTER_CHUNK_SIZE = int(os.getenv("OPENMRS_ENCOUNTER_CHUNK_SIZE", "500"))  # Encounter IDs per IN (...) query
+OPENMRS_STREAM_ENCOUNTERS = os.getenv("OPENMRS_STREAM_ENCOUNTERS", "false").lower() in ("1", "true", "yes")  # Stream encounter discovery instead of staging it in encounters_to_process.json
+OPENMRS_POOL_SIZE = int(os.getenv("OPENMRS_POOL_SIZE", "10"))  # Pooled OpenMRS connections shared by all extraction workers (at most 32)
+OPENMRS_STREAM_WRITE_TIMEOUT = int(os.getenv("OPENMRS_STREAM_WRITE_TIMEOUT", "3600"))  # net_write_timeout of the encounter stream: seconds the server waits for a slow consumer
+
+# DHIS2 upload configuration
+DHIS2_UPLOAD_WORKERS = int(os.getenv("DHIS2_UPLOAD_WORKERS", "4"))  # Patients uploaded concurrently
+DHIS2_REQUEST_TIMEOUT = float(os.getenv("DHIS2_REQUEST_TIMEOUT", "60"))  # Seconds before a DHIS2 call times out
+DHIS2_IMPORT_MODE = os.getenv("DHIS2_IMPORT_MODE", "single")  # 'single' posts each record, 'bulk' posts batches of records
+DHIS2_BULK_BATCH_SIZE = int(os.getenv("DHIS2_BULK_BATCH_SIZE", "50"))  # Tracked entity instances per bulk import request
+DHIS2_MAX_RETRIES = int(os.getenv("DHIS2_MAX_RETRIES", "5"))  # Retries of a failed DHIS2 call before giving up
+DHIS2_BACKOFF_BASE = float(os.getenv("DHIS2_BACKOFF_BASE", "1"))  # Seconds of the first retry backoff, doubled at each retry
+DHIS2_BACKOFF_MAX = float(os.getenv("DHIS2_BACKOFF_MAX", "60"))  # Longest wait between two retries, Retry-After included
+DHIS2_RATE_LIMIT = float(os.getenv("DHIS2_RATE_LIMIT", "10"))  # Requests per second to start with
+DHIS2_MAX_RATE_LIMIT = float(os.getenv("DHIS2_MAX_RATE_LIMIT", "50"))  # Requests per second the rate never grows beyond
+DHIS2_TARGET_LATENCY = float(os.getenv("DHIS2_TARGET_LATENCY", "2"))  # Seconds per response above which the rate is lowered
+DHIS2_CIRCUIT_FAILURES = int(os.getenv("DHIS2_CIRCUIT_FAILURES", "5"))  # Consecutive failed calls that pause all calls
+DHIS2_CIRCUIT_RESET = float(os.getenv("DHIS2_CIRCUIT_RESET", "30"))  # Seconds calls are paused before DHIS2 is probed again
+
+# Pre-upload validation configuration
+DHIS2_VALIDATE = os.getenv("DHIS2_VALIDATE", "true").lower() in ("1", "true", "yes")  # Check payloads against the DHIS2 metadata before uploading them
+DHIS2_METADATA_FILE = os.getenv("DHIS2_METADATA_FILE", "logs/dhis2_metadata.json")  # Cached snapshot of the DHIS2 metadata payloads are checked against
+DHIS2_METADATA_MAX_AGE = float(os.getenv("DHIS2_METADATA_MAX_AGE", "86400"))  # Seconds before the metadata snapshot is fetched again
+DHIS2_REJECT_REPORT = os.getenv("DHIS2_REJECT_REPORT", "logs/rejected.jsonl")  # Records failing validation, one JSON object per line
+
+# Dead-letter configuration
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", "logs/dead_letters.db")  # Patients that failed extraction, transformation, validation or upload, to replay
+DEAD_LETTER_MAX_ATTEMPTS = int(os.getenv("DEAD_LETTER_MAX_ATTEMPTS", "5"))  # Attempts after which a dead letter is no longer replayed; 0 for no limit
+REPLAY_WORKERS = int(os.getenv("REPLAY_WORKERS", "2"))  # Dead-letter batches replayed at the same time
+REPLAY_BATCH_SIZE = int(os.getenv("REPLAY_BATCH_SIZE", "100"))  # Dead letters per replay batch
+
+# Logging configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # DEBUG adds per-patient and per-record lines
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # 'text', or 'json' for one JSON object per line
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))  # Size at which logs/sync.log is rotated
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))  # Rotated log files kept
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))  # Fraction of the record payloads logged at DEBUG level
+
+# Metrics configuration
+METRICS_FILE = os.getenv("METRICS_FILE", "logs/metrics.prom")  # Prometheus text file written at the end of a run; empty to disable
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Port serving the metrics on /metrics during a run; 0 disables it
+
+# Staging configuration
+STAGING_COMPRESS = os.getenv("STAGING_COMPRESS", "true").lower() in ("1", "true", "yes")  # zlib-compress the payloads staged in logs/staging.db
+
+# Pipelined extract -> transform -> load configuration
+SYNC_PIPELINE = os.getenv("SYNC_PIPELINE", "false").lower() in ("1", "true", "yes")  # Upload while extracting instead of staging every patient first
+PIPELINE_EXTRACT_WORKERS = int(os.getenv("PIPELINE_EXTRACT_WORKERS", "2"))  # OpenMRS connections extracting in parallel
+PIPELINE_TRANSFORM_WORKERS = int(os.getenv("PIPELINE_TRANSFORM_WORKERS", "1"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))  # Batches waiting between two stages before the earlier one blocks
+PIPELINE_BATCH_SIZE = int(os.getenv("PIPELINE_BATCH_SIZE", "100"))  # Patients per pipeline batch
+
+# Multi-process transformation configuration
+SYNC_PROCESSES = int(os.getenv("SYNC_PROCESSES", "1"))  # Processes extracting and transforming patient shards; 1 disables sharding
+SYNC_SHARD_SIZE = int(os.getenv("SYNC_SHARD_SIZE", "500"))  # Patients per shard handed to a process
+
+# Multi-location batch run configuration
+SYNC_LOCATION_CONCURRENCY = int(os.getenv("SYNC_LOCATION_CONCURRENCY", "2"))  # Locations synced at the same time in batch mode
@@ -1,3 +1,3 @@
-from .openmrs_connector import OpenMRSConnector
+from .openmrs_connector import OpenMRSConnector, OpenMRSMetadata
 from .dhis2_connector import DHIS2Connector
 
@@ -1,54 +1,469 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
 import base64
 import logging
 import os
 import json
+import time
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from utils.batching import batched
+from utils.logger import log_payload
+from utils.metrics import METRICS
+from utils.profiling import PATIENT_TIMINGS
+from utils.progress_tracker import UPLOADED, FAILED
+from utils.reference_index import payload_hash
+from utils.dead_letter_store import STAGES, UPLOAD, VALIDATION
+from utils.staging_store import REJECTED
+from utils.resilience import AdaptiveRateLimiter, CircuitBreaker, CircuitOpenError, backoff_delay, retry_after_seconds
+
+# Responses meaning the server is overloaded or briefly unavailable, worth retrying later
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+# Responses that mean the request was refused before it was processed, so even a POST can be resent safely
+REFUSED_STATUS_CODES = {429, 503}
+# Records carrying their own UIDs are created or updated, so posting them twice does not duplicate them
+UPSERT = 'strategy=CREATE_AND_UPDATE'
 
 class DHIS2Connector:
-    def __init__(self, base_url, username, password):
+    def __init__(self, base_url, username, password, max_workers=4, pool_size=None, timeout=60, import_mode='single', batch_size=50,
+                 max_retries=5, backoff_base=1.0, backoff_max=60, rate_limit=10, max_rate_limit=50, target_latency=2.0,
+                 circuit_failures=5, circuit_reset=30):
         self.base_url = base_url
         self.username = username
         self.password = password
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.import_mode = import_mode
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Shared by all upload workers, so together they adapt to what DHIS2 can take
+        self.rate_limiter = AdaptiveRateLimiter(rate=rate_limit, max_rate=max_rate_limit, target_latency=target_latency)
+        self.circuit_breaker = CircuitBreaker(failure_threshold=circuit_failures, reset_timeout=circuit_reset)
+        # Checkpoint store the upload results are recorded in, when set
+        self.progress_tracker = None
+        # Index of the synced DHIS2 records, used to skip unchanged events, when set
+        self.reference_index = None
+        # ValidationService the payloads are checked with before they are uploaded, when set
+        self.validator = None
+        # DeadLetterStore the failed uploads are recorded in for a later replay, when set
+        self.dead_letters = None
+        # One keep-alive session for all calls, with enough pooled connections for every upload worker
+        pool_size = pool_size or max_workers
+        self.session = requests.Session()
+        self.session.headers.update(self.get_auth_header())
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def process_patient_files(self, directory='patients_to_sync', max_workers=None):
+        """Upload the patient files in a directory, several patients at a time.
 
-    def process_patient_files(self, directory='patients_to_sync'):
+        Each patient is handled by one worker from start to end, so its tracked entity instance is
+        always posted before its events. In 'bulk' import mode each worker posts a batch of
+        `batch_size` patients, events nested, in a single request.
+        """
         files = sorted(os.listdir(directory), key=lambda x: os.path.getctime(os.path.join(directory, x)))
-        for filename in files:
-            if not filename.endswith('.json'):
-                continue
-            file_path = os.path.join(directory, filename)
+        files = [filename for filename in files if filename.endswith('.json')]
+        max_workers = max_workers or self.max_workers
+        logging.info(f"Uploading {len(files)} patient files from {directory} with {max_workers} workers in {self.import_mode} mode.")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if self.import_mode == 'bulk':
+                batches = [files[start:start + self.batch_size] for start in range(0, len(files), self.batch_size)]
+                results = [entity_id for batch_results in executor.map(lambda batch: self.process_patient_file_batch(directory, batch), batches) for entity_id in batch_results]
+            else:
+                results = list(executor.map(lambda filename: self.process_patient_file(directory, filename), files))
+        uploaded = sum(1 for entity_id in results if entity_id)
+        logging.info(f"Uploaded {uploaded} of {len(files)} patient files from {directory}.")
+        return uploaded
+
+    def process_patient_file(self, directory, filename):
+        """Upload one patient file and rename it with the tracked entity instance ID on success."""
+        file_path = os.path.join(directory, filename)
+        patient_data = None
+        try:
             with open(file_path, 'r') as file:
                 patient_data = json.load(file)
-            # Assuming that patient_data is a dictionary that contains the full tracked entity instance data
-            # under a key that is not just 'trackedEntityType'. We need to find the correct key or construct
-            # the full JSON object if necessary. For this example, let's assume the full data is under the key
-            # 'trackedEntityInstance'.
-            try:
-                logging.info(f"Posting tracked entity instance data: {json.dumps(patient_data, indent=4)}")
-                org_unit = patient_data.get('orgUnit')
-                
-                response = self.make_api_call('trackedEntityInstances', method='POST', data=patient_data)
-                if response and 'response' in response and 'importSummaries' in response['response']:
-                    entity_id = response['response']['importSummaries'][0]['reference']
-                    for enrollment in patient_data.get('enrollments', []):
-                        # Extract program, enrollmentDate, and incidentDate from each enrollment
-                        program = enrollment.get('program')
-                        enrollment_date = enrollment.get('enrollmentDate')
-                        incident_date = enrollment.get('incidentDate')
-                        for event in enrollment.get('events', []):
-                            # Include program, orgUnit, enrollmentDate, and incidentDate in each event
-                            event['program'] = program
-                            event['orgUnit'] = org_unit  # orgUnit is still taken from the root level
-                            event['enrollmentDate'] = enrollment_date
-                            event['incidentDate'] = incident_date
-                            event['trackedEntityInstance'] = entity_id
-                            event['status'] = 'COMPLETED'  # Mark the event as completed
-                            logging.info(f"Posting event data: {json.dumps(event, indent=4)}")
-                            self.make_api_call('events', method='POST', data=event)
-                    new_filename = f"{entity_id}_{filename}"
-                    os.rename(file_path, os.path.join(directory, new_filename))
-            except Exception as e:
-                logging.error(f"Error processing file {filename}: {e}")
-                continue
+            entity_id = self.upload_patient(patient_data)
+            if entity_id:
+                new_filename = f"{entity_id}_{filename}"
+                os.rename(file_path, os.path.join(directory, new_filename))
+            self._record_upload(os.path.splitext(filename)[0], entity_id, payload=patient_data)
+            return entity_id
+        except Exception as e:
+            logging.error("Error processing file %s: %s", filename, e)
+            self._record_upload(os.path.splitext(filename)[0], None, error=e, payload=patient_data)
+            return None
+
+    def process_patient_file_batch(self, directory, filenames):
+        """Upload several patient files in one bulk request, renaming each file that was imported."""
+        try:
+            patients = []
+            for filename in filenames:
+                with open(os.path.join(directory, filename), 'r') as file:
+                    patients.append(json.load(file))
+            entity_ids = self.upload_patients_bulk(patients)
+        except Exception as e:
+            logging.error("Error processing files %s to %s: %s", filenames[0], filenames[-1], e)
+            for index, filename in enumerate(filenames):
+                self._record_upload(os.path.splitext(filename)[0], None, error=e, payload=patients[index] if index < len(patients) else None)
+            return [None] * len(filenames)
+        for filename, patient_data, entity_id in zip(filenames, patients, entity_ids):
+            if entity_id:
+                os.rename(os.path.join(directory, filename), os.path.join(directory, f"{entity_id}_{filename}"))
+            self._record_upload(os.path.splitext(filename)[0], entity_id, payload=patient_data)
+        return entity_ids
+
+    def process_staged_patients(self, staging_store, max_workers=None):
+        """Upload the patients waiting in a StagingStore, several at a time, and record each result in it.
+
+        The store is read in batches of `batch_size` patients per worker, so memory stays flat
+        however many patients are staged. Returns the number of patients uploaded.
+        """
+        max_workers = max_workers or self.max_workers
+        logging.info(f"Uploading {staging_store.count()} staged patients with {max_workers} workers in {self.import_mode} mode.")
+        uploaded = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for patients in staging_store.iter_batches(self.batch_size * max_workers):
+                uploaded += self.upload_staged(staging_store, patients, executor)
+        logging.info(f"Uploaded {uploaded} staged patients.")
+        return uploaded
+
+    def upload_staged(self, staging_store, patients, executor=None):
+        """Validate and upload a list of (patient_id, payload) pairs staged in a StagingStore and record each result.
+
+        Patients are uploaded in bulk requests of `batch_size` or one by one, depending on the
+        import mode, on the threads of `executor` if given. Returns the number of patients uploaded.
+        """
+        patients = self.reject_invalid(patients, staging_store)
+        map_function = executor.map if executor is not None else map
+        if self.import_mode == 'bulk':
+            results = map_function(lambda batch: self._upload_staged_batch(staging_store, batch), batched(patients, self.batch_size))
+            return sum(1 for batch_results in results for entity_id in batch_results if entity_id)
+        return sum(1 for entity_id in map_function(lambda patient: self._upload_staged_patient(staging_store, *patient), patients) if entity_id)
+
+    def reject_invalid(self, patients, staging_store=None):
+        """Return the (patient_id, payload) pairs of a batch that pass the validator, recording the others as rejected.
+
+        Rejected patients are never sent; they are marked rejected in the staging store, if
+        given, so later runs do not retry them, failed in the checkpoint store, and recorded as
+        dead letters of the validation stage, to replay once the data or metadata is fixed. The
+        payloads returned are copies without their invalid events, each kept as a dead letter of
+        its own, by event UID, so the staged payloads are left whole.
+        """
+        if self.validator is None:
+            return patients
+        payloads = dict(patients)
+        valid, rejected, dropped = self.validator.validate_batch(patients)
+        for patient_id, errors in rejected:
+            error = ValueError(f"rejected by validation: {'; '.join(errors)}")
+            if staging_store is not None:
+                staging_store.mark(patient_id, REJECTED, error=str(error))
+            self._record_upload(patient_id, None, error=error, payload=payloads[patient_id], stage=VALIDATION)
+        if self.dead_letters is not None:
+            for patient_id, event, errors in dropped:
+                error = ValueError(f"rejected by validation: {'; '.join(errors)}")
+                self.dead_letters.add(patient_id, VALIDATION, event, error, record=event.get('event') or payload_hash(event))
+        return valid
+
+    def upload_rejected_events(self, events):
+        """Upload again a list of (patient_id, event) pairs dropped by validation, and resolve or record each again.
+
+        The events carry the fields of their enrollment and patient and are posted in one bulk
+        request, after being validated again. Returns the number of events uploaded.
+        """
+        pending = []
+        for patient_id, event in events:
+            record = event.get('event') or payload_hash(event)
+            errors = self.validator.validate_event(event) if self.validator is not None else []
+            if errors:
+                self.dead_letters.add(patient_id, VALIDATION, event, ValueError(f"rejected by validation: {'; '.join(errors)}"), record=record)
+            else:
+                pending.append((patient_id, record, dict(event, status='COMPLETED')))
+        if not pending:
+            return 0
+        try:
+            event_ids = self.upload_events_bulk([event for _, _, event in pending])
+            error = None
+        except Exception as e:
+            logging.error("Error uploading %d events dropped by validation: %s", len(pending), e)
+            event_ids, error = [None] * len(pending), e
+        for (patient_id, record, event), event_id in zip(pending, event_ids):
+            if event_id:
+                self._record_references(event.get('trackedEntityInstance'), [event], {event['event']: payload_hash(event)} if event.get('event') else {})
+                self.dead_letters.resolve_records(patient_id, VALIDATION, [record])
+            else:
+                self.dead_letters.add(patient_id, VALIDATION, event, error, record=record)
+        return sum(1 for event_id in event_ids if event_id)
+
+    def _upload_staged_patient(self, staging_store, patient_id, patient_data):
+        """Upload one staged patient and record the result."""
+        try:
+            with PATIENT_TIMINGS.timed(patient_id, 'upload'):
+                entity_id = self.upload_patient(patient_data)
+            error = None
+        except Exception as e:
+            logging.error("Error uploading staged patient ID %s: %s", patient_id, e)
+            entity_id, error = None, e
+        self._record_staged_upload(staging_store, patient_id, entity_id, error, patient_data)
+        return entity_id
+
+    def _upload_staged_batch(self, staging_store, patients):
+        """Upload a batch of staged patients in one bulk request and record each result."""
+        try:
+            entity_ids = self.upload_patients_bulk([patient_data for _, patient_data in patients])
+            error = None
+        except Exception as e:
+            logging.error("Error uploading staged patients %s to %s: %s", patients[0][0], patients[-1][0], e)
+            entity_ids, error = [None] * len(patients), e
+        for (patient_id, patient_data), entity_id in zip(patients, entity_ids):
+            self._record_staged_upload(staging_store, patient_id, entity_id, error, patient_data)
+        return entity_ids
+
+    def _record_staged_upload(self, staging_store, patient_id, entity_id, error=None, payload=None):
+        """Record the upload result of a staged patient in the staging store, the checkpoint store and the dead letters."""
+        if entity_id:
+            staging_store.mark(patient_id, UPLOADED, dhis2_reference=entity_id)
+        else:
+            staging_store.mark(patient_id, FAILED, error=str(error) if error else 'import failed')
+        self._record_upload(patient_id, entity_id, error=error, payload=payload)
+
+    def _record_upload(self, patient_id, entity_id, error=None, payload=None, stage=UPLOAD):
+        """Record the upload result of a patient in the checkpoint store and the dead letters.
+
+        A failed upload is kept as a dead letter with its payload and `error`, the exception
+        raised or None if DHIS2 refused the record; an upload that succeeded resolves those of the
+        patient and those of the events it uploaded, but not those of the events validation dropped.
+        """
+        if self.dead_letters is not None:
+            if entity_id:
+                self.dead_letters.resolve([patient_id], STAGES)
+                if payload is not None:
+                    event_uids = [event['event'] for enrollment in payload.get('enrollments', []) for event in enrollment.get('events', []) if event.get('event')]
+                    self.dead_letters.resolve_records(patient_id, VALIDATION, event_uids)
+            elif payload is not None:
+                self.dead_letters.add(patient_id, stage, payload, error)
+        if self.progress_tracker is None:
+            return
+        if entity_id:
+            self.progress_tracker.mark_patient_state(patient_id, UPLOADED, dhis2_reference=entity_id)
+        else:
+            self.progress_tracker.mark_patient_state(patient_id, FAILED, error=str(error) if error else 'import failed')
+
+    def upload_patient(self, patient_data):
+        """Post a tracked entity instance with its enrollments and events nested, or only its changed events.
+
+        Returns the tracked entity instance ID, or None if it or one of its events failed. Payloads
+        carrying their own UIDs are upserted, so uploading a patient again updates its records.
+        Only the parts whose payload changed since they were last synced are sent: a patient
+        synced unchanged before makes no HTTP call at all.
+        """
+        # Assuming that patient_data is a dictionary that contains the full tracked entity instance data
+        # under a key that is not just 'trackedEntityType'. We need to find the correct key or construct
+        # the full JSON object if necessary. For this example, let's assume the full data is under the key
+        # 'trackedEntityInstance'.
+        entity_id = patient_data.get('trackedEntityInstance')
+        events, event_hashes, tracked_entity_hash, tracked_entity_changed = self._pending_changes(patient_data)
+        if not tracked_entity_changed and not events:
+            METRICS.increment('dhis2_unchanged_skipped_total', record='trackedEntityInstance')
+            logging.debug("Tracked entity instance %s is unchanged since it was synced, skipping it.", entity_id)
+            return entity_id
+        if tracked_entity_changed:
+            logging.debug("Posting tracked entity instance %s with %d events.", entity_id, len(events))
+            log_payload("Tracked entity instance payload", entity_id, patient_data)
+            response = self.make_api_call(f'trackedEntityInstances?{UPSERT}', method='POST', data=patient_data, idempotent=entity_id is not None)
+            summaries = self._import_summaries(response)
+            if not summaries:
+                return None
+            entity_id = self._summary_reference(summaries[0])
+            if not entity_id:
+                return None
+        elif events:
+            # The events of a posted tracked entity instance are imported with it, nested in its enrollments;
+            # otherwise the changed events are posted together rather than one request each
+            for event in events:
+                event.setdefault('trackedEntityInstance', entity_id)
+                log_payload("Event payload", event.get('event'), event)
+            event_ids = self.upload_events_bulk(events)
+            # Only the events DHIS2 accepted are recorded as synced; the others are sent again next time
+            accepted = [event for event, event_id in zip(events, event_ids) if event_id]
+            self._record_references(entity_id, accepted, {event['event']: event_hashes[event['event']] for event in accepted if event.get('event') in event_hashes})
+            return entity_id if all(event_ids) else None
+        self._record_references(entity_id, events, event_hashes, tracked_entity_hash, patient_data.get('enrollments', []))
+        return entity_id
+
+    def upload_patients_bulk(self, patients):
+        """Post many tracked entity instances, with their enrollments and events nested, in one request.
+
+        Returns the tracked entity instance ID of each patient in order, or None for the patients
+        whose import summary, or the summary of one of their enrollments or events, is an error.
+        Patients synced unchanged before are not sent.
+        """
+        pending = [self._pending_changes(patient_data) for patient_data in patients]
+        entity_ids = [patient_data.get('trackedEntityInstance') for patient_data in patients]
+        changed = [index for index, (events, _, _, tracked_entity_changed) in enumerate(pending) if tracked_entity_changed or events]
+        if len(changed) < len(patients):
+            METRICS.increment('dhis2_unchanged_skipped_total', len(patients) - len(changed), record='trackedEntityInstance')
+            logging.info("Skipping %d tracked entity instances unchanged since they were synced.", len(patients) - len(changed))
+        if not changed:
+            return entity_ids
+        upsert = all(entity_ids[index] is not None for index in changed)
+        logging.info("Posting %d tracked entity instances in bulk.", len(changed))
+        response = self.make_api_call(f'trackedEntityInstances?{UPSERT}', method='POST', data={"trackedEntityInstances": [patients[index] for index in changed]}, accept_conflict=True, idempotent=upsert)
+        summaries = self._import_summaries(response)
+        if len(summaries) != len(changed):
+            raise ValueError(f"Expected {len(changed)} import summaries, got {len(summaries)}.")
+        for index, summary in zip(changed, summaries):
+            entity_ids[index] = self._summary_reference(summary)
+            if entity_ids[index]:
+                events, event_hashes, tracked_entity_hash, _ = pending[index]
+                self._record_references(entity_ids[index], events, event_hashes, tracked_entity_hash, patients[index].get('enrollments', []))
+        return entity_ids
+
+    def upload_events_bulk(self, events):
+        """Post many events in one request. Returns the event ID of each event in order, or None if it failed."""
+        logging.info("Posting %d events in bulk.", len(events))
+        upsert = all('event' in event for event in events)
+        response = self.make_api_call(f'events?{UPSERT}', method='POST', data={"events": events}, accept_conflict=True, idempotent=upsert)
+        summaries = self._import_summaries(response)
+        if len(summaries) != len(events):
+            raise ValueError(f"Expected {len(events)} import summaries, got {len(summaries)}.")
+        return [self._summary_reference(summary) for summary in summaries]
+
+    def find_tracked_entity_instances(self, attribute, values, tracked_entity_type='j9TllKXZ3jb', chunk_size=50):
+        """Look up existing tracked entity instances by a unique attribute, e.g. the OpenMRS patient UUID.
+
+        Returns a dict of attribute value -> tracked entity instance UID for the values found in
+        any org unit the user can access. Values are queried `chunk_size` at a time.
+        """
+        return self.find_tracked_entities(attribute, values, tracked_entity_type, chunk_size)[0]
+
+    def find_tracked_entities(self, attribute, values, tracked_entity_type='j9TllKXZ3jb', chunk_size=50):
+        """Like `find_tracked_entity_instances`, also returning the active enrollments of the instances found.
+
+        Returns (references, enrollments): the dict of attribute value -> tracked entity instance
+        UID, and a dict of (tracked entity instance UID, program) -> active enrollment UID, read
+        from the same responses.
+        """
+        values = [value for value in values if value]
+        references = {}
+        enrollments = {}
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start:start + chunk_size]
+            query = urlencode({
+                'trackedEntityType': tracked_entity_type,
+                'ouMode': 'ACCESSIBLE',
+                'filter': f"{attribute}:IN:{';'.join(chunk)}",
+                'fields': 'trackedEntityInstance,attributes[attribute,value],enrollments[enrollment,program,status]',
+                'paging': 'false'
+            })
+            response = self.make_api_call(f'trackedEntityInstances.json?{query}')
+            for instance in (response or {}).get('trackedEntityInstances', []):
+                for instance_attribute in instance.get('attributes', []):
+                    if instance_attribute.get('attribute') == attribute:
+                        references[instance_attribute.get('value')] = instance['trackedEntityInstance']
+                for enrollment in instance.get('enrollments', []):
+                    if enrollment.get('status') == 'ACTIVE':
+                        enrollments[(instance['trackedEntityInstance'], enrollment.get('program'))] = enrollment.get('enrollment')
+        logging.info("Found %d of %d tracked entity instances in DHIS2 by attribute %s, with %d active enrollments.", len(references), len(values), attribute, len(enrollments))
+        return references, enrollments
+
+    def _pending_changes(self, patient_data):
+        """Prepare the events of a patient and drop those DHIS2 already holds unchanged from its payload.
+
+        Returns (events, event_hashes, tracked_entity_hash, tracked_entity_changed): the events
+        left to send, the payload hashes to record once they are uploaded, by event UID, the hash
+        of the tracked entity instance payload without its events, and whether that payload
+        changed since it was last synced.
+        """
+        entity_id = patient_data.get('trackedEntityInstance')
+        events = self._prepare_events(patient_data, entity_id)
+        event_hashes = {event['event']: payload_hash(event) for event in events if event.get('event')}
+        if entity_id is None:
+            return events, event_hashes, None, True
+        tracked_entity_hash = payload_hash(dict(patient_data, enrollments=[
+            {key: value for key, value in enrollment.items() if key != 'events'} for enrollment in patient_data.get('enrollments', [])
+        ]))
+        if self.reference_index is None:
+            return events, event_hashes, tracked_entity_hash, True
+        tracked_entity_changed = self.reference_index.get_synced_tracked_entity_hash(entity_id) != tracked_entity_hash
+        synced_hashes = self.reference_index.get_synced_event_hashes(event_hashes)
+        unchanged = {event_uid for event_uid, event_hash in event_hashes.items() if synced_hashes.get(event_uid) == event_hash}
+        if unchanged:
+            METRICS.increment('dhis2_unchanged_skipped_total', len(unchanged), record='event')
+            logging.debug("Skipping %d events of tracked entity instance %s already synced unchanged.", len(unchanged), entity_id)
+            for enrollment in patient_data.get('enrollments', []):
+                enrollment['events'] = [event for event in enrollment.get('events', []) if event.get('event') not in unchanged]
+            events = [event for event in events if event.get('event') not in unchanged]
+            event_hashes = {event_uid: event_hash for event_uid, event_hash in event_hashes.items() if event_uid not in unchanged}
+        return events, event_hashes, tracked_entity_hash, tracked_entity_changed
+
+    def _record_references(self, entity_id, events, event_hashes, tracked_entity_hash=None, enrollments=()):
+        """Record an uploaded tracked entity instance, the enrollments posted with it and its uploaded events in the reference index.
+
+        Enrollment and event UIDs are indexed only once DHIS2 accepted them, so a failed upload
+        leaves no enrollment behind for the next transform to reuse.
+        """
+        if self.reference_index is not None:
+            self.reference_index.mark_synced(
+                entity_id, event_hashes, tracked_entity_hash,
+                enrollments={enrollment['program']: enrollment['enrollment'] for enrollment in enrollments if enrollment.get('enrollment')},
+                event_enrollments={event['event']: event['enrollment'] for event in events if event.get('event') and event.get('enrollment')}
+            )
+
+    @staticmethod
+    def _prepare_events(patient_data, entity_id=None):
+        """Fill in the enrollment and patient fields of every event of a patient and return the events."""
+        org_unit = patient_data.get('orgUnit')
+        events = []
+        for enrollment in patient_data.get('enrollments', []):
+            # Extract program, enrollmentDate, and incidentDate from each enrollment
+            program = enrollment.get('program')
+            enrollment_id = enrollment.get('enrollment')
+            enrollment_date = enrollment.get('enrollmentDate')
+            incident_date = enrollment.get('incidentDate')
+            for event in enrollment.get('events', []):
+                # Include program, orgUnit, enrollmentDate, and incidentDate in each event
+                event['program'] = program
+                event['orgUnit'] = org_unit  # orgUnit is still taken from the root level
+                event['enrollmentDate'] = enrollment_date
+                event['incidentDate'] = incident_date
+                if enrollment_id:
+                    # Lets an event be upserted on its own once its enrollment is in DHIS2
+                    event['enrollment'] = enrollment_id
+                if entity_id:
+                    event['trackedEntityInstance'] = entity_id
+                event['status'] = 'COMPLETED'  # Mark the event as completed
+                events.append(event)
+        return events
+
+    @staticmethod
+    def _import_summaries(response):
+        """Return the list of import summaries of a bulk import response."""
+        return ((response or {}).get('response') or {}).get('importSummaries', [])
+
+    @classmethod
+    def _summary_reference(cls, summary):
+        """Return the reference of an import summary, or None if it or one of its nested summaries failed."""
+        errors = cls._summary_errors(summary)
+        if errors:
+            logging.error("Import of %s failed: %s", summary.get('reference'), '; '.join(errors))
+            return None
+        return summary.get('reference')
+
+    @classmethod
+    def _summary_errors(cls, summary):
+        """Collect the error descriptions of an import summary and of its nested enrollment and event summaries."""
+        errors = []
+        if summary.get('status') == 'ERROR':
+            conflicts = [f"{conflict.get('object')}: {conflict.get('value')}" for conflict in summary.get('conflicts', [])]
+            errors.append(summary.get('description') or ', '.join(conflicts) or 'unknown error')
+        for nested in ('enrollments', 'events'):
+            for nested_summary in (summary.get(nested) or {}).get('importSummaries', []):
+                errors.extend(cls._summary_errors(nested_summary))
+        return errors
 
     def get_auth_header(self):
         """Create the authorization header for DHIS2 API requests."""
@@ -58,19 +473,93 @@ class DHIS2Connector:
         base64_credentials = base64_bytes.decode('ascii')
         return {"Authorization": f"Basic {base64_credentials}"}
 
-    def make_api_call(self, endpoint, method='GET', data=None):
-        """Make an API call to the DHIS2 instance."""
+    def make_api_call(self, endpoint, method='GET', data=None, accept_conflict=False, idempotent=False):
+        """Make an API call to the DHIS2 instance over the pooled session.
+
+        Calls are paced by the adaptive rate limiter and refused while the circuit breaker is open.
+        Failed calls are retried up to `max_retries` times with exponential backoff and jitter, or
+        after the delay of a Retry-After header. A GET is retried on any timeout, connection error
+        or 429/502/503/504 response, and so is a POST marked `idempotent` (an upsert of records
+        carrying their own UIDs). Other POSTs are retried only when DHIS2 cannot have processed
+        them (connection refused, 429 or 503), so a retry never creates a record twice.
+
+        With `accept_conflict`, a 409 response is returned instead of raised: DHIS2 answers bulk
+        imports with some failed records that way, and the body holds the per-record summaries.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self._send(method, endpoint, data)
+                if accept_conflict and response.status_code == 409:
+                    return response.json()
+                response.raise_for_status()
+                return response.json()
+            except (requests.RequestException, CircuitOpenError) as err:
+                delay = self._retry_delay(err, attempt, idempotent=method == 'GET' or idempotent)
+                if delay is None:
+                    logging.error("Error in DHIS2 API call: %s", err)
+                    raise
+                attempt += 1
+                METRICS.increment('dhis2_retries_total', endpoint=endpoint.split('?')[0], method=method)
+                logging.warning("DHIS2 API call to %s failed (%s), retry %d of %d in %.1f seconds.", endpoint, err, attempt, self.max_retries, delay)
+                time.sleep(delay)
+
+    def _send(self, method, endpoint, data):
+        """Send one request through the circuit breaker and the rate limiter, and feed them and the metrics its outcome."""
         url = f"{self.base_url}/{endpoint}"
-        headers = self.get_auth_header()
+        labels = {'endpoint': endpoint.split('?')[0], 'method': method}
+        if not self.circuit_breaker.allow_request():
+            METRICS.increment('dhis2_circuit_open_total', **labels)
+            raise CircuitOpenError(f"DHIS2 circuit breaker is open, calls are paused for {self.circuit_breaker.retry_after():.0f} seconds")
+        self.rate_limiter.acquire()
+        started_at = time.monotonic()
         try:
-            if method == 'GET':
-                response = requests.get(url, headers=headers)
-            elif method == 'POST':
-                response = requests.post(url, headers=headers, json=data)
-            # Add other HTTP methods as needed
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as err:
-            logging.error(f"Error in DHIS2 API call: {err}")
+            with METRICS.timer('dhis2_request_seconds', **labels):
+                if method == 'GET':
+                    response = self.session.get(url, timeout=self.timeout)
+                elif method == 'POST':
+                    response = self.session.post(url, json=data, timeout=self.timeout)
+                else:
+                    # Add other HTTP methods as needed
+                    raise ValueError(f"Unsupported HTTP method: {method}")
+        except (requests.ConnectionError, requests.Timeout):
+            self.circuit_breaker.record_failure()
             raise
+        METRICS.increment('dhis2_responses_total', status=response.status_code, **labels)
+        if response.status_code >= 400:
+            METRICS.increment('dhis2_request_errors_total', **labels)
+        self.rate_limiter.record(time.monotonic() - started_at, throttled=response.status_code in REFUSED_STATUS_CODES)
+        if response.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        return response
+
+    def _retry_delay(self, err, attempt, idempotent=False):
+        """Return how long to wait before retrying a failed call, or None if it must not be retried."""
+        if attempt >= self.max_retries:
+            return None
+        if isinstance(err, CircuitOpenError):
+            return max(self.circuit_breaker.retry_after(), backoff_delay(attempt, self.backoff_base, self.backoff_max))
+        response = getattr(err, 'response', None)
+        if response is not None:
+            retryable = RETRYABLE_STATUS_CODES if idempotent else REFUSED_STATUS_CODES
+            if response.status_code not in retryable:
+                return None
+            retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return min(retry_after, self.backoff_max)
+        elif not isinstance(err, (requests.ConnectionError, requests.Timeout)):
+            return None
+        elif not idempotent and not self._not_sent(err):
+            # The request may have reached DHIS2 before the connection failed or timed out
+            return None
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
 
+    @staticmethod
+    def _not_sent(err):
+        """Return whether a connection error or timeout happened before the request could be sent."""
+        if isinstance(err, requests.ConnectTimeout):
+            return True
+        reason = err.args[0].reason if err.args and isinstance(err.args[0], MaxRetryError) else None
+        return isinstance(reason, NewConnectionError)
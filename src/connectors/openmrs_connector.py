@@ -1,224 +1,632 @@
 import mysql.connector
+from mysql.connector import errorcode
+from mysql.connector.pooling import MySQLConnectionPool, CNX_POOL_MAXSIZE
+import functools
+import itertools
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from models.openmrs_models import OpenMRSObservation
+from utils.metrics import METRICS
+
+# Client errors meaning the server closed the connection, e.g. "MySQL server has gone away"
+LOST_CONNECTION_ERRORS = {errorcode.CR_SERVER_GONE_ERROR, errorcode.CR_SERVER_LOST, errorcode.CR_SERVER_LOST_EXTENDED}
+_pool_ids = itertools.count(1)
+
+def _retry_on_lost_connection(method):
+    """Run a query method again, on a fresh pooled connection, if the server dropped the first one."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except (mysql.connector.OperationalError, mysql.connector.InterfaceError) as err:
+            if err.errno not in LOST_CONNECTION_ERRORS:
+                raise
+            logging.warning("Lost the OpenMRS connection in %s (%s), retrying once.", method.__name__, err)
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _timed_query(method):
+    """Record the latency and failures of a query method in the metrics, labelled with its name."""
+    return METRICS.timed('openmrs_query_seconds', query=method.__name__)(method)
+
+def _text(value):
+    """Decode the bytes a prepared cursor may return for a character column."""
+    return value.decode() if isinstance(value, (bytes, bytearray)) else value
+
+# Observation rows of `_observations_query` are tuples of
+# (encounter_id, obs_id, concept, value_numeric, value_coded, value_text, value_datetime)
+
+def _observation_value(row):
+    """Return the value of an observation row from whichever value column is set."""
+    if row[3] is not None:
+        # Cast to int if the numeric value is an integer, otherwise return as is
+        return int(row[3]) if row[3].is_integer() else row[3]
+    elif row[4] is not None:
+        return row[4]
+    elif row[5] is not None:
+        return _text(row[5])
+    elif row[6] is not None:
+        return row[6].isoformat()
+    return None
+
+def _numeric_value(row):
+    value = row[3]
+    if value is None:
+        return _observation_value(row)
+    return int(value) if value.is_integer() else value
+
+def _coded_value(row):
+    return row[4] if row[4] is not None else _observation_value(row)
+
+def _text_value(row):
+    return _text(row[5]) if row[5] is not None else _observation_value(row)
+
+def _datetime_value(row):
+    return row[6].isoformat() if row[6] is not None else _observation_value(row)
+
+# Concept datatype (HL7 abbreviation) -> function reading the value column of that datatype.
+# Other datatypes, e.g. boolean, complex or N/A, look for whichever value column is set.
+VALUE_READERS = {
+    'NM': _numeric_value,
+    'CWE': _coded_value,
+    'ST': _text_value,
+    'TS': _datetime_value,
+    'DT': _datetime_value,
+    'TM': _datetime_value
+}
+
+class OpenMRSMetadata:
+    """Concept and form metadata of the OpenMRS database, loaded once and shared by the connectors of a run.
+
+    Only the concepts of `concept_uuids`, those the form mappings use, are loaded, so observations
+    are filtered by concept_id in the database and their UUIDs looked up here instead of joining
+    `concept` on every row. With `concept_uuids` None, observations are not filtered.
+    """
+
+    def __init__(self, concept_uuids=None):
+        self.concept_uuids = concept_uuids
+        # concept_id -> (concept UUID, value reader of its datatype), for the concepts of concept_uuids found in the database,
+        # ordered by concept_id. Replaced, not mutated, on reload, so a query and the decoding of its rows can share one map
+        self.concepts = {}
+        # form_id -> (form UUID, encounter_type_id)
+        self.forms = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def use_concepts(self, concept_uuids):
+        """Switch to the concept UUIDs of reloaded mappings; the metadata is reloaded on next use.
+
+        The mapping registry replaces its set of concept UUIDs on every reload, so an edit of the
+        mappings also picks up the concepts and forms added to OpenMRS since the metadata was loaded.
+        """
+        with self.lock:
+            if concept_uuids is not self.concept_uuids:
+                self.concept_uuids = concept_uuids
+                self.loaded = False
 
 class OpenMRSConnector:
-    def __init__(self, host, user, password, database):
+    # person_attribute_type_id -> key of the attribute in the patient row
+    PERSON_ATTRIBUTE_TYPES = {19: 'national_id', 11: 'phone_number', 3: 'citizenship'}
+    _EMPTY_ADDRESS = dict.fromkeys(['country', 'province', 'district', 'sector', 'cell', 'village'])
+
+    def __init__(self, host, user, password, database, chunk_size=500, pool_size=5, pool=None, checkout_timeout=60, metadata=None,
+                 stream_write_timeout=3600):
         self.host = host.strip()
         self.user = user.strip()
         self.password = password.strip()
         self.database = database.strip()
-        self.connection = None
+        self.chunk_size = chunk_size
+        self.pool_size = min(pool_size, CNX_POOL_MAXSIZE)
+        # A pool passed in is shared with other connectors and is not closed by this one
+        self.pool = pool
+        self.owns_pool = pool is None
+        # Connections taken from the pool and not yet released, and those of them whose pool was closed meanwhile
+        self.checked_out = set()
+        self.orphaned = set()
+        self.connections_lock = threading.Lock()
+        self.checkout_timeout = checkout_timeout
+        self.stream_write_timeout = stream_write_timeout
+        self.patient_cache = {}
+        # Metadata passed in is shared with other connectors, so it is loaded once per run
+        self.metadata = metadata if metadata is not None else OpenMRSMetadata()
 
-    def fetch_patient_encounters_by_location(self, location_id, form_ids=None):
+    def fetch_patient_encounters_by_location(self, location_id, form_ids=None, since=None):
         """Fetch patient encounters for a given location ID and list of form IDs, grouped by patient ID."""
+        return dict(self.stream_patient_encounters_by_location(location_id, form_ids, since=since))
+
+    def stream_patient_encounters_by_location(self, location_id, form_ids=None, fetch_size=None, since=None):
+        """Yield (patient_id, [encounter_ids]) for a given location ID and list of form IDs, one patient at a time.
+
+        Rows are read from an unbuffered cursor ordered by patient ID, `fetch_size` rows at a time,
+        so memory stays flat however many encounters the location has. The stream runs on its own
+        connection because an unbuffered result blocks its connection until it is fully read, with a
+        `net_write_timeout` of `stream_write_timeout` seconds as the consumer may be slow. A stream the
+        server cut off raises an error rather than ending as if the location had no more encounters.
+
+        With `since`, only encounters created or changed after that time, or with observations
+        created after it, are returned.
+        """
         form_ids = form_ids or [197]  # Default form ID is 197 for mUzima NCD Screening Form
         form_ids_placeholder = ', '.join(['%s'] * len(form_ids))
         query = f"""
-        SELECT patient_id, GROUP_CONCAT(encounter_id) as encounter_ids, date_created
-        FROM encounter
-        WHERE location_id = %s AND form_id IN ({form_ids_placeholder})
-        GROUP BY patient_id
+        SELECT e.patient_id, e.encounter_id
+        FROM encounter e
+        WHERE e.location_id = %s AND e.form_id IN ({form_ids_placeholder})
         """
-        query_params = [location_id] + form_ids
+        query_params = [location_id] + list(form_ids)
+        if since is not None:
+            query += """
+            AND (e.date_created > %s OR e.date_changed > %s
+                 OR EXISTS (SELECT 1 FROM obs o WHERE o.encounter_id = e.encounter_id AND o.date_created > %s))
+            """
+            query_params += [since] * 3
+        query += "ORDER BY e.patient_id, e.encounter_id"
+        fetch_size = fetch_size or self.chunk_size
+        connection = self._open_connection()
+        cursor = None
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            cursor.execute(query, query_params)
-            result = cursor.fetchall()
-            patient_encounters = {}
-            for row in result:
-                patient_encounters[row['patient_id']] = [int(eid) for eid in row['encounter_ids'].split(',')]
-            return patient_encounters
+            # The server otherwise aborts the stream once the consumer leaves it unread for net_write_timeout (60 seconds by default)
+            cursor = connection.cursor()
+            cursor.execute(f"SET SESSION net_write_timeout = {int(self.stream_write_timeout)}")
+            cursor.close()
+            cursor = connection.cursor(buffered=False)
+            with METRICS.timer('openmrs_query_seconds', query='stream_patient_encounters_by_location'):
+                cursor.execute(query, query_params)
+            current_patient_id, encounter_ids = None, []
+            row_count = 0
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                row_count += len(rows)
+                METRICS.increment('openmrs_rows_total', len(rows), query='stream_patient_encounters_by_location')
+                for patient_id, encounter_id in rows:
+                    if patient_id != current_patient_id:
+                        if encounter_ids:
+                            yield current_patient_id, encounter_ids
+                        current_patient_id, encounter_ids = patient_id, []
+                    encounter_ids.append(encounter_id)
+            # A stream the server aborted can end like a complete one; the connection then no longer answers
+            if not connection.is_connected():
+                raise mysql.connector.OperationalError(
+                    msg=f"The encounter stream of location ID {location_id} was cut off by the server after {row_count} rows."
+                )
+            if encounter_ids:
+                yield current_patient_id, encounter_ids
         except mysql.connector.Error as err:
             logging.error(f"Error fetching encounter IDs: {err}")
             raise
         finally:
-            if cursor:
-                cursor.close()
+            try:
+                if cursor is not None:
+                    cursor.close()
+                connection.close()
+            except mysql.connector.Error as err:
+                # Closing a stream that was abandoned half-way can fail on the unread rows
+                logging.warning(f"Error closing the encounter stream connection: {err}")
+
+    @_timed_query
+    @_retry_on_lost_connection
+    def get_database_time(self):
+        """Return the current time of the OpenMRS database server, used as a delta sync watermark."""
+        try:
+            with self._cursor() as cursor:
+                cursor.execute("SELECT NOW()")
+                return cursor.fetchone()[0]
+        except mysql.connector.Error as err:
+            logging.error(f"Error fetching the database time: {err}")
+            raise
 
     def fetch_patient_data(self, patient_id):
-        """Fetch patient data for a given patient ID."""
-        query = """
-        SELECT per.uuid, pn.given_name, pn.middle_name, pn.family_name, pa.value AS national_id,
-        pp.value AS phone_number,
-        pc.value AS citizenship,
-        adr.country, adr.state_province AS province, adr.county_district AS district, adr.city_village AS sector,
-        adr.address3 AS cell,
-        adr.address1 AS village,
-        per.gender, per.birthdate, p.date_created, TIMESTAMPDIFF(YEAR, per.birthdate, CURDATE()) AS age
-        FROM patient p
-        JOIN person per ON p.patient_id = per.person_id
-        JOIN person_name pn ON per.person_id = pn.person_id
-        LEFT JOIN person_attribute pa ON p.patient_id = pa.person_id AND pa.person_attribute_type_id = 19
-        LEFT JOIN person_attribute pp ON p.patient_id = pp.person_id AND pp.person_attribute_type_id = 11
-        LEFT JOIN person_attribute pc ON p.patient_id = pc.person_id AND pc.person_attribute_type_id = 3
-        LEFT JOIN person_address adr ON p.patient_id = adr.person_id
-        WHERE p.patient_id = %s
+        """Fetch patient data for a given patient ID, from the per-run cache when it was prefetched."""
+        patient_id = int(patient_id)
+        if patient_id in self.patient_cache:
+            return self.patient_cache[patient_id]
+        return self.fetch_patients_data([patient_id]).get(patient_id, {})
+
+    @_timed_query
+    @_retry_on_lost_connection
+    def fetch_patients_data(self, patient_ids, chunk_size=None):
+        """Fetch patient data for many patient IDs with a few set-based queries per chunk.
+
+        Returns a dict of patient_id -> patient data in the shape of `fetch_patient_data`, and
+        stores it in the per-run patient cache. When a patient has several names, addresses or
+        values of the same attribute type, the non-voided, preferred and then oldest row wins.
         """
-        cursor = None
+        chunk_size = chunk_size or self.chunk_size
+        patient_ids = [int(pid) for pid in patient_ids]
+        attribute_type_ids = list(self.PERSON_ATTRIBUTE_TYPES)
+        patients = {}
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            cursor.execute(query, (patient_id,))
-            result = cursor.fetchone()
-            # Make sure to fetch all results to avoid "Unread result found" error
-            cursor.fetchall()
-            return {
-                'UUID': result.get('uuid', ''),
-                'First_Name': result.get('given_name', ''),
-                'Middle_Name': result.get('middle_name', ''),
-                'Family_Name': result.get('family_name', ''),
-                'National_ID': result.get('national_id', ''),
-                'Phone_Number': result.get('phone_number', ''),
-                'Citizenship': result.get('citizenship', ''),
-                'country': result.get('country', ''),
-                'Province': result.get('province', ''),
-                'District': result.get('district', ''),
-                'Sector': result.get('sector', ''),
-                'Cell': result.get('cell', ''),
-                'Village': result.get('village', ''),
-                'Sex': result.get('gender', ''),
-                'Birth_Date': result['birthdate'].isoformat() if result and result['birthdate'] else None,
-                'date_created': result['date_created'].isoformat() if result and result['date_created'] else None,
-                'Age_in_Years': result.get('age', '')
-            } if result else {}
+            with self._cursor(dictionary=True) as cursor:
+                for start in range(0, len(patient_ids), chunk_size):
+                    chunk = patient_ids[start:start + chunk_size]
+                    placeholder = ', '.join(['%s'] * len(chunk))
+                    rows = {}
+                    cursor.execute(f"""
+                    SELECT p.patient_id, per.uuid, per.gender, per.birthdate, p.date_created,
+                    TIMESTAMPDIFF(YEAR, per.birthdate, CURDATE()) AS age
+                    FROM patient p
+                    JOIN person per ON p.patient_id = per.person_id
+                    WHERE p.patient_id IN ({placeholder})
+                    """, chunk)
+                    for row in cursor.fetchall():
+                        rows[row['patient_id']] = dict(row, **dict.fromkeys(self.PERSON_ATTRIBUTE_TYPES.values()))
+                    cursor.execute(f"""
+                    SELECT person_id, given_name, middle_name, family_name
+                    FROM person_name
+                    WHERE person_id IN ({placeholder})
+                    ORDER BY person_id, voided, preferred DESC, person_name_id
+                    """, chunk)
+                    names = {}
+                    for row in cursor.fetchall():
+                        names.setdefault(row['person_id'], row)
+                    cursor.execute(f"""
+                    SELECT person_id, country, state_province AS province, county_district AS district,
+                    city_village AS sector, address3 AS cell, address1 AS village
+                    FROM person_address
+                    WHERE person_id IN ({placeholder})
+                    ORDER BY person_id, voided, preferred DESC, person_address_id
+                    """, chunk)
+                    addresses = {}
+                    for row in cursor.fetchall():
+                        addresses.setdefault(row['person_id'], row)
+                    type_placeholder = ', '.join(['%s'] * len(attribute_type_ids))
+                    cursor.execute(f"""
+                    SELECT person_id, person_attribute_type_id, value
+                    FROM person_attribute
+                    WHERE person_id IN ({placeholder}) AND person_attribute_type_id IN ({type_placeholder})
+                    ORDER BY person_id, person_attribute_type_id, voided, person_attribute_id
+                    """, chunk + attribute_type_ids)
+                    attributes = {}
+                    for row in cursor.fetchall():
+                        attributes.setdefault((row['person_id'], row['person_attribute_type_id']), row['value'])
+                    for patient_id, row in rows.items():
+                        # Like the original JOIN on person_name, patients without a name are not returned
+                        if patient_id not in names:
+                            continue
+                        row.update(names[patient_id])
+                        row.update(addresses.get(patient_id, self._EMPTY_ADDRESS))
+                        for type_id, key in self.PERSON_ATTRIBUTE_TYPES.items():
+                            row[key] = attributes.get((patient_id, type_id))
+                        patients[patient_id] = self._patient_record(row)
+            self.patient_cache.update(patients)
+            # Remember patients without data too, so they are not queried again one by one
+            for patient_id in patient_ids:
+                self.patient_cache.setdefault(patient_id, {})
+            METRICS.increment('openmrs_rows_total', len(patients), query='fetch_patients_data')
+            logging.info("Fetched patient data for %d of %d patients.", len(patients), len(patient_ids))
+            return patients
         except mysql.connector.Error as err:
-            logging.error(f"Error fetching patient data for patient ID {patient_id}: {err}")
+            logging.error("Error fetching patient data for %d patients: %s", len(patient_ids), err)
             raise
-        finally:
-            if cursor is not None:
-                cursor.close()
+
+    def clear_patient_cache(self):
+        """Drop the prefetched patient data."""
+        self.patient_cache.clear()
+
+    @staticmethod
+    def _patient_record(result):
+        """Build the patient data dict returned by `fetch_patient_data` from a joined row."""
+        return {
+            'UUID': result.get('uuid', ''),
+            'First_Name': result.get('given_name', ''),
+            'Middle_Name': result.get('middle_name', ''),
+            'Family_Name': result.get('family_name', ''),
+            'National_ID': result.get('national_id', ''),
+            'Phone_Number': result.get('phone_number', ''),
+            'Citizenship': result.get('citizenship', ''),
+            'country': result.get('country', ''),
+            'Province': result.get('province', ''),
+            'District': result.get('district', ''),
+            'Sector': result.get('sector', ''),
+            'Cell': result.get('cell', ''),
+            'Village': result.get('village', ''),
+            'Sex': result.get('gender', ''),
+            'Birth_Date': result['birthdate'].isoformat() if result['birthdate'] else None,
+            'date_created': result['date_created'].isoformat() if result['date_created'] else None,
+            'Age_in_Years': result.get('age', '')
+        }
 
     def connect(self):
-        """Establish a connection to the OpenMRS database."""
+        """Create the connection pool to the OpenMRS database, unless a shared pool was given."""
+        if self.pool is not None:
+            return
         try:
-            self.connection = mysql.connector.connect(
+            self.pool = MySQLConnectionPool(
+                pool_name=f"openmrs-{next(_pool_ids)}",
+                pool_size=self.pool_size,
                 host=self.host,
                 user=self.user,
                 password=self.password,
                 database=self.database
             )
-            logging.info(f"Connected to the OpenMRS database at {self.host} successfully.")
+            logging.info(f"Connected to the OpenMRS database at {self.host} successfully with a pool of {self.pool_size} connections.")
         except Exception as err:
             logging.exception("Failed to connect to the OpenMRS database.")
             raise
 
-    def close(self):
-        """Close the database connection."""
-        if self.connection:
-            self.connection.close()
-            logging.info("OpenMRS database connection closed.")
+    def reserve_connections(self, connections):
+        """Grow the pool, before it is created, to `connections` connections used at the same time, e.g. one per extraction worker."""
+        if connections <= self.pool_size:
+            return
+        if self.pool is not None:
+            logging.warning(f"{connections} workers share an OpenMRS pool of {self.pool_size} connections; they will wait for each other.")
+            return
+        if connections > CNX_POOL_MAXSIZE:
+            logging.warning(f"{connections} workers share an OpenMRS pool of at most {CNX_POOL_MAXSIZE} connections; they will wait for each other.")
+        self.pool_size = min(connections, CNX_POOL_MAXSIZE)
 
-    def fetch_observations_for_encounter(self, encounter_id):
-        """Fetch all observations for a given encounter ID."""
-        logging.info(f"Fetching observations for encounter ID: {encounter_id}")
+    def _open_connection(self):
+        """Open a new connection to the OpenMRS database, outside of the pool."""
+        return mysql.connector.connect(
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database
+        )
+
+    def _checkout(self):
+        """Take a connection from the pool, waiting for one to be released if all are in use.
+
+        The connection is pinged and transparently reconnected if the server closed it while it
+        sat idle in the pool.
+        """
+        if self.pool is None:
+            self.connect()
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            try:
+                connection = self.pool.get_connection()
+                break
+            except mysql.connector.PoolError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        with self.connections_lock:
+            self.checked_out.add(connection)
         try:
-            # The actual query should be defined here
-            query = """
-            SELECT obs.obs_id, concept.uuid AS concept_uuid, obs.value_numeric, obs.value_coded, obs.value_text, obs.value_datetime
-            FROM obs
-            JOIN concept ON obs.concept_id = concept.concept_id
-            WHERE obs.encounter_id = %s
-            """
-            cursor = self.connection.cursor(dictionary=True)
-            cursor.execute(query, (encounter_id,))
-            results = cursor.fetchall()
-            logging.info(f"Fetched {len(results)} observations for encounter ID: {encounter_id}")
-            def get_observation_value(obs):
-                if obs['value_numeric'] is not None:
-                    # Cast to int if the numeric value is an integer, otherwise return as is
-                    return int(obs['value_numeric']) if obs['value_numeric'].is_integer() else obs['value_numeric']
-                elif obs['value_coded'] is not None:
-                    return obs['value_coded']
-                elif obs['value_text'] is not None:
-                    return obs['value_text']
-                elif obs['value_datetime'] is not None:
-                    return obs['value_datetime'].isoformat()
-                return None
-
-            observations = [
-                {
-                    'obs_id': result['obs_id'],
-                    'concept_uuid': result['concept_uuid'],
-                    'value': get_observation_value(result)
-                }
-                for result in results
-            ]
-            return observations
-        except mysql.connector.Error as err:
-            logging.exception(f"Error fetching observations for encounter ID {encounter_id}: {err}")
+            connection.ping(reconnect=True, attempts=3, delay=1)
+        except mysql.connector.Error:
+            self._checkin(connection)
             raise
-        finally:
-            if cursor:
-                cursor.close()
-
-    def get_form_id_by_encounter_id(self, encounter_id):
-        """Fetch the form ID for a given encounter ID."""
-        query = """
-        SELECT form_id
-        FROM encounter
-        WHERE encounter_id = %s
+        return connection
+
+    def _checkin(self, connection):
+        """Return a connection to the pool, replacing it with a new one if it is broken.
+
+        A connection whose pool was closed while it was checked out is disconnected instead.
         """
+        with self.connections_lock:
+            self.checked_out.discard(connection)
+            orphaned = connection in self.orphaned
+            self.orphaned.discard(connection)
+        if orphaned:
+            self._disconnect(connection)
+            return
         try:
-            cursor = self.connection.cursor()
-            cursor.execute(query, (encounter_id,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+            connection.close()
         except mysql.connector.Error as err:
-            logging.error(f"Error fetching form ID: {err}")
-            raise
+            logging.warning("Discarding a broken OpenMRS connection: %s", err)
+            try:
+                self.pool.add_connection()
+            except mysql.connector.PoolError:
+                # The pool is full: close() queued the broken connection before failing, and it is reconnected on its next checkout
+                pass
+            except mysql.connector.Error as add_err:
+                logging.warning("Could not replace the broken OpenMRS connection: %s", add_err)
+
+    @staticmethod
+    def _disconnect(connection):
+        """Close the server connection of a pooled connection, without returning it to the pool."""
+        try:
+            connection.disconnect()
+        except mysql.connector.Error:
+            pass
+
+    @contextmanager
+    def _connection(self):
+        """Yield a pooled connection, released on exit."""
+        connection = self._checkout()
+        try:
+            yield connection
         finally:
-            if cursor:
-                cursor.close()
-
-    def get_encounter_date_created_by_id(self, encounter_id):
-        """Fetch the date_created for a given encounter ID."""
-        query = """
-        SELECT date_created
-        FROM encounter
-        WHERE encounter_id = %s
-        """
+            self._checkin(connection)
+
+    @contextmanager
+    def _cursor(self, connection=None, **cursor_args):
+        """Yield a cursor on `connection`, or on a pooled connection released on exit; the cursor is closed on exit."""
+        if connection is None:
+            with self._connection() as connection:
+                with self._cursor(connection, **cursor_args) as cursor:
+                    yield cursor
+            return
+        cursor = None
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            cursor.execute(query, (encounter_id,))
-            result = cursor.fetchone()
-            return result['date_created'].isoformat() if result and result['date_created'] else None
-        except mysql.connector.Error as err:
-            logging.error(f"Error fetching date_created for encounter ID {encounter_id}: {err}")
-            raise
+            cursor = connection.cursor(**cursor_args)
+            yield cursor
         finally:
-            if cursor:
-                cursor.close()
+            try:
+                if cursor is not None:
+                    cursor.close()
+            except mysql.connector.Error:
+                # The connection is broken; keep the original error and let _checkin replace it
+                pass
+
+    def close(self):
+        """Close the connections of the pool, if this connector created it.
+
+        Idle connections are closed now; those still checked out are closed when they are released.
+        """
+        if self.pool is not None and self.owns_pool:
+            pool, self.pool = self.pool, None
+            with self.connections_lock:
+                self.orphaned.update(self.checked_out)
+            for _ in range(pool.pool_size):
+                try:
+                    connection = pool.get_connection()
+                except mysql.connector.PoolError:
+                    # No idle connection left
+                    break
+                except mysql.connector.Error:
+                    # An idle connection that could not be reconnected; the pool keeps it and is dropped
+                    continue
+                self._disconnect(connection)
+            logging.info("OpenMRS database connection pool closed.")
+
+    @_timed_query
+    @_retry_on_lost_connection
+    def load_metadata(self, refresh=False):
+        """Load the form metadata and the concepts of the metadata's concept UUIDs, unless already loaded.
+
+        With `refresh`, the metadata is reloaded, e.g. after concepts or forms were added to OpenMRS.
+        """
+        metadata = self.metadata
+        with metadata.lock:
+            if metadata.loaded and not refresh:
+                return metadata
+            concept_uuids = sorted(metadata.concept_uuids or ())
+            concepts = {}
+            try:
+                with self._cursor() as cursor:
+                    cursor.execute("SELECT form_id, uuid, encounter_type FROM form")
+                    forms = {form_id: (uuid, encounter_type_id) for form_id, uuid, encounter_type_id in cursor.fetchall()}
+                    for start in range(0, len(concept_uuids), self.chunk_size):
+                        chunk = concept_uuids[start:start + self.chunk_size]
+                        cursor.execute(f"""
+                        SELECT c.concept_id, c.uuid, d.hl7_abbreviation
+                        FROM concept c
+                        JOIN concept_datatype d ON c.datatype_id = d.concept_datatype_id
+                        WHERE c.uuid IN ({', '.join(['%s'] * len(chunk))})
+                        """, chunk)
+                        for concept_id, uuid, datatype in cursor.fetchall():
+                            concepts[concept_id] = (uuid, VALUE_READERS.get(datatype, _observation_value))
+            except mysql.connector.Error as err:
+                logging.error(f"Error loading the OpenMRS metadata: {err}")
+                raise
+            missing = set(concept_uuids) - {uuid for uuid, _ in concepts.values()}
+            if missing:
+                logging.warning(f"{len(missing)} mapped concepts are not in the OpenMRS database: {', '.join(sorted(missing))}")
+            metadata.forms = forms
+            metadata.concepts = dict(sorted(concepts.items()))
+            metadata.loaded = True
+        logging.info(f"Loaded the metadata of {len(forms)} forms and {len(concepts)} mapped concepts.")
+        return metadata
+
+    def _metadata(self):
+        return self.metadata if self.metadata.loaded else self.load_metadata()
+
+    def _observations_query(self, condition):
+        """Return the observation query for a WHERE condition, the concept_id parameters it adds and the concept map to decode its rows with.
+
+        The concept map is taken once, so a reload of the metadata while the query runs cannot leave
+        rows of concepts it does not know. It is None when observations are not filtered by concept,
+        and the query is None when no concept of the metadata exists, as no observation would be kept.
+        """
+        metadata = self._metadata()
+        if metadata.concept_uuids is None:
+            return f"""
+            SELECT obs.encounter_id, obs.obs_id, concept.uuid AS concept_uuid, obs.value_numeric, obs.value_coded, obs.value_text, obs.value_datetime
+            FROM obs
+            JOIN concept ON obs.concept_id = concept.concept_id
+            WHERE {condition}
+            """, [], None
+        concepts = metadata.concepts
+        if not concepts:
+            return None, [], concepts
+        return f"""
+            SELECT obs.encounter_id, obs.obs_id, obs.concept_id, obs.value_numeric, obs.value_coded, obs.value_text, obs.value_datetime
+            FROM obs
+            WHERE {condition} AND obs.concept_id IN ({', '.join(['%s'] * len(concepts))})
+            """, list(concepts), concepts
+
+    def _read_observations(self, rows, concepts):
+        """Decode the rows of `_observations_query` into (encounter_id, OpenMRSObservation) pairs, with the concept map it returned.
+
+        With the concept metadata, each value is read from the column of its concept's datatype.
+        """
+        if concepts is None:
+            for row in rows:
+                yield row[0], OpenMRSObservation(row[1], _text(row[2]), _observation_value(row))
+            return
+        for row in rows:
+            concept_uuid, read_value = concepts[row[2]]
+            yield row[0], OpenMRSObservation(row[1], concept_uuid, read_value(row))
+
+    @_timed_query
+    @_retry_on_lost_connection
+    def fetch_observations_for_encounter(self, encounter_id):
+        """Fetch all observations for a given encounter ID."""
+        logging.debug("Fetching observations for encounter ID: %s", encounter_id)
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            logging.info(f"Executing query for encounter ID: {encounter_id}")
-            cursor.execute(query, (encounter_id,))
-            result = cursor.fetchone()
-            cursor.fetchall()  # Fetch the remaining results to avoid the "Unread result found" error
-            logging.info(f"Query executed for encounter ID: {encounter_id}")
-            # Convert date objects to strings in ISO format
-            if result and 'Birth_Date' in result and result['Birth_Date']:
-                result['Birth_Date'] = result['Birth_Date'].isoformat()
-            return result
+            query, concept_ids, concepts = self._observations_query("obs.encounter_id = %s")
+            if query is None:
+                return []
+            with self._cursor(prepared=True) as cursor:
+                cursor.execute(query, [encounter_id] + concept_ids)
+                observations = [observation for _, observation in self._read_observations(cursor.fetchall(), concepts)]
+            logging.debug("Fetched %d observations for encounter ID: %s", len(observations), encounter_id)
+            return observations
         except mysql.connector.Error as err:
-            logging.error(f"Error fetching patient data: {err}")
+            logging.exception("Error fetching observations for encounter ID %s: %s", encounter_id, err)
             raise
-        finally:
-            cursor.close()
 
-    def get_encounter_type_id_by_form_id(self, form_id):
-        """Fetch the encounter type ID for a given form ID."""
-        query = """
-        SELECT encounter_type_id
-        FROM encounter_type
-        WHERE uuid = %s
+    @_timed_query
+    @_retry_on_lost_connection
+    def fetch_encounters_data(self, encounter_ids, chunk_size=None):
+        """Fetch form ID, date_created and observations for many encounters, grouped by encounter ID.
+
+        Encounters are queried in chunks of `chunk_size` IDs, two queries per chunk, instead of
+        three round trips per encounter. The queries are prepared once per call and re-executed
+        for every full-size chunk. Only the observations of the concepts of the metadata are read.
         """
+        chunk_size = chunk_size or self.chunk_size
+        encounter_ids = [int(eid) for eid in encounter_ids]
+        encounters = {}
         try:
-            cursor = self.connection.cursor()
-            cursor.execute(query, (form_id,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+            # Loaded before the connection is checked out of the pool
+            self._metadata()
+            # Both statements run on one connection, so a worker never holds a connection while waiting for a second
+            with self._connection() as connection, \
+                    self._cursor(connection, prepared=True) as encounter_cursor, self._cursor(connection, prepared=True) as obs_cursor:
+                for start in range(0, len(encounter_ids), chunk_size):
+                    chunk = encounter_ids[start:start + chunk_size]
+                    placeholder = ', '.join(['%s'] * len(chunk))
+                    encounter_cursor.execute(f"""
+                    SELECT encounter_id, form_id, date_created
+                    FROM encounter
+                    WHERE encounter_id IN ({placeholder})
+                    """, chunk)
+                    for encounter_id, form_id, date_created in encounter_cursor.fetchall():
+                        encounters[encounter_id] = {
+                            'form_id': form_id,
+                            'date_created': date_created.isoformat() if date_created else None,
+                            'observations': []
+                        }
+                    obs_query, concept_ids, concepts = self._observations_query(f"obs.encounter_id IN ({placeholder})")
+                    if obs_query is None:
+                        continue
+                    obs_cursor.execute(f"{obs_query} ORDER BY obs.encounter_id, obs.obs_id", chunk + concept_ids)
+                    # Rows come ordered by encounter, so the observation list is only looked up when the encounter changes
+                    current_id = observations = None
+                    for encounter_id, observation in self._read_observations(obs_cursor.fetchall(), concepts):
+                        if encounter_id != current_id:
+                            current_id = encounter_id
+                            encounter = encounters.get(encounter_id)
+                            observations = encounter['observations'] if encounter is not None else []
+                        observations.append(observation)
+            METRICS.increment('openmrs_rows_total', len(encounters), query='fetch_encounters_data')
+            logging.info("Fetched data for %d of %d encounters.", len(encounters), len(encounter_ids))
+            return encounters
         except mysql.connector.Error as err:
-            logging.error(f"Error fetching encounter type ID: {err}")
+            logging.error("Error fetching data for encounters: %s", err)
             raise
-        finally:
-            if cursor:
-                cursor.close()
+
+    @_timed_query
+    @_retry_on_lost_connection
+    def get_encounter_type_id_by_form_id(self, form_id):
+        """Return the encounter type ID of a given form ID, from the form metadata."""
+        form = self._metadata().forms.get(int(form_id))
+        return form[1] if form else None
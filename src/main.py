@@ -1,22 +1,185 @@
+import argparse
+import atexit
 import logging
 import json
 import sys
-import os
-import shutil
 from dotenv import load_dotenv
 from services.sync_service import SyncService
+from services.pipeline import SyncPipeline
+from services.shard_runner import ShardedRunner
+from services.scheduler import LocationScheduler
+from services.dead_letter_replay import DeadLetterReplayer
 from utils.logger import setup_logger
-from utils.progress_tracker import ProgressTracker
+from utils.metrics import METRICS
+from utils.profiling import RunProfiler
+from utils.progress_tracker import FAILED
+from utils.batching import batched
+from utils.watermark_store import WatermarkStore
+from utils.staging_store import StagingStore
 
 # Load environment variables
 load_dotenv()
-from config.settings import OPENMRS_DB_HOST, OPENMRS_DB_USER, OPENMRS_DB_PASSWORD, OPENMRS_DB_NAME, DHIS2_BASE_URL, DHIS2_USERNAME, DHIS2_PASSWORD
+from config.settings import OPENMRS_DB_HOST, OPENMRS_DB_USER, OPENMRS_DB_PASSWORD, OPENMRS_DB_NAME, DHIS2_BASE_URL, DHIS2_USERNAME, DHIS2_PASSWORD, OPENMRS_ENCOUNTER_CHUNK_SIZE, OPENMRS_STREAM_ENCOUNTERS, OPENMRS_POOL_SIZE, OPENMRS_STREAM_WRITE_TIMEOUT, DHIS2_UPLOAD_WORKERS, DHIS2_REQUEST_TIMEOUT, DHIS2_IMPORT_MODE, DHIS2_BULK_BATCH_SIZE
+from config.settings import DHIS2_MAX_RETRIES, DHIS2_BACKOFF_BASE, DHIS2_BACKOFF_MAX, DHIS2_RATE_LIMIT, DHIS2_MAX_RATE_LIMIT, DHIS2_TARGET_LATENCY, DHIS2_CIRCUIT_FAILURES, DHIS2_CIRCUIT_RESET
+from config.settings import DHIS2_VALIDATE, DHIS2_METADATA_FILE, DHIS2_METADATA_MAX_AGE, DHIS2_REJECT_REPORT
+from config.settings import DEAD_LETTER_FILE, DEAD_LETTER_MAX_ATTEMPTS, REPLAY_WORKERS, REPLAY_BATCH_SIZE
+from config.settings import METRICS_FILE, METRICS_PORT, STAGING_COMPRESS, LOG_LEVEL, LOG_FORMAT, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_PAYLOAD_SAMPLE_RATE
+from config.settings import SYNC_PIPELINE, PIPELINE_EXTRACT_WORKERS, PIPELINE_TRANSFORM_WORKERS, PIPELINE_QUEUE_SIZE, PIPELINE_BATCH_SIZE, SYNC_PROCESSES, SYNC_SHARD_SIZE, SYNC_LOCATION_CONCURRENCY
+
+def get_openmrs_config():
+    """Configuration for the OpenMRS connector."""
+    return {
+        "host": OPENMRS_DB_HOST,
+        "user": OPENMRS_DB_USER,
+        "password": OPENMRS_DB_PASSWORD,
+        "database": OPENMRS_DB_NAME,
+        "chunk_size": OPENMRS_ENCOUNTER_CHUNK_SIZE,
+        "pool_size": OPENMRS_POOL_SIZE,
+        "stream_write_timeout": OPENMRS_STREAM_WRITE_TIMEOUT
+    }
+
+def get_dhis2_config(pool_size=None):
+    """Configuration for the DHIS2 connector, with `pool_size` keep-alive connections for the threads sharing its session (default: one per upload worker)."""
+    return {
+        "base_url": DHIS2_BASE_URL,
+        "username": DHIS2_USERNAME,
+        "password": DHIS2_PASSWORD,
+        "max_workers": DHIS2_UPLOAD_WORKERS,
+        "pool_size": pool_size,
+        "timeout": DHIS2_REQUEST_TIMEOUT,
+        "import_mode": DHIS2_IMPORT_MODE,
+        "batch_size": DHIS2_BULK_BATCH_SIZE,
+        "max_retries": DHIS2_MAX_RETRIES,
+        "backoff_base": DHIS2_BACKOFF_BASE,
+        "backoff_max": DHIS2_BACKOFF_MAX,
+        "rate_limit": DHIS2_RATE_LIMIT,
+        "max_rate_limit": DHIS2_MAX_RATE_LIMIT,
+        "target_latency": DHIS2_TARGET_LATENCY,
+        "circuit_failures": DHIS2_CIRCUIT_FAILURES,
+        "circuit_reset": DHIS2_CIRCUIT_RESET
+    }
+
+def create_sync_service(openmrs_config, dhis2_config):
+    """Create the SyncService of a run, validating its payloads before upload unless disabled."""
+    sync_service = SyncService(openmrs_config, dhis2_config, 'logs/progress.db', compress_staging=STAGING_COMPRESS, dead_letter_file=DEAD_LETTER_FILE)
+    if DHIS2_VALIDATE:
+        sync_service.enable_validation(DHIS2_METADATA_FILE, DHIS2_METADATA_MAX_AGE, DHIS2_REJECT_REPORT)
+    return sync_service
+
+def parse_args(argv=None):
+    """Parse the command line. Without --locations or --all-locations the tool runs interactively."""
+    parser = argparse.ArgumentParser(description="OpenMRS to DHIS2 Synchronization Tool.")
+    parser.add_argument('--locations', help="Comma separated location IDs to sync non-interactively.")
+    parser.add_argument('--all-locations', action='store_true', help="Sync every location in mappings/location_mappings.json non-interactively.")
+    parser.add_argument('--form-ids', default='', help="Comma separated form IDs to sync (default: 197).")
+    parser.add_argument('--mode', choices=['resume', 'scratch', 'delta'], default='resume', help="How to treat locations synced before (default: resume).")
+    parser.add_argument('--no-upload', action='store_true', help="Only stage the payloads in logs/staging.db instead of uploading them.")
+    parser.add_argument('--export-staging', metavar='DIRECTORY', help="Write the staged payloads waiting for upload to DIRECTORY, one {patient_id}.json file per patient, and exit.")
+    parser.add_argument('--replay-dead-letters', action='store_true', help="Replay the patients that failed in earlier runs, kept in logs/dead_letters.db, and exit.")
+    parser.add_argument('--replay-stages', default='', help="Comma separated stages to replay: extract, transform, validation, upload (default: all).")
+    parser.add_argument('--replay-errors', default='', help="Comma separated error classes to replay, e.g. ConnectionError,HTTPError (default: all).")
+    parser.add_argument('--replay-workers', type=int, default=REPLAY_WORKERS, help="Dead-letter batches replayed at the same time.")
+    parser.add_argument('--replay-batch-size', type=int, default=REPLAY_BATCH_SIZE, help="Dead letters per replay batch.")
+    parser.add_argument('--location-concurrency', type=int, default=SYNC_LOCATION_CONCURRENCY, help="Locations synced at the same time.")
+    parser.add_argument('--profile', action='store_true', help="Profile the run: write a flame graph of all threads and the slowest patients to --profile-dir.")
+    parser.add_argument('--profile-memory', action='store_true', help="Profile the run and also trace its memory allocations, which slows it down and skews the timings.")
+    parser.add_argument('--profile-dir', default='logs/profile', help="Where --profile writes its reports (default: logs/profile).")
+    parser.add_argument('--summary-file', default='logs/batch_summary.json', help="Where to write the JSON summary of a batch run.")
+    return parser.parse_args(argv)
+
+def report_metrics():
+    """Write the metrics file and print and log the per-stage timing table."""
+    if not METRICS.histograms:
+        return
+    if METRICS_FILE:
+        METRICS.write_prometheus(METRICS_FILE)
+    table = METRICS.summary_table()
+    print(table)
+    logging.info(f"Timings of this run:\n{table}")
+
+def start_profiler(output_dir, trace_memory=False):
+    """Profile the rest of the run, writing the reports when the application exits."""
+    profiler = RunProfiler(output_dir, trace_memory=trace_memory)
+
+    def write_profile():
+        paths = profiler.stop()
+        print(f"Profile written to {', '.join(paths)}.")
+        logging.info(f"Profile written to {', '.join(paths)}.")
+
+    profiler.start()
+    # Registered last, so the profile is written before the metrics are reported
+    atexit.register(write_profile)
+    logging.info(f"Profiling the run into {output_dir}.")
+
+def run_batch(args):
+    """Sync several locations without prompting and print the per-location summary."""
+    # Every location's upload and transform workers call DHIS2 through the one shared session
+    dhis2_config = get_dhis2_config(pool_size=args.location_concurrency * (DHIS2_UPLOAD_WORKERS + PIPELINE_TRANSFORM_WORKERS))
+    sync_service = create_sync_service(get_openmrs_config(), dhis2_config)
+    if args.all_locations:
+        location_ids = list(sync_service.mappings.location_mappings)
+    else:
+        location_ids = [location_id.strip() for location_id in args.locations.split(',') if location_id.strip()]
+    form_ids = [form_id.strip() for form_id in args.form_ids.split(',') if form_id.strip()]
+    scheduler = LocationScheduler(
+        sync_service, get_openmrs_config(), WatermarkStore('logs/watermarks.json'),
+        location_concurrency=args.location_concurrency,
+        extract_workers=PIPELINE_EXTRACT_WORKERS,
+        transform_workers=PIPELINE_TRANSFORM_WORKERS,
+        load_workers=DHIS2_UPLOAD_WORKERS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        batch_size=PIPELINE_BATCH_SIZE
+    )
+    summary = scheduler.run(location_ids, form_ids, mode=args.mode, upload=not args.no_upload, summary_file=args.summary_file)
+    for location in summary['locations']:
+        print(f"Location {location['location_id']}: {location['status']}, {location['patients']} patients, "
+              f"{location['uploaded']} uploaded, {location['failed']} failed, {location['patients_per_second']} patients/s")
+    print(f"Synced {summary['patients']} patients of {len(location_ids)} locations in {summary['seconds']} seconds; summary written to {args.summary_file}.")
+    return 1 if any(location['status'] != 'ok' or location['failed'] for location in summary['locations']) else 0
+
+def print_dead_letters(sync_service):
+    """Print the dead letters waiting for a replay, by stage and error class."""
+    rows = sync_service.dead_letters.summary()
+    if not rows:
+        print("No dead letters.")
+    for stage, error_class, count, attempts in rows:
+        print(f"{stage}: {count} patients failed with {error_class}, up to {attempts} attempts")
+
+def replay_dead_letters(args):
+    """Replay the dead letters of the given stages and error classes, prioritized by error type, and print what is left."""
+    sync_service = create_sync_service(get_openmrs_config(), get_dhis2_config(pool_size=max(args.replay_workers, DHIS2_UPLOAD_WORKERS)))
+    stages = [stage.strip() for stage in args.replay_stages.split(',') if stage.strip()]
+    error_classes = [error_class.strip() for error_class in args.replay_errors.split(',') if error_class.strip()]
+    print_dead_letters(sync_service)
+    replayer = DeadLetterReplayer(sync_service, get_openmrs_config(), workers=args.replay_workers, batch_size=args.replay_batch_size)
+    stats = replayer.run(stages, error_classes, max_attempts=DEAD_LETTER_MAX_ATTEMPTS)
+    print(f"Replayed {stats['patients']} dead letters in {stats['seconds']} seconds: {stats['uploaded']} uploaded, {stats['failed']} failed again.")
+    print_dead_letters(sync_service)
+    return 1 if stats['failed'] else 0
 
 def main():
     # Set up logging
-    setup_logger('logs/sync.log')
+    setup_logger('logs/sync.log', level=LOG_LEVEL, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT,
+                 log_format=LOG_FORMAT, payload_sample_rate=LOG_PAYLOAD_SAMPLE_RATE)
     logging.info("Application started.")
 
+    args = parse_args()
+    if args.export_staging:
+        exported = StagingStore('logs/staging.db').export_directory(args.export_staging)
+        print(f"Exported {exported} staged patients to {args.export_staging}.")
+        sys.exit(0)
+    if METRICS_PORT:
+        METRICS.serve_prometheus(METRICS_PORT)
+        logging.info(f"Serving metrics on port {METRICS_PORT}.")
+    # Registered after the logger, so it runs before the queued log records are flushed
+    atexit.register(report_metrics)
+    if args.profile or args.profile_memory:
+        start_profiler(args.profile_dir, trace_memory=args.profile_memory)
+    if args.replay_dead_letters:
+        sys.exit(replay_dead_letters(args))
+    if args.locations or args.all_locations:
+        sys.exit(run_batch(args))
+
     # Welcome message
     print("Welcome to the OpenMRS to DHIS2 Synchronization Tool.")
     print("Please enter the location ID you want to sync data for:")
@@ -28,80 +191,61 @@ def main():
         sys.exit(1)
 
     # Configuration for OpenMRS and DHIS2 connectors
-    openmrs_config = {
-        "host": OPENMRS_DB_HOST,
-        "user": OPENMRS_DB_USER,
-        "password": OPENMRS_DB_PASSWORD,
-        "database": OPENMRS_DB_NAME
-    }
-    dhis2_config = {
-        "base_url": DHIS2_BASE_URL,
-        "username": DHIS2_USERNAME,
-        "password": DHIS2_PASSWORD
-    }
+    openmrs_config = get_openmrs_config()
+    dhis2_config = get_dhis2_config(pool_size=DHIS2_UPLOAD_WORKERS + PIPELINE_TRANSFORM_WORKERS)
 
     # Initialize the SyncService
-    sync_service = SyncService(openmrs_config, dhis2_config, 'logs/progress.json')
-
-    # Check if the patients_to_sync directory has files and ask the user if they want to process them
-    patients_to_sync_dir = 'patients_to_sync'
-    existing_files = [f for f in os.listdir(patients_to_sync_dir) if os.path.isfile(os.path.join(patients_to_sync_dir, f))]
-    if existing_files:
-        print(f"Found {len(existing_files)} files in the patients_to_sync directory.")
-        process_files = input("Do you want to process the existing files? (yes/no): ").strip().lower()
+    sync_service = create_sync_service(openmrs_config, dhis2_config)
+
+    # Payloads staged one file per patient by earlier versions are moved into the staging store
+    imported = sync_service.staging_store.import_directory('patients_to_sync')
+    if imported:
+        logging.info(f"Imported {imported} patient files from the patients_to_sync directory into the staging store.")
+
+    # Check if patients are staged for upload and ask the user if they want to process them
+    staged_patients = sync_service.staging_store.count()
+    if staged_patients:
+        print(f"Found {staged_patients} patients staged for upload.")
+        process_files = input("Do you want to process the staged patients? (yes/no): ").strip().lower()
         if process_files == 'yes':
-            sync_service.dhis2_connector.process_patient_files()
+            sync_service.dhis2_connector.process_staged_patients(sync_service.staging_store)
             sys.exit(0)
         elif process_files == 'no':
-            print("Clearing the patients_to_sync directory and proceeding with the normal flow.")
+            print("Clearing the staged patients and proceeding with the normal flow.")
+            cleared = sync_service.staging_store.clear()
+            # Their payloads are gone, so a resume must transform them again instead of skipping them
+            sync_service.progress_tracker.mark_patient_states(cleared, FAILED, error='staged payload cleared')
         else:
             print("Invalid input. Exiting.")
             sys.exit(1)
 
-    # Clear the patients_to_sync directory if the user chose not to process existing files
-    for filename in existing_files:
-        file_path = os.path.join(patients_to_sync_dir, filename)
-        try:
-            os.unlink(file_path)
-        except Exception as e:
-            print(f'Failed to delete {file_path}. Reason: {e}')
-            sys.exit(1)
+    # The progress tracker of the sync service
+    progress_tracker = sync_service.progress_tracker
 
-    # Initialize progress tracker
-    progress_tracker = ProgressTracker('logs/progress.json')
+    # Initialize the delta sync watermarks
+    watermark_store = WatermarkStore('logs/watermarks.json')
+    watermark = watermark_store.get_watermark(location_id)
 
     # Check if the location has been handled before or if it's new
-    handled_encounters = progress_tracker.get_progress(location_id)
+    handled_encounters = progress_tracker.get_progress(location_id, sync_service.staging_store.staged)
     if handled_encounters is not None:
         print(f"Location {location_id} has been handled before.")
-        choice = input("Do you want to resume or start from scratch? (resume/scratch): ").strip().lower()
-        if choice not in ['resume', 'scratch']:
+        choices = ['resume', 'scratch', 'delta'] if watermark else ['resume', 'scratch']
+        if watermark:
+            print(f"Last successful sync of location {location_id} was at {watermark.isoformat()}; 'delta' only syncs what changed since then.")
+        choice = input(f"Do you want to resume or start from scratch? ({'/'.join(choices)}): ").strip().lower()
+        if choice not in choices:
             print("Invalid choice. Exiting.")
             sys.exit(1)
         elif choice == 'scratch':
             handled_encounters = []
             progress_tracker.reset_progress(location_id)
+            watermark_store.reset_watermark(location_id)
     else:
         print(f"Location {location_id} is new. Starting the process of selecting all encounters for this location.")
         handled_encounters = []
         choice = 'scratch'
 
-    # Configuration for OpenMRS and DHIS2 connectors
-    openmrs_config = {
-        "host": OPENMRS_DB_HOST,
-        "user": OPENMRS_DB_USER,
-        "password": OPENMRS_DB_PASSWORD,
-        "database": OPENMRS_DB_NAME
-    }
-    dhis2_config = {
-        "base_url": DHIS2_BASE_URL,
-        "username": DHIS2_USERNAME,
-        "password": DHIS2_PASSWORD
-    }
-
-    # Initialize the SyncService
-    sync_service = SyncService(openmrs_config, dhis2_config, 'logs/progress.json')
-
     # Prompt user for encounter type IDs
     print("Please enter the encounter type IDs you are interested in (comma separated):")
     encounter_type_ids_input = input("Encounter Type IDs: ").strip()
@@ -109,45 +253,102 @@ def main():
 
     # Connect to OpenMRS and fetch encounters by location ID and encounter type IDs
     logging.info("Attempting to connect to the OpenMRS database...")
+    if SYNC_PIPELINE:
+        sync_service.openmrs_connector.reserve_connections(PIPELINE_EXTRACT_WORKERS)
     sync_service.openmrs_connector.connect()
     logging.info("Connection to OpenMRS database successful. Fetching encounters by location ID and encounter type IDs...")
     try:
-        patient_encounters = sync_service.openmrs_connector.fetch_patient_encounters_by_location(location_id, encounter_type_ids)
-        if patient_encounters is None:
-            logging.error(f"Failed to fetch encounters for location ID {location_id}.")
-            sys.exit(1)
-        logging.info(f"Fetched encounters for {len(patient_encounters)} patients from the OpenMRS database for location ID {location_id}.")
-        
-                # Clear patients_to_sync.json and encounters_to_process.json files
-        open('patients_to_sync.json', 'w').close()
-        open('encounters_to_process.json', 'w').close()
-    
-        # Log the fetched patient encounters to the encounters_to_process.json file and process each patient's encounters
-        with open('encounters_to_process.json', 'w') as file:
-            json.dump(patient_encounters, file, indent=4)
-        logging.info(f"Logged encounters for {len(patient_encounters)} patients to encounters_to_process.json.")
+        # Take the next watermark before extracting, so changes made during the run are picked up next time
+        since = watermark if choice == 'delta' else None
+        next_watermark = sync_service.openmrs_connector.get_database_time()
+        if since:
+            logging.info(f"Delta sync of location ID {location_id}: only encounters changed since {since.isoformat()}.")
+        if OPENMRS_STREAM_ENCOUNTERS:
+            # Stream the encounters patient by patient so processing starts while discovery is still running
+            logging.info(f"Streaming encounters for location ID {location_id} from the OpenMRS database.")
+            encounters_to_process = sync_service.openmrs_connector.stream_patient_encounters_by_location(location_id, encounter_type_ids, since=since)
+        else:
+            patient_encounters = sync_service.openmrs_connector.fetch_patient_encounters_by_location(location_id, encounter_type_ids, since=since)
+            if patient_encounters is None:
+                logging.error(f"Failed to fetch encounters for location ID {location_id}.")
+                sys.exit(1)
+            logging.info(f"Fetched encounters for {len(patient_encounters)} patients from the OpenMRS database for location ID {location_id}.")
 
+            # Clear patients_to_sync.json and encounters_to_process.json files
+            open('patients_to_sync.json', 'w').close()
+            open('encounters_to_process.json', 'w').close()
 
-        # Read the encounters to process from the JSON file
-        with open('encounters_to_process.json', 'r') as file:
-            encounters_to_process = json.load(file)
+            # Log the fetched patient encounters to the encounters_to_process.json file and process each patient's encounters
+            with open('encounters_to_process.json', 'w') as file:
+                json.dump(patient_encounters, file, indent=4)
+            logging.info(f"Logged encounters for {len(patient_encounters)} patients to encounters_to_process.json.")
 
-        # Loop through each patient and process their encounters
-        for patient_id, encounter_ids in encounters_to_process.items():
-            # Process patient and their encounters, passing the location_id
-            sync_service.process_patient_and_encounters(patient_id, encounter_ids, location_id)
+            # Read the encounters to process from the JSON file
+            with open('encounters_to_process.json', 'r') as file:
+                encounters_to_process = json.load(file).items()
 
-            # Log the processed patient ID to the progress.json file
-            progress_tracker.update_progress(location_id, patient_id)
+        # When resuming, skip the patients that were already handled
+        if choice == 'resume' and handled_encounters:
+            handled_patients = set(handled_encounters)
+            logging.info(f"Resuming location ID {location_id}: skipping {len(handled_patients)} patients already handled.")
+            encounters_to_process = ((patient_id, encounter_ids) for patient_id, encounter_ids in encounters_to_process if str(patient_id) not in handled_patients)
+
+        if SYNC_PIPELINE:
+            # Extract, transform and upload concurrently instead of staging every patient first
+            pipeline = SyncPipeline(
+                sync_service, openmrs_config,
+                extract_workers=PIPELINE_EXTRACT_WORKERS,
+                transform_workers=PIPELINE_TRANSFORM_WORKERS,
+                load_workers=DHIS2_UPLOAD_WORKERS,
+                queue_size=PIPELINE_QUEUE_SIZE,
+                batch_size=PIPELINE_BATCH_SIZE
+            )
+            stats = pipeline.run(location_id, encounters_to_process)
+            failed_patients = stats['failed']
+            print(f"Synchronized {stats['uploaded']} of {stats['patients']} patients to DHIS2 in {stats['seconds']} seconds.")
+        elif SYNC_PROCESSES > 1:
+            # Spread extraction and transformation of the patients over a pool of processes
+            runner = ShardedRunner(
+                sync_service, openmrs_config, dhis2_config, 'logs/progress.db',
+                processes=SYNC_PROCESSES,
+                shard_size=SYNC_SHARD_SIZE,
+                batch_size=OPENMRS_ENCOUNTER_CHUNK_SIZE
+            )
+            stats = runner.run({location_id: encounters_to_process})
+            failed_patients = stats['failed']
+        else:
+            # Loop through the patients in batches so that encounter data is fetched in bulk
+            failed_patients = 0
+            for batch in batched(encounters_to_process, OPENMRS_ENCOUNTER_CHUNK_SIZE):
+                # Process the patients and their encounters, passing the location_id
+                results = sync_service.process_patient_batch(batch, location_id)
+                failed_patients += sum(1 for result in results.values() if not result)
+
+        # Once every changed encounter has been uploaded, the next delta run can start from here
+        if failed_patients:
+            logging.warning(f"{failed_patients} patients failed to process; the delta sync watermark of location ID {location_id} is not advanced.")
+        elif SYNC_PIPELINE:
+            watermark_store.set_watermark(location_id, next_watermark)
     except Exception as e:
         logging.error(f"Failed to fetch encounters by location ID: {e}")
         sys.exit(1)
 
+    if SYNC_PIPELINE:
+        if failed_patients:
+            print(f"{failed_patients} patients failed; their upload payloads were staged in logs/staging.db.")
+        sys.exit(0)
+
     # Prompt the user to start the synchronization process
-    print("All patient files have been created in the patients_to_sync directory.")
+    print(f"{sync_service.staging_store.count()} patients are staged for upload in logs/staging.db.")
     user_choice = input("Do you want to start the synchronization process to DHIS2? (yes/no): ").strip().lower()
     if user_choice == 'yes':
-        sync_service.dhis2_connector.process_patient_files()
+        sync_service.dhis2_connector.process_staged_patients(sync_service.staging_store)
+        # Staged payloads may still be cleared or fail, so the watermark only moves once all of them are uploaded
+        not_uploaded = sync_service.staging_store.count()
+        if failed_patients or not_uploaded:
+            logging.warning(f"{failed_patients + not_uploaded} patients were not uploaded; the delta sync watermark of location ID {location_id} is not advanced.")
+        else:
+            watermark_store.set_watermark(location_id, next_watermark)
     else:
         print("Synchronization process not started. Exiting application.")
         sys.exit(0)
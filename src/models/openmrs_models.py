@@ -6,10 +6,17 @@ class OpenMRSPatient:
     # Additional methods as needed for handling OpenMRS patient data
 
 class OpenMRSObservation:
+    """An observation of an encounter, one per obs row extracted.
+
+    Slotted rather than a dict, as extraction creates one per observation: a third of the memory
+    and no per-key hashing when the form mappings read it.
+    """
+    __slots__ = ('obs_id', 'concept_uuid', 'value')
+
     def __init__(self, obs_id, concept_uuid, value):
         self.obs_id = obs_id
         self.concept_uuid = concept_uuid
         self.value = value
 
-    # Additional methods for OpenMRS observations
-
+    def __repr__(self):
+        return f"OpenMRSObservation({self.obs_id!r}, {self.concept_uuid!r}, {self.value!r})"
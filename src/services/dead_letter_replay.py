@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from connectors.openmrs_connector import OpenMRSConnector
+from utils.dead_letter_store import EXTRACT, TRANSFORM
+
+class DeadLetterReplayer:
+    """Re-drive the dead letters of a sync service, and only them, in batches.
+
+    Batches are read from the dead-letter store by priority, so transient errors such as timeouts
+    are replayed before the records DHIS2 refused, and `workers` batches run at a time. Extraction
+    and transformation failures are extracted again from OpenMRS by their location and encounter
+    IDs, then uploaded; upload and validation failures are staged again and uploaded from their
+    payload, and the events validation dropped from a payload are uploaded on their own. Each
+    replayed patient or event either resolves its dead letter or counts one more attempt.
+    """
+
+    def __init__(self, sync_service, openmrs_config, workers=2, batch_size=100):
+        self.sync_service = sync_service
+        self.openmrs_config = openmrs_config
+        self.workers = workers
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.connectors = []
+        self.stats_lock = threading.Lock()
+
+    def run(self, stages=None, error_classes=None, max_attempts=None):
+        """Replay the dead letters of the given stages and error classes with fewer than `max_attempts` attempts. Returns the run statistics."""
+        dead_letters = self.sync_service.dead_letters
+        self.stats = {'patients': 0, 'uploaded': 0, 'failed': 0}
+        logging.info(f"Replaying {dead_letters.count(stages, error_classes, max_attempts)} dead letters with {self.workers} workers.")
+        started_at = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # At most two batches per worker are read ahead, so memory stays flat however many dead letters there are
+                pending = deque()
+                for entries in dead_letters.iter_batches(self.batch_size, stages, error_classes, max_attempts):
+                    if len(pending) >= 2 * self.workers:
+                        pending.popleft().result()
+                    pending.append(executor.submit(self.replay_batch, entries))
+                for future in pending:
+                    future.result()
+        finally:
+            for openmrs_connector in self.connectors:
+                openmrs_connector.close()
+        self.stats['seconds'] = round(time.monotonic() - started_at, 3)
+        logging.info(f"Dead-letter replay finished: {self.stats}")
+        return self.stats
+
+    def replay_batch(self, entries):
+        """Replay a batch of (patient_id, stage, location_id, payload, record) dead letters."""
+        payloads, events = [], []
+        locations = defaultdict(list)
+        for patient_id, stage, location_id, payload, record in entries:
+            if record:
+                events.append((patient_id, payload))
+            elif stage in (EXTRACT, TRANSFORM):
+                locations[location_id].append((patient_id, payload['encounter_ids']))
+            else:
+                payloads.append((patient_id, payload))
+        # The payloads of upload and validation failures are staged again; _transform stages those it recreates
+        self.sync_service.staging_store.stage_many(payloads)
+        for location_id, patient_encounters in locations.items():
+            payloads.extend(self._transform(location_id, patient_encounters))
+        # The connector records each result as a dead letter or resolves it
+        uploaded = self.sync_service.dhis2_connector.upload_staged(self.sync_service.staging_store, payloads) if payloads else 0
+        if events:
+            uploaded += self.sync_service.dhis2_connector.upload_rejected_events(events)
+        with self.stats_lock:
+            self.stats['patients'] += len(entries)
+            self.stats['uploaded'] += uploaded
+            self.stats['failed'] += len(entries) - uploaded
+
+    def _transform(self, location_id, patient_encounters):
+        """Extract and transform patients of a location again, returning the (patient_id, payload) pairs that succeeded, staged."""
+        try:
+            openmrs_connector = self._openmrs_connector()
+            try:
+                patients_data, encounters_data = self.sync_service.extract_patient_batch(patient_encounters, openmrs_connector)
+            finally:
+                openmrs_connector.clear_patient_cache()
+        except Exception as e:
+            logging.error("Error extracting %d dead-letter patients of location ID %s: %s", len(patient_encounters), location_id, e)
+            self.sync_service.record_failures(location_id, patient_encounters, EXTRACT, e)
+            return []
+        self.sync_service.dead_letters.resolve([patient_id for patient_id, _ in patient_encounters], (EXTRACT,))
+        results = self.sync_service.transform_patient_batch(patient_encounters, location_id, patients_data, encounters_data)
+        return self.sync_service.stage_and_checkpoint_batch(location_id, patient_encounters, results)
+
+    def _openmrs_connector(self):
+        """The OpenMRS connector of the calling worker, sharing the sync service's connection pool and metadata."""
+        openmrs_connector = getattr(self.local, 'openmrs_connector', None)
+        if openmrs_connector is None:
+            openmrs_connector = OpenMRSConnector(
+                **self.openmrs_config,
+                pool=getattr(self.sync_service.openmrs_connector, 'pool', None),
+                metadata=getattr(self.sync_service.openmrs_connector, 'metadata', None)
+            )
+            openmrs_connector.connect()
+            self.local.openmrs_connector = openmrs_connector
+            with self.stats_lock:
+                self.connectors.append(openmrs_connector)
+        return openmrs_connector
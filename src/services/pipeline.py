@@ -0,0 +1,160 @@
+import logging
+import queue
+import threading
+import time
+from connectors.openmrs_connector import OpenMRSConnector
+from utils.batching import batched
+from utils.progress_tracker import EXTRACTED, FAILED
+from utils.dead_letter_store import EXTRACT
+
+# Marks the end of a stage's input
+_DONE = object()
+
+class SyncPipeline:
+    """Run OpenMRS extraction, transformation and DHIS2 loading as concurrent stages.
+
+    Stages are connected by bounded queues, so a fast stage blocks instead of piling up work when
+    the next one falls behind, and the wall time of a run approaches that of its slowest stage.
+    Extraction workers check their connections out of the sync service's OpenMRS connection pool
+    when it is connected, and loading shares the DHIS2 connector's pooled session. Transformed
+    payloads are staged before they are queued for upload; without `upload`, they are only staged.
+    """
+
+    def __init__(self, sync_service, openmrs_config, extract_workers=2, transform_workers=1, load_workers=4, queue_size=4, batch_size=100, upload=True):
+        self.sync_service = sync_service
+        self.upload = upload
+        self.openmrs_config = openmrs_config
+        self.extract_workers = extract_workers
+        self.transform_workers = transform_workers
+        self.load_workers = load_workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stats_lock = threading.Lock()
+
+    def run(self, location_id, patient_encounters):
+        """Sync an iterable of (patient_id, encounter_ids) pairs of a location. Returns the run statistics."""
+        self.location_id = location_id
+        self.stats = {'patients': 0, 'extracted': 0, 'transformed': 0, 'uploaded': 0, 'failed': 0}
+        self.errors = []
+        extract_queue = queue.Queue(self.queue_size)
+        transform_queue = queue.Queue(self.queue_size)
+        load_queue = queue.Queue(self.queue_size)
+        stages = [
+            ([self._thread(self._feed, patient_encounters, extract_queue)], extract_queue),
+            ([self._thread(self._extract, extract_queue, transform_queue) for _ in range(self.extract_workers)], transform_queue),
+            ([self._thread(self._transform, transform_queue, load_queue) for _ in range(self.transform_workers)], load_queue),
+            ([self._thread(self._load, load_queue) for _ in range(self.load_workers)], None),
+        ]
+        started_at = time.monotonic()
+        # Once every worker of a stage is done, tell each worker of the next stage there is no more input
+        for index, (workers, output_queue) in enumerate(stages):
+            for worker in workers:
+                worker.join()
+            if output_queue is not None:
+                for _ in stages[index + 1][0]:
+                    output_queue.put(_DONE)
+        self.stats['seconds'] = round(time.monotonic() - started_at, 3)
+        logging.info(f"Pipeline run of location ID {location_id} finished: {self.stats}")
+        if self.errors:
+            raise self.errors[0]
+        return self.stats
+
+    def _thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def _count(self, key, value):
+        with self.stats_lock:
+            self.stats[key] += value
+
+    def _feed(self, patient_encounters, output_queue):
+        """Split the discovered patients into batches for the extraction workers."""
+        try:
+            for batch in batched(patient_encounters, self.batch_size):
+                self._count('patients', len(batch))
+                output_queue.put(batch)
+        except Exception as e:
+            logging.error(f"Error discovering encounters for location ID {self.location_id}: {e}")
+            self.errors.append(e)
+
+    def _consume(self, input_queue, handle):
+        """Handle the items of a queue until the end of the stage's input.
+
+        Unexpected errors are recorded and the worker keeps consuming, so an upstream stage never
+        blocks on a full queue that nobody reads anymore.
+        """
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                return
+            try:
+                handle(item)
+            except Exception as e:
+                logging.exception(f"Unexpected error in pipeline stage {handle.__name__}: {e}")
+                self.errors.append(e)
+
+    def _extract(self, input_queue, output_queue):
+        """Fetch the OpenMRS data of each batch, sharing the sync service's connection pool if it has one and its metadata."""
+        openmrs_connector = OpenMRSConnector(
+            **self.openmrs_config,
+            pool=getattr(self.sync_service.openmrs_connector, 'pool', None),
+            metadata=getattr(self.sync_service.openmrs_connector, 'metadata', None)
+        )
+        connect_error = None
+        try:
+            openmrs_connector.connect()
+        except Exception as e:
+            self.errors.append(e)
+            openmrs_connector, connect_error = None, e
+
+        def extract_batch(batch):
+            if openmrs_connector is None:
+                self._fail(batch, connect_error)
+                return
+            try:
+                patients_data, encounters_data = self.sync_service.extract_patient_batch(batch, openmrs_connector)
+            except Exception as e:
+                logging.error("Error extracting a batch of %d patients: %s", len(batch), e)
+                self._fail(batch, e)
+                return
+            finally:
+                openmrs_connector.clear_patient_cache()
+            # Informational only: a resume extracts these patients again, as their data is only held in memory
+            self.sync_service.progress_tracker.mark_patients(self.location_id, [patient_id for patient_id, _ in batch], EXTRACTED)
+            self._count('extracted', len(batch))
+            output_queue.put((batch, patients_data, encounters_data))
+
+        try:
+            self._consume(input_queue, extract_batch)
+        finally:
+            if openmrs_connector is not None:
+                openmrs_connector.close()
+
+    def _transform(self, input_queue, output_queue):
+        """Transform each extracted batch into DHIS2 tracked entity instances, staged before they are queued for upload."""
+        def transform_batch(item):
+            batch, patients_data, encounters_data = item
+            results = self.sync_service.transform_patient_batch(batch, self.location_id, patients_data, encounters_data)
+            # Staged before they are checkpointed, so a run stopped with the batch still queued uploads it from the staging store
+            transformed = self.sync_service.stage_and_checkpoint_batch(self.location_id, batch, results)
+            self._count('transformed', len(transformed))
+            self._count('failed', len(results) - len(transformed))
+            if transformed and self.upload:
+                output_queue.put(transformed)
+
+        self._consume(input_queue, transform_batch)
+
+    def _load(self, input_queue):
+        """Upload each transformed batch to DHIS2, recording the results in the staging store, the checkpoint store and the dead letters."""
+        def load_batch(batch):
+            uploaded = self.sync_service.dhis2_connector.upload_staged(self.sync_service.staging_store, batch)
+            self._count('uploaded', uploaded)
+            self._count('failed', len(batch) - uploaded)
+
+        self._consume(input_queue, load_batch)
+
+    def _fail(self, batch, error):
+        self.sync_service.progress_tracker.mark_patients(self.location_id, [patient_id for patient_id, _ in batch], FAILED, error=str(error))
+        self.sync_service.record_failures(self.location_id, batch, EXTRACT, error)
+        self._count('failed', len(batch))
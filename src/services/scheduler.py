@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from connectors.openmrs_connector import OpenMRSConnector
+from services.pipeline import SyncPipeline
+
+class LocationScheduler:
+    """Sync many locations non-interactively, a few at a time.
+
+    All locations share one SyncService, so they share its OpenMRS connection pool, DHIS2 session
+    pool, mappings and checkpoint store. At most `location_concurrency` locations run at once, each
+    with `extract_workers` extraction workers. Locations are started least recently synced first, so
+    every facility gets its turn before any is synced twice.
+    """
+
+    def __init__(self, sync_service, openmrs_config, watermark_store, location_concurrency=2, extract_workers=2,
+                 transform_workers=1, load_workers=4, queue_size=4, batch_size=100):
+        self.sync_service = sync_service
+        self.openmrs_config = openmrs_config
+        self.watermark_store = watermark_store
+        self.location_concurrency = location_concurrency
+        self.pipeline_options = {
+            'extract_workers': extract_workers,
+            'transform_workers': transform_workers,
+            'load_workers': load_workers,
+            'queue_size': queue_size,
+            'batch_size': batch_size
+        }
+
+    def order_locations(self, location_ids):
+        """Order locations fairly: never synced first, then least recently synced."""
+        progress_tracker = self.sync_service.progress_tracker
+        return sorted(location_ids, key=lambda location_id: progress_tracker.get_location_updated_at(location_id) or '')
+
+    def run(self, location_ids, form_ids=None, mode='resume', upload=True, summary_file=None):
+        """Sync the given locations and return a summary of each, also written to `summary_file` as JSON."""
+        location_ids = self.order_locations(location_ids)
+        logging.info(f"Scheduling {len(location_ids)} locations, {self.location_concurrency} at a time: {', '.join(location_ids)}")
+        started_at = time.monotonic()
+        # Every extraction worker of every location holds a pooled connection while it queries
+        self.sync_service.openmrs_connector.reserve_connections(self.location_concurrency * self.pipeline_options['extract_workers'])
+        self.sync_service.openmrs_connector.connect()
+        staging_store = self.sync_service.staging_store
+        if upload and staging_store.count():
+            # Patients staged by a stopped or --no-upload run are skipped on resume, so they are uploaded first
+            logging.info(f"Uploading {staging_store.count()} patients staged by an earlier run.")
+            self.sync_service.dhis2_connector.process_staged_patients(staging_store)
+        try:
+            with ThreadPoolExecutor(max_workers=self.location_concurrency) as executor:
+                summaries = list(executor.map(lambda location_id: self.sync_location(location_id, form_ids, mode, upload), location_ids))
+        finally:
+            self.sync_service.openmrs_connector.close()
+        summary = {
+            'seconds': round(time.monotonic() - started_at, 3),
+            'patients': sum(location['patients'] for location in summaries),
+            'uploaded': sum(location['uploaded'] for location in summaries),
+            'failed': sum(location['failed'] for location in summaries),
+            'locations': summaries
+        }
+        if summary_file:
+            os.makedirs(os.path.dirname(summary_file) or '.', exist_ok=True)
+            with open(summary_file, 'w') as file:
+                json.dump(summary, file, indent=4)
+            logging.info(f"Wrote the batch run summary to {summary_file}.")
+        return summary
+
+    def sync_location(self, location_id, form_ids=None, mode='resume', upload=True):
+        """Sync one location through the pipeline and return its summary."""
+        summary = {'location_id': location_id, 'mode': mode, 'status': 'ok', 'error': None,
+                   'patients': 0, 'extracted': 0, 'transformed': 0, 'uploaded': 0, 'failed': 0, 'seconds': 0.0}
+        progress_tracker = self.sync_service.progress_tracker
+        openmrs_connector = OpenMRSConnector(**self.openmrs_config, pool=self.sync_service.openmrs_connector.pool,
+                                             metadata=self.sync_service.openmrs_connector.metadata)
+        pipeline = None
+        try:
+            # Fail early, before any query is run, when the location is not mapped
+            self.sync_service.get_org_unit_id(location_id)
+            watermark = self.watermark_store.get_watermark(location_id)
+            if mode == 'delta' and watermark is None:
+                logging.info(f"Location ID {location_id} has no watermark yet, running a full sync instead of a delta.")
+                summary['mode'] = mode = 'resume'
+            if mode == 'scratch':
+                progress_tracker.reset_progress(location_id)
+                self.watermark_store.reset_watermark(location_id)
+            openmrs_connector.connect()
+            next_watermark = openmrs_connector.get_database_time()
+            since = watermark if mode == 'delta' else None
+            patient_encounters = openmrs_connector.stream_patient_encounters_by_location(location_id, form_ids, since=since)
+            if mode == 'resume':
+                handled_patients = set(progress_tracker.get_progress(location_id, self.sync_service.staging_store.staged) or [])
+                patient_encounters = ((patient_id, encounter_ids) for patient_id, encounter_ids in patient_encounters if str(patient_id) not in handled_patients)
+            pipeline = SyncPipeline(self.sync_service, self.openmrs_config, upload=upload, **self.pipeline_options)
+            summary.update(pipeline.run(location_id, patient_encounters))
+            # Payloads only staged may still be cleared, so a run without upload leaves the watermark
+            if summary['failed'] == 0 and upload:
+                self.watermark_store.set_watermark(location_id, next_watermark)
+        except Exception as e:
+            logging.error(f"Error syncing location ID {location_id}: {e}")
+            if pipeline is not None:
+                summary.update(pipeline.stats)
+            summary['status'] = 'failed'
+            summary['error'] = f"{type(e).__name__}: {e}"
+        finally:
+            openmrs_connector.close()
+        seconds = summary['seconds'] or 0.0
+        summary['patients_per_second'] = round(summary['patients'] / seconds, 2) if seconds else 0.0
+        summary['uploaded_per_second'] = round(summary['uploaded'] / seconds, 2) if seconds else 0.0
+        logging.info(f"Location ID {location_id} done: {summary}")
+        return summary
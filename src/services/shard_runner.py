@@ -0,0 +1,102 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from services.sync_service import SyncService
+from utils.batching import batched
+from utils.dead_letter_store import EXTRACT
+from utils.logger import setup_worker_logger, worker_log_queue
+from utils.metrics import METRICS
+from utils.profiling import PATIENT_TIMINGS
+
+# The SyncService of a worker process, with its own OpenMRS connection
+_worker_service = None
+
+def _init_worker(openmrs_config, dhis2_config, progress_tracker_file, log_queue=None, log_level=None, dead_letter_file='logs/dead_letters.db', profile=False):
+    """Create the SyncService of a worker process and connect it to OpenMRS."""
+    global _worker_service
+    if log_queue is not None:
+        # Log through the parent process, which owns the log file
+        setup_worker_logger(log_queue, log_level)
+    # Forked workers start with a copy of the parent's metrics and timings; drop them so the
+    # parent doesn't merge its own counts back with the first shard
+    METRICS.drain()
+    PATIENT_TIMINGS.reset()
+    PATIENT_TIMINGS.enabled = profile
+    _worker_service = SyncService(openmrs_config, dhis2_config, progress_tracker_file, dead_letter_file=dead_letter_file)
+    _worker_service.openmrs_connector.connect()
+
+def _process_shard(location_id, shard, batch_size):
+    """Extract and transform a shard of (patient_id, encounter_ids) pairs in a worker process.
+
+    Results are returned to the parent process, which is the only one writing the checkpoint
+    store and the staging output, with the metrics and the per-patient timings the shard recorded.
+    """
+    results = {}
+    for batch in batched(shard, batch_size):
+        try:
+            patients_data, encounters_data = _worker_service.extract_patient_batch(batch)
+        except Exception as e:
+            logging.error("Error extracting a batch of %d patients: %s", len(batch), e)
+            _worker_service.record_failures(location_id, batch, EXTRACT, e)
+            results.update((patient_id, {}) for patient_id, _ in batch)
+            continue
+        finally:
+            _worker_service.openmrs_connector.clear_patient_cache()
+        results.update(_worker_service.transform_patient_batch(batch, location_id, patients_data, encounters_data))
+    return location_id, shard, results, METRICS.drain(), PATIENT_TIMINGS.drain()
+
+class ShardedRunner:
+    """Extract and transform the patients of one or more locations across a pool of processes.
+
+    Patients are partitioned into shards of `shard_size`; at most two shards per process are in
+    flight so memory stays bounded. Shard results are merged into the staging output and the
+    checkpoint store by the parent process as they complete. Each worker runs one query at a
+    time, so it gets a pool of a single OpenMRS connection.
+    """
+
+    def __init__(self, sync_service, openmrs_config, dhis2_config, progress_tracker_file, processes=4, shard_size=500, batch_size=100):
+        self.sync_service = sync_service
+        self.openmrs_config = dict(openmrs_config, pool_size=1)
+        self.dhis2_config = dhis2_config
+        self.progress_tracker_file = progress_tracker_file
+        self.processes = processes
+        self.shard_size = shard_size
+        self.batch_size = batch_size
+
+    def run(self, location_patient_encounters):
+        """Process a dict of location_id -> iterable of (patient_id, encounter_ids) pairs. Returns the run statistics."""
+        stats = {'patients': 0, 'transformed': 0, 'failed': 0}
+        started_at = time.monotonic()
+        shards = (
+            (location_id, shard)
+            for location_id, patient_encounters in location_patient_encounters.items()
+            for shard in batched(patient_encounters, self.shard_size)
+        )
+        with ProcessPoolExecutor(
+            max_workers=self.processes,
+            initializer=_init_worker,
+            initargs=(self.openmrs_config, self.dhis2_config, self.progress_tracker_file, worker_log_queue(), logging.getLogger().level,
+                      self.sync_service.dead_letters.file_path, PATIENT_TIMINGS.enabled)
+        ) as executor:
+            pending = set()
+            for location_id, shard in shards:
+                pending.add(executor.submit(_process_shard, location_id, shard, self.batch_size))
+                if len(pending) >= self.processes * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._merge(future.result(), stats)
+            for future in pending:
+                self._merge(future.result(), stats)
+        stats['seconds'] = round(time.monotonic() - started_at, 3)
+        logging.info(f"Sharded run over {self.processes} processes finished: {stats}")
+        return stats
+
+    def _merge(self, shard_result, stats):
+        """Write the payloads of a finished shard to the staging store, checkpoint it and merge its metrics and timings."""
+        location_id, shard, results, metrics, timings = shard_result
+        METRICS.merge(metrics)
+        PATIENT_TIMINGS.merge(timings)
+        transformed = len(self.sync_service.stage_and_checkpoint_batch(location_id, shard, results))
+        stats['patients'] += len(results)
+        stats['transformed'] += transformed
+        stats['failed'] += len(results) - transformed
@@ -1,133 +1,285 @@
-import json
-import os
 import logging
-from connectors.openmrs_connector import OpenMRSConnector
+import time
+from connectors.openmrs_connector import OpenMRSConnector, OpenMRSMetadata
 from connectors.dhis2_connector import DHIS2Connector
-from models.dhis2_models import DHIS2TrackedEntity, DHIS2DataElement
-from models.openmrs_models import OpenMRSPatient, OpenMRSObservation
-from config.mappings import load_mappings
-from utils.progress_tracker import ProgressTracker
+from config.mappings import MappingRegistry
+from services.validation_service import ValidationService, load_metadata_snapshot
+from utils.progress_tracker import ProgressTracker, TRANSFORMED, FAILED
+from utils.reference_index import ReferenceIndex, dhis2_uid
+from utils.staging_store import StagingStore
+from utils.dead_letter_store import DeadLetterStore, EXTRACT, TRANSFORM
+from utils.logger import log_payload
+from utils.metrics import METRICS
+from utils.profiling import PATIENT_TIMINGS
 
 class SyncService:
-    def __init__(self, openmrs_config, dhis2_config, progress_tracker_file):
-        self.openmrs_connector = OpenMRSConnector(**openmrs_config)
+    def __init__(self, openmrs_config, dhis2_config, progress_tracker_file, reference_index_file='logs/references.db',
+                 staging_file='logs/staging.db', compress_staging=True, mappings_dir='mappings', dead_letter_file='logs/dead_letters.db'):
+        self.mappings = MappingRegistry(mappings_dir)  # Loads, validates and compiles all mapping files once
+        # Only the observations of mapped concepts are extracted
+        self.openmrs_connector = OpenMRSConnector(**openmrs_config, metadata=OpenMRSMetadata(self.mappings.concept_uuids))
         self.dhis2_connector = DHIS2Connector(**dhis2_config)
-        self.mappings = {}  # Initialize the mappings attribute
         self.progress_tracker = ProgressTracker(progress_tracker_file)
+        self.reference_index = ReferenceIndex(reference_index_file)
+        self.staging_store = StagingStore(staging_file, compress=compress_staging)
+        self.dead_letters = DeadLetterStore(dead_letter_file)
+        self.dhis2_connector.progress_tracker = self.progress_tracker
+        self.dhis2_connector.reference_index = self.reference_index
+        self.dhis2_connector.dead_letters = self.dead_letters
+
+    def enable_validation(self, metadata_file='logs/dhis2_metadata.json', max_age=86400, report_file='logs/rejected.jsonl'):
+        """Validate the payloads against the DHIS2 metadata of the mapped programs before they are uploaded.
+
+        The metadata is cached in `metadata_file` for `max_age` seconds. Without it, e.g. on the
+        first run while DHIS2 is down, payloads are uploaded unvalidated. Returns the validator.
+        """
+        program_ids = {form_mappings.program_id for form_mappings in self.mappings.forms.values()}
+        try:
+            snapshot = load_metadata_snapshot(self.dhis2_connector, program_ids, metadata_file, max_age)
+        except Exception as e:
+            logging.warning(f"Could not load the DHIS2 metadata, payloads are uploaded without validation: {e}")
+            return None
+        self.dhis2_connector.validator = ValidationService(snapshot, report_file)
+        return self.dhis2_connector.validator
 
     def load_form_mappings(self, form_id):
-        """Load mappings for a specific form and return them."""
-        mapping_file = f'mappings/forms/form_{form_id}_mappings.json'
-        if os.path.exists(mapping_file):
-            return load_mappings(mapping_file)
-        logging.error(f"Mapping file not found for form ID {form_id}")
-        return None
-
-    def process_patient_and_encounters(self, patient_id, encounter_ids, location_id):
-        """Process a patient and their encounters, transforming them into a DHIS2-compliant JSON object ready for submission to DHIS2."""
-        logging.info(f"Processing patient ID: {patient_id}")
-        # Load attribute mappings
-        attribute_mappings = load_mappings('mappings/attribute_mappings.json')
-        # Load location, province and district mappings
-        location_mappings = load_mappings('mappings/location_mappings.json')
-        province_mappings = load_mappings('mappings/province_mappings.json')
-        district_mappings = load_mappings('mappings/district_mappings.json')
-        # Initialize the DHIS2-compliant JSON object
+        """Return the compiled FormMapping of a specific form, or None if it is not mapped."""
+        form_mappings = self.mappings.get_form(form_id)
+        if form_mappings is None:
+            logging.error(f"Mapping file not found for form ID {form_id}")
+        return form_mappings
+
+    @METRICS.timed('sync_step_seconds', step='extract_patient_batch')
+    def extract_patient_batch(self, patient_encounters, openmrs_connector=None):
+        """Fetch the demographics and encounter data of a batch of (patient_id, encounter_ids) pairs in bulk.
+
+        Returns a (patients_data, encounters_data) pair of dicts keyed by patient ID and encounter ID.
+        """
+        openmrs_connector = openmrs_connector or self.openmrs_connector
+        # Concepts mapped since the last batch are extracted from now on
+        openmrs_connector.metadata.use_concepts(self.mappings.mapped_concept_uuids())
+        all_encounter_ids = [encounter_id for _, encounter_ids in patient_encounters for encounter_id in encounter_ids]
+        encounters_data = openmrs_connector.fetch_encounters_data(all_encounter_ids)
+        patients_data = openmrs_connector.fetch_patients_data([patient_id for patient_id, _ in patient_encounters])
+        return patients_data, encounters_data
+
+    def process_patient_batch(self, patient_encounters, location_id):
+        """Process a batch of patients, fetching their demographics and encounter data in bulk first.
+
+        `patient_encounters` is a list of (patient_id, encounter_ids) pairs. Returns a dict of
+        patient_id -> DHIS2-compliant JSON object ({} for patients that failed).
+        """
+        # Prefetch the demographics of the whole batch into the connector's patient cache
+        try:
+            patients_data, encounters_data = self.extract_patient_batch(patient_encounters)
+        except Exception as e:
+            # The batch fails on its own, like in the pipeline, rather than the rest of its location
+            logging.error("Error extracting a batch of %d patients: %s", len(patient_encounters), e)
+            self.openmrs_connector.clear_patient_cache()
+            self.record_failures(location_id, patient_encounters, EXTRACT, e)
+            results = {patient_id: {} for patient_id, _ in patient_encounters}
+            self.checkpoint_batch(location_id, patient_encounters, results)
+            return results
+        try:
+            # Look up the new patients in DHIS2 in bulk rather than one by one
+            self.resolve_tracked_entity_instances(patient_data.get('UUID') for patient_data in patients_data.values())
+        except Exception as e:
+            # Without the lookup, patients already in DHIS2 would be created a second time
+            logging.error("Error looking up the tracked entity instances of a batch of %d patients: %s", len(patient_encounters), e)
+            self.openmrs_connector.clear_patient_cache()
+            self.record_failures(location_id, patient_encounters, TRANSFORM, e)
+            results = {patient_id: {} for patient_id, _ in patient_encounters}
+            self.checkpoint_batch(location_id, patient_encounters, results)
+            return results
+        results = {}
+        try:
+            for patient_id, encounter_ids in patient_encounters:
+                results[patient_id] = self.process_patient_and_encounters(patient_id, encounter_ids, location_id, encounters_data)
+        finally:
+            self.openmrs_connector.clear_patient_cache()
+        self.checkpoint_batch(location_id, patient_encounters, results)
+        return results
+
+    def transform_patient_batch(self, patient_encounters, location_id, patients_data, encounters_data):
+        """Transform an extracted batch of patients. Returns a dict of patient_id -> JSON object ({} for patients that failed)."""
+        results = {}
+        try:
+            self.resolve_tracked_entity_instances(patient_data.get('UUID') for patient_data in patients_data.values())
+        except Exception as e:
+            # Without the lookup, patients already in DHIS2 would be created a second time
+            logging.error("Error looking up the tracked entity instances of a batch of %d patients: %s", len(patient_encounters), e)
+            self.record_failures(location_id, patient_encounters, TRANSFORM, e)
+            return {patient_id: {} for patient_id, _ in patient_encounters}
+        for patient_id, encounter_ids in patient_encounters:
+            try:
+                with PATIENT_TIMINGS.timed(patient_id, 'transform'):
+                    results[patient_id] = self.transform_patient(patient_id, encounter_ids, location_id, patients_data.get(int(patient_id), {}), encounters_data)
+            except Exception as e:
+                logging.error("Error processing patient ID %s: %s", patient_id, e)
+                self.record_failures(location_id, [(patient_id, encounter_ids)], TRANSFORM, e)
+                results[patient_id] = {}
+        return results
+
+    def record_failures(self, location_id, patient_encounters, stage, error):
+        """Keep (patient_id, encounter_ids) pairs that failed extraction or transformation as dead letters, to replay them on their own."""
+        self.dead_letters.add_many(
+            ((patient_id, {'encounter_ids': list(encounter_ids)}) for patient_id, encounter_ids in patient_encounters), stage, error, location_id
+        )
+
+    def checkpoint_batch(self, location_id, patient_encounters, results):
+        """Checkpoint the state of every patient and encounter of a processed batch."""
+        self.progress_tracker.mark_patients(location_id, [patient_id for patient_id, result in results.items() if result], TRANSFORMED)
+        self.progress_tracker.mark_patients(location_id, [patient_id for patient_id, result in results.items() if not result], FAILED)
+        for patient_id, encounter_ids in patient_encounters:
+            self.progress_tracker.mark_encounters(location_id, patient_id, encounter_ids, TRANSFORMED if results.get(patient_id) else FAILED)
+        self.dead_letters.resolve([patient_id for patient_id, result in results.items() if result], (EXTRACT, TRANSFORM))
+
+    def stage_and_checkpoint_batch(self, location_id, patient_encounters, results):
+        """Stage the payloads of a transformed batch, then checkpoint it, so no patient is checkpointed transformed without a staged payload.
+
+        Returns the (patient_id, payload) pairs staged.
+        """
+        transformed = [(patient_id, result) for patient_id, result in results.items() if result]
+        self.staging_store.stage_many(transformed)
+        self.checkpoint_batch(location_id, patient_encounters, results)
+        return transformed
+
+    @METRICS.timed('sync_step_seconds', step='resolve_tracked_entity_instances')
+    def resolve_tracked_entity_instances(self, patient_uuids):
+        """Return a dict of patient UUID -> tracked entity instance UID, indexing the patients seen for the first time.
+
+        A new patient is looked up in DHIS2 by its UUID attribute, once, so the tracked entity
+        instances created before the index existed are updated rather than duplicated, and their
+        active enrollments are indexed. Patients not found get a UID derived from their UUID.
+        """
+        patient_uuids = {patient_uuid for patient_uuid in patient_uuids if patient_uuid}
+        references = self.reference_index.get_tracked_entity_instances(patient_uuids)
+        new_uuids = sorted(patient_uuids - set(references))
+        if new_uuids:
+            uuid_attribute = self.mappings.attribute_mappings.get('UUID')
+            found, enrollments = self.dhis2_connector.find_tracked_entities(uuid_attribute, new_uuids) if uuid_attribute else ({}, {})
+            new_references = {patient_uuid: found.get(patient_uuid) or dhis2_uid('trackedEntityInstance', patient_uuid) for patient_uuid in new_uuids}
+            self.reference_index.set_tracked_entity_instances(new_references)
+            # New events of these patients join their active enrollments rather than enrolling them again
+            self.reference_index.set_enrollments((instance, program, enrollment) for (instance, program), enrollment in enrollments.items())
+            references.update(new_references)
+        return references
+
+    def get_org_unit_id(self, location_id):
+        """Return the DHIS2 org unit ID of an OpenMRS location, raising ValueError if it is not mapped."""
         # Use the location ID provided by the user to get the org unit ID
-        org_unit_id = location_mappings.get(location_id)
+        org_unit_id = self.mappings.get_org_unit_id(location_id)
         if not org_unit_id:
             logging.error(f"Location ID {location_id} not found in the mappings. Please provide a valid location ID.")
             raise ValueError(f"Location ID {location_id} not found in the mappings.")
-        dhis2_compliant_json = {
-            "trackedEntityType": "j9TllKXZ3jb",
-            "orgUnit": org_unit_id,
-            "attributes": [],
-            "enrollments": []
-        }
+        return org_unit_id
+
+    def process_patient_and_encounters(self, patient_id, encounter_ids, location_id, encounters_data=None):
+        """Process a patient and their encounters, transforming them into a DHIS2-compliant JSON object ready for submission to DHIS2.
+
+        `encounters_data` is the result of `OpenMRSConnector.fetch_encounters_data`; it is fetched
+        for `encounter_ids` when not provided.
+        """
+        logging.debug("Processing patient ID: %s", patient_id)
+        self.get_org_unit_id(location_id)
         try:
             # Fetch patient data
             patient_data = self.openmrs_connector.fetch_patient_data(patient_id)
-            # Transform patient data to DHIS2 attributes format
-            for openmrs_attr, dhis2_attr in attribute_mappings.items():
-                # Get the patient attribute value from patient_data using the OpenMRS attribute name
-                patient_attribute_value = patient_data.get(openmrs_attr)
-                # Special handling for gender to convert 'F' to 'Female' and 'M' to 'Male'
-                # and for 'Citizenship' or 'country' to set its value to 'D6Us3GQryHU'
-                if openmrs_attr == 'Sex':
-                    patient_attribute_value = 'Female' if patient_attribute_value == 'F' else 'Male' if patient_attribute_value == 'M' else patient_attribute_value
-                elif openmrs_attr in ['Citizenship', 'country']:
-                    patient_attribute_value = '646'
-                # Map OpenMRS attributes to DHIS2 attributes and append them to the attributes list
-                # Replace province and district attribute values with the corresponding values from the province and district mappings
-                if openmrs_attr == 'Province' and patient_attribute_value in province_mappings:
-                    patient_attribute_value = province_mappings[patient_attribute_value]
-                elif openmrs_attr == 'District':
-                    # Handle cases where the attribute value is in the format "Rusizi / Western Province/Uburengerazuba"
-                    if '/' in patient_attribute_value:
-                        patient_attribute_value = patient_attribute_value.split('/')[0].strip()
-                    if patient_attribute_value in district_mappings:
-                        patient_attribute_value = district_mappings[patient_attribute_value]
-                if patient_attribute_value is not None:
-                    dhis2_compliant_json["attributes"].append({
-                        "attribute": dhis2_attr,
-                        "value": patient_attribute_value
-                    })
-            # Process each encounter
-            for encounter_id in encounter_ids:
-                # Fetch observations for the encounter
-                observations = self.openmrs_connector.fetch_observations_for_encounter(encounter_id)
-                # Load form mappings based on the form ID associated with the encounter
-                form_id = self.openmrs_connector.get_form_id_by_encounter_id(encounter_id)
-                form_mappings = self.load_form_mappings(form_id)
-                # Transform encounter data and observations to DHIS2 event format
-                event_data_values = []
-                for observation in observations:
-                    # Use form_mappings to map OpenMRS observation to DHIS2 data element
-                    data_element_id = form_mappings['observations'].get(observation['concept_uuid'])
-                    if data_element_id:
-                        # Check if the dataElement is BCTuQ3xPYet and modify the value accordingly
-                        if data_element_id == 'BCTuQ3xPYet':
-                            if observation['value'] == 13467:
-                                observation_value = 'random'
-                            elif observation['value'] == 6689:
-                                observation_value = 'fasting'
-                            else:
-                                observation_value = observation['value']
-                        else:
-                            observation_value = observation['value']
-                        event_data_values.append({
-                            "dataElement": data_element_id,
-                            "value": observation_value
-                        })
-                # Log the event data values before appending to the enrollments list
-                logging.info(f"Event data values for encounter ID {encounter_id}: {patient_data}")
-                # Append transformed encounter data to the enrollments list
-                dhis2_compliant_json["enrollments"].append({
-                    # Fetch the location ID from the encounter data instead of patient_data
-                    "orgUnit": location_mappings.get(location_id),
-                    "program": form_mappings['dhis2_program_id'],  # Use the program stage ID from form mappings
-                    "enrollmentDate": patient_data['date_created'],  # Use the date_created from patient data
-                    "incidentDate": patient_data['date_created'],  # Use the date_created from patient data
-                    "events": [{
-                        "programStage": form_mappings['dhis2_program_stage_id'],  # Use the program stage ID from form mappings
-                        "eventDate": self.openmrs_connector.get_encounter_date_created_by_id(encounter_id),  # Use the date_created from encounter data
-                        "dataValues": event_data_values
-                    }]
-                })
-            # Log the DHIS2-compliant JSON object to a new file named as the patient_id.json
-            self.log_patient_data_to_sync_file(patient_id, dhis2_compliant_json)
+            # Fetch observations, form ID and date_created for all encounters at once
+            if encounters_data is None:
+                encounters_data = self.openmrs_connector.fetch_encounters_data(encounter_ids)
+            with PATIENT_TIMINGS.timed(patient_id, 'transform'):
+                dhis2_compliant_json = self.transform_patient(patient_id, encounter_ids, location_id, patient_data, encounters_data)
+            # Stage the DHIS2-compliant JSON object for upload
+            self.stage_patient_data(patient_id, dhis2_compliant_json)
             return dhis2_compliant_json
         except Exception as e:
-            logging.error(f"Error processing patient ID {patient_id}: {e}")
+            logging.error("Error processing patient ID %s: %s", patient_id, e)
+            self.record_failures(location_id, [(patient_id, encounter_ids)], TRANSFORM, e)
             return {}
 
+    @METRICS.timed('sync_step_seconds', step='transform_patient')
+    def transform_patient(self, patient_id, encounter_ids, location_id, patient_data, encounters_data):
+        """Transform the extracted data of a patient and their encounters into a DHIS2-compliant JSON object."""
+        # Initialize the DHIS2-compliant JSON object
+        org_unit_id = self.get_org_unit_id(location_id)
+        patient_uuid = patient_data.get('UUID')
+        # The DHIS2 records of a patient keep the same UIDs across syncs, so re-syncs update them.
+        # Patients are looked up in DHIS2 per batch, before their transform, so this is a local lookup
+        tracked_entity_instance = self.reference_index.get_tracked_entity_instances([patient_uuid]).get(patient_uuid) if patient_uuid else None
+        if patient_uuid and not tracked_entity_instance:
+            raise ValueError(f"Patient UUID {patient_uuid} was not looked up in DHIS2 before its transform.")
+        dhis2_compliant_json = {
+            "trackedEntityType": "j9TllKXZ3jb",
+            "orgUnit": org_unit_id,
+            # Transform patient data to DHIS2 attributes format, normalising Sex, Citizenship, Province and District
+            "attributes": self.mappings.attribute_values(patient_data),
+            "enrollments": []
+        }
+        if tracked_entity_instance:
+            dhis2_compliant_json["trackedEntityInstance"] = tracked_entity_instance
+            # The active enrollment of the patient in each program, and that of the events synced before
+            program_enrollments = self.reference_index.get_enrollments(tracked_entity_instance)
+            event_enrollments = self.reference_index.get_event_enrollments(dhis2_uid('event', patient_uuid, encounter_id) for encounter_id in encounter_ids)
+        # Encounters with their form mappings, in order
+        encounters = []
+        for encounter_id in encounter_ids:
+            encounter = encounters_data.get(int(encounter_id))
+            if encounter is None:
+                logging.warning("Encounter ID %s not found for patient ID %s, skipping.", encounter_id, patient_id)
+                continue
+            # Load form mappings based on the form ID associated with the encounter
+            form_mappings = self.load_form_mappings(encounter['form_id'])
+            if form_mappings is None:
+                raise ValueError(f"No mappings for form ID {encounter['form_id']} of encounter ID {encounter_id}.")
+            encounters.append((encounter_id, encounter, form_mappings))
+            if tracked_entity_instance:
+                # Patients synced with an enrollment per encounter keep the enrollment of their first synced encounter of the program
+                indexed_enrollment = event_enrollments.get(dhis2_uid('event', patient_uuid, encounter_id))
+                if indexed_enrollment:
+                    program_enrollments.setdefault(form_mappings.program_id, indexed_enrollment)
+        # One enrollment per program, holding the events of all the encounters of its forms
+        enrollments = {}
+        for encounter_id, encounter, form_mappings in encounters:
+            started_at = time.perf_counter()
+            observations = encounter['observations']
+            # Transform encounter data and observations to DHIS2 event format, recoding values such as BCTuQ3xPYet
+            event_data_values = form_mappings.data_values(observations)
+            # Log a sample of the event data values before appending to the enrollments list
+            log_payload("Event data values for encounter ID", encounter_id, event_data_values)
+            event = {
+                "programStage": form_mappings.program_stage_id,  # Use the program stage ID from form mappings
+                "eventDate": encounter['date_created'],  # Use the date_created from encounter data
+                "dataValues": event_data_values
+            }
+            enrollment_key = form_mappings.program_id
+            if tracked_entity_instance:
+                event["event"] = dhis2_uid('event', patient_uuid, encounter_id)
+                # Events synced before stay in their enrollment; the others join the patient's enrollment in the program
+                enrollment_key = event_enrollments.get(event["event"]) or program_enrollments.setdefault(
+                    form_mappings.program_id, dhis2_uid('enrollment', patient_uuid, form_mappings.program_id)
+                )
+            enrollment = enrollments.get(enrollment_key)
+            if enrollment is None:
+                enrollment = enrollments[enrollment_key] = {
+                    "orgUnit": org_unit_id,
+                    "program": form_mappings.program_id,  # Use the program ID from form mappings
+                    "enrollmentDate": patient_data['date_created'],  # Use the date_created from patient data
+                    "incidentDate": patient_data['date_created'],  # Use the date_created from patient data
+                    "events": []
+                }
+                if tracked_entity_instance:
+                    enrollment["enrollment"] = enrollment_key
+                dhis2_compliant_json["enrollments"].append(enrollment)
+            enrollment["events"].append(event)
+            if PATIENT_TIMINGS.enabled:
+                PATIENT_TIMINGS.record_encounter(patient_id, encounter_id, len(observations), time.perf_counter() - started_at)
+        # The enrollment and event UIDs are indexed once DHIS2 accepted them, by the upload
+        return dhis2_compliant_json
 
-    def log_patient_data_to_sync_file(self, patient_id, dhis2_compliant_json):
-        # Ensure the patients_to_sync directory exists
-        os.makedirs('patients_to_sync', exist_ok=True)
-        # Create a new JSON file for each patient using the patient ID as the filename
-        file_path = os.path.join('patients_to_sync', f"{patient_id}.json")
-        with open(file_path, 'w') as file:
-            json.dump(dhis2_compliant_json, file, indent=4)
+    @METRICS.timed('sync_step_seconds', step='stage_patient_data')
+    def stage_patient_data(self, patient_id, dhis2_compliant_json):
+        """Stage the DHIS2-compliant JSON object of a patient for a later upload."""
+        self.staging_store.stage(patient_id, dhis2_compliant_json)
 
     # Other methods and logic as needed for the SyncService class
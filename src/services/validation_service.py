@@ -1,13 +1,292 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+from utils.metrics import METRICS
+
+# Patterns of the value types DHIS2 checks the text of
+_NUMBER = re.compile(r'^-?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?$')
+_INTEGER = re.compile(r'^-?\d+$')
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$')
+_EMAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+_PHONE_NUMBER = re.compile(r'^\+?[\d\s()-]{4,}$')
+
+def _in_range(low, high):
+    return lambda text: bool(_NUMBER.match(text)) and low <= float(text) <= high
+
+# DHIS2 value type -> test of the text of a value; the types missing here, e.g. TEXT, accept any value
+VALUE_TYPE_CHECKS = {
+    'NUMBER': lambda text: bool(_NUMBER.match(text)),
+    'INTEGER': lambda text: bool(_INTEGER.match(text)),
+    'INTEGER_POSITIVE': lambda text: bool(_INTEGER.match(text)) and int(text) > 0,
+    'INTEGER_NEGATIVE': lambda text: bool(_INTEGER.match(text)) and int(text) < 0,
+    'INTEGER_ZERO_OR_POSITIVE': lambda text: bool(_INTEGER.match(text)) and int(text) >= 0,
+    'PERCENTAGE': _in_range(0, 100),
+    'UNIT_INTERVAL': _in_range(0, 1),
+    'BOOLEAN': lambda text: text in ('true', 'false'),
+    'TRUE_ONLY': lambda text: text == 'true',
+    'DATE': lambda text: bool(_DATE.match(text)),
+    'DATETIME': lambda text: bool(_DATE.match(text)),
+    'AGE': lambda text: bool(_DATE.match(text)),
+    'EMAIL': lambda text: bool(_EMAIL.match(text)),
+    'PHONE_NUMBER': lambda text: bool(_PHONE_NUMBER.match(text))
+}
+
+# Fields of the programs and tracked entity type the payloads are validated against
+PROGRAM_FIELDS = (
+    'id,organisationUnits[id],'
+    'programTrackedEntityAttributes[mandatory,trackedEntityAttribute[id,valueType,optionSet[options[code]]]],'
+    'programStages[id,programStageDataElements[compulsory,dataElement[id,valueType,optionSet[options[code]]]]]'
+)
+TRACKED_ENTITY_TYPE_FIELDS = 'id,trackedEntityTypeAttributes[mandatory,trackedEntityAttribute[id,valueType,optionSet[options[code]]]]'
+
+def _text(value):
+    """Return a payload value as the text DHIS2 stores."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+def _value_check(element):
+    """Compile the check of the values of a data element or attribute, returning an error message or None."""
+    value_type = element.get('valueType')
+    type_check = VALUE_TYPE_CHECKS.get(value_type)
+    options = frozenset(option.get('code') for option in (element.get('optionSet') or {}).get('options', [])) or None
+
+    def check(value):
+        text = _text(value)
+        if options is not None and text not in options:
+            return f"value {text!r} is not an option of the option set"
+        if type_check is not None and not type_check(text):
+            return f"value {text!r} is not a valid {value_type}"
+        return None
+
+    return check
+
+def load_metadata_snapshot(dhis2_connector, program_ids, file_path, max_age, tracked_entity_type='j9TllKXZ3jb'):
+    """Return the DHIS2 metadata the payloads of `program_ids` are validated against.
+
+    The snapshot is read from `file_path` while it is younger than `max_age` seconds and covers
+    the programs, and fetched from DHIS2 and saved there otherwise, so the metadata is only
+    requested once a day rather than once per run. If DHIS2 cannot be reached, an older
+    snapshot is used rather than none.
+    """
+    program_ids = sorted(program_ids)
+    snapshot = None
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as file:
+            snapshot = json.load(file)
+        covered = set(program_ids) <= {program['id'] for program in snapshot.get('programs', [])}
+        if covered and time.time() - snapshot.get('fetched_at', 0) < max_age:
+            return snapshot
+    try:
+        query = urlencode({'filter': f"id:in:[{','.join(program_ids)}]", 'fields': PROGRAM_FIELDS, 'paging': 'false'})
+        programs = dhis2_connector.make_api_call(f"programs.json?{query}")
+        query = urlencode({'fields': TRACKED_ENTITY_TYPE_FIELDS})
+        tracked_entity = dhis2_connector.make_api_call(f"trackedEntityTypes/{tracked_entity_type}.json?{query}")
+    except Exception as e:
+        if snapshot is None:
+            raise
+        logging.warning(f"Could not refresh the DHIS2 metadata ({e}), validating against the snapshot in {file_path}.")
+        return snapshot
+    snapshot = {'fetched_at': time.time(), 'programs': programs.get('programs', []), 'trackedEntityType': tracked_entity}
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(temp_path, file_path)
+    logging.info(f"Saved the DHIS2 metadata of {len(snapshot['programs'])} programs to {file_path}.")
+    return snapshot
+
 class ValidationService:
-    @staticmethod
-    def validate_openmrs_data(data):
-        # Implement validation logic for OpenMRS data
-        pass
+    """Validate tracked entity instance payloads against a snapshot of the DHIS2 metadata before they are uploaded.
+
+    The checks are compiled once from the snapshot: the value type and option set of every
+    attribute and data element, the mandatory attributes, the compulsory data elements of every
+    program stage and the org units every program is assigned to. A payload whose attributes
+    or enrollments are invalid is rejected whole; an invalid event is dropped from a copy of its
+    payload, and the rest of the patient is still uploaded. Rejections are appended to
+    `report_file`, one JSON object per line, with their errors and payload, instead of being sent
+    to DHIS2.
+    """
+
+    def __init__(self, snapshot, report_file=None):
+        self.report_file = report_file
+        self.lock = threading.Lock()
+        tracked_entity = snapshot.get('trackedEntityType') or {}
+        self.tracked_entity_type = tracked_entity.get('id')
+        self.attribute_checks = {}
+        self.mandatory_attributes = set()
+        self._compile_attributes(tracked_entity.get('trackedEntityTypeAttributes', []), self.mandatory_attributes)
+        # program ID -> (org unit IDs, mandatory attribute IDs, {program stage ID -> ({data element ID -> check}, compulsory data element IDs)})
+        self.programs = {}
+        for program in snapshot.get('programs', []):
+            mandatory_attributes = set()
+            self._compile_attributes(program.get('programTrackedEntityAttributes', []), mandatory_attributes)
+            stages = {}
+            for stage in program.get('programStages', []):
+                elements = stage.get('programStageDataElements', [])
+                stages[stage['id']] = (
+                    {element['dataElement']['id']: _value_check(element['dataElement']) for element in elements},
+                    frozenset(element['dataElement']['id'] for element in elements if element.get('compulsory'))
+                )
+            org_units = frozenset(org_unit['id'] for org_unit in program.get('organisationUnits', []))
+            self.programs[program['id']] = (org_units, frozenset(mandatory_attributes), stages)
+        logging.info(f"Compiled the validation of {len(self.programs)} programs and {len(self.attribute_checks)} attributes.")
+
+    def _compile_attributes(self, attributes, mandatory):
+        for attribute in attributes:
+            attribute_id = attribute['trackedEntityAttribute']['id']
+            self.attribute_checks[attribute_id] = _value_check(attribute['trackedEntityAttribute'])
+            if attribute.get('mandatory'):
+                mandatory.add(attribute_id)
+
+    def validate_dhis2_data(self, payload):
+        """Check a tracked entity instance payload, leaving it unchanged.
+
+        Returns (errors, valid_payload, rejected_events): the errors rejecting the whole payload,
+        a copy of the payload without its invalid events, and the (event, errors) pairs of the
+        events dropped from it. Each dropped event carries the fields of its enrollment and patient,
+        so it can be uploaded on its own once fixed. An enrollment left without events is kept in
+        the copy, without an events list, so those events have an enrollment to go to.
+        """
+        errors = []
+        if not payload.get('orgUnit'):
+            errors.append("missing orgUnit")
+        if self.tracked_entity_type and payload.get('trackedEntityType') != self.tracked_entity_type:
+            errors.append(f"trackedEntityType {payload.get('trackedEntityType')} is not {self.tracked_entity_type}")
+        attribute_ids = set()
+        for attribute in payload.get('attributes', []):
+            attribute_id = attribute.get('attribute')
+            attribute_ids.add(attribute_id)
+            check = self.attribute_checks.get(attribute_id)
+            if check is None:
+                errors.append(f"attribute {attribute_id} is not an attribute of the tracked entity type or programs")
+                continue
+            error = check(attribute.get('value')) if attribute.get('value') is not None else None
+            if error:
+                errors.append(f"attribute {attribute_id}: {error}")
+        mandatory_attributes = set(self.mandatory_attributes)
+        rejected_events = []
+        enrollments = []
+        for enrollment in payload.get('enrollments', []):
+            enrollments.append(enrollment)
+            program = self.programs.get(enrollment.get('program'))
+            if program is None:
+                errors.append(f"program {enrollment.get('program')} is not in the DHIS2 metadata")
+                continue
+            org_units, program_mandatory_attributes, stages = program
+            mandatory_attributes |= program_mandatory_attributes
+            org_unit = enrollment.get('orgUnit') or payload.get('orgUnit')
+            if org_unit not in org_units:
+                errors.append(f"program {enrollment['program']} is not assigned to org unit {org_unit}")
+            for date_field in ('enrollmentDate', 'incidentDate'):
+                if not _DATE.match(str(enrollment.get(date_field) or '')):
+                    errors.append(f"enrollment of program {enrollment['program']}: invalid {date_field} {enrollment.get(date_field)!r}")
+            events = []
+            for event in enrollment.get('events', []):
+                event_errors = self._event_errors(event, stages)
+                if event_errors:
+                    rejected_events.append((self._standalone_event(event, enrollment, payload), event_errors))
+                else:
+                    events.append(event)
+            if len(events) < len(enrollment.get('events', [])):
+                enrollments[-1] = {key: value for key, value in enrollment.items() if key != 'events'}
+                if events:
+                    enrollments[-1]['events'] = events
+        missing = mandatory_attributes - attribute_ids
+        if missing:
+            errors.append(f"missing mandatory attributes {', '.join(sorted(missing))}")
+        valid_payload = dict(payload, enrollments=enrollments) if rejected_events else payload
+        return errors, valid_payload, rejected_events
+
+    def validate_event(self, event):
+        """Check an event uploaded on its own, carrying its program. Returns the list of its errors."""
+        program = self.programs.get(event.get('program'))
+        if program is None:
+            return [f"program {event.get('program')} is not in the DHIS2 metadata"]
+        return self._event_errors(event, program[2])
 
     @staticmethod
-    def validate_dhis2_data(data):
-        # Implement validation logic for DHIS2 data
-        pass
+    def _standalone_event(event, enrollment, payload):
+        """Return a copy of an event of a payload with the fields of its enrollment and patient, as the connector uploads it."""
+        event = dict(
+            event, program=enrollment.get('program'), orgUnit=payload.get('orgUnit'),
+            enrollmentDate=enrollment.get('enrollmentDate'), incidentDate=enrollment.get('incidentDate')
+        )
+        if enrollment.get('enrollment'):
+            event['enrollment'] = enrollment['enrollment']
+        if payload.get('trackedEntityInstance'):
+            event['trackedEntityInstance'] = payload['trackedEntityInstance']
+        return event
+
+    def _event_errors(self, event, stages):
+        stage = stages.get(event.get('programStage'))
+        if stage is None:
+            return [f"program stage {event.get('programStage')} is not a stage of the program"]
+        checks, compulsory = stage
+        errors = []
+        if not _DATE.match(str(event.get('eventDate') or '')):
+            errors.append(f"invalid eventDate {event.get('eventDate')!r}")
+        data_element_ids = set()
+        for data_value in event.get('dataValues', []):
+            data_element_id = data_value.get('dataElement')
+            check = checks.get(data_element_id)
+            if check is None:
+                errors.append(f"data element {data_element_id} is not in program stage {event['programStage']}")
+                continue
+            if data_value.get('value') is None:
+                continue
+            data_element_ids.add(data_element_id)
+            error = check(data_value['value'])
+            if error:
+                errors.append(f"data element {data_element_id}: {error}")
+        missing = compulsory - data_element_ids
+        if missing:
+            errors.append(f"missing compulsory data elements {', '.join(sorted(missing))}")
+        return errors
+
+    def validate_batch(self, patients):
+        """Split a batch of (patient_id, payload) pairs into the payloads to upload and the rejected patients and events.
 
-    # Additional validation methods as needed
+        Returns (valid, rejected, dropped): the (patient_id, payload) pairs left to upload, copies
+        without their invalid events, the (patient_id, errors) pairs of the patients rejected whole,
+        and the (patient_id, event, errors) triples of the events dropped from the valid payloads.
+        """
+        valid, rejected, dropped, report = [], [], [], []
+        rejected_events = 0
+        for patient_id, payload in patients:
+            errors, valid_payload, events = self.validate_dhis2_data(payload)
+            rejected_events += len(events)
+            report.extend(
+                {'patient_id': str(patient_id), 'record': 'event', 'id': event.get('event'), 'errors': event_errors, 'payload': event}
+                for event, event_errors in events
+            )
+            if errors:
+                rejected.append((patient_id, errors))
+                report.append({'patient_id': str(patient_id), 'record': 'trackedEntityInstance', 'id': payload.get('trackedEntityInstance'), 'errors': errors, 'payload': payload})
+            else:
+                valid.append((patient_id, valid_payload))
+                dropped.extend((patient_id, event, event_errors) for event, event_errors in events)
+        if rejected:
+            METRICS.increment('dhis2_rejected_total', len(rejected), record='trackedEntityInstance')
+        if rejected_events:
+            METRICS.increment('dhis2_rejected_total', rejected_events, record='event')
+        if report:
+            logging.warning("Validation rejected %d of %d tracked entity instances and %d events; see %s.", len(rejected), len(patients), rejected_events, self.report_file)
+            self._write_report(report)
+        return valid, rejected, dropped
 
+    def _write_report(self, report):
+        """Append rejected records to the reject report."""
+        if not self.report_file:
+            return
+        rejected_at = datetime.now().isoformat(timespec='seconds')
+        with self.lock:
+            os.makedirs(os.path.dirname(self.report_file) or '.', exist_ok=True)
+            with open(self.report_file, 'a') as file:
+                for entry in report:
+                    file.write(json.dumps(dict(entry, rejected_at=rejected_at), default=str) + '\n')
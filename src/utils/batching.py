@@ -0,0 +1,10 @@
+from itertools import islice
+
+def batched(iterable, size):
+    """Yield lists of up to `size` items from an iterable, consuming it lazily."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,195 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+
+# Stages a patient can fail at. Extraction and transformation failures keep the patient's location and encounter IDs
+# to extract them again; upload and validation failures keep the payload to send again, and each event dropped by
+# validation is kept on its own, as a record of the patient's validation stage
+EXTRACT = 'extract'
+TRANSFORM = 'transform'
+UPLOAD = 'upload'
+VALIDATION = 'validation'
+STAGES = (EXTRACT, TRANSFORM, VALIDATION, UPLOAD)
+
+# Error classes of an unreachable or overloaded server: replayed first, as they succeed once it is back
+TRANSIENT_ERRORS = {
+    'ConnectionError', 'ConnectTimeout', 'ReadTimeout', 'Timeout', 'ChunkedEncodingError', 'CircuitOpenError',
+    'OperationalError', 'InterfaceError', 'PoolError'
+}
+# Error classes of records refused for their content: replayed last, as they fail again until the data or metadata is fixed
+DATA_ERRORS = {'ValidationError', 'ImportRejected', 'ValueError', 'KeyError', 'TypeError', 'AttributeError'}
+
+def error_class(error):
+    """Return the error class recorded for a failure: the exception class name, or ImportRejected when DHIS2 refused the record."""
+    return type(error).__name__ if isinstance(error, BaseException) else 'ImportRejected'
+
+def error_priority(error):
+    """Return the replay priority of a failure, 0 first. HTTP errors are transient unless DHIS2 refused the request itself (4xx but 429)."""
+    name = error_class(error)
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if name == 'HTTPError' and status is not None:
+        return 2 if 400 <= status < 500 and status != 429 else 0
+    if name in TRANSIENT_ERRORS:
+        return 0
+    return 2 if name in DATA_ERRORS else 1
+
+class DeadLetterStore:
+    """The patients that failed to sync, with what is needed to retry them, backed by SQLite.
+
+    Each failure is kept once per patient and stage, with its payload, error class and message
+    and the number of attempts, so the failed patients can be replayed on their own instead of
+    re-running their whole location. A dead letter is resolved, i.e. deleted, once its patient
+    gets past the stage, whether by a replay or by a regular run. A stage can also hold dead
+    letters of single records of a patient, e.g. the events validation dropped from a payload
+    uploaded without them; those are resolved once the record itself gets past the stage.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            # Stores created before records were kept on their own held one dead letter per patient and stage
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(dead_letters)")]
+            migrate = columns and 'record' not in columns
+            if migrate:
+                self.connection.execute("DROP INDEX IF EXISTS dead_letters_priority")
+                self.connection.execute("ALTER TABLE dead_letters RENAME TO dead_letters_by_patient")
+            self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id TEXT,
+                stage TEXT,
+                record TEXT NOT NULL DEFAULT '',
+                location_id TEXT,
+                payload BLOB,
+                error_class TEXT,
+                error TEXT,
+                priority INTEGER,
+                attempts INTEGER,
+                first_failed_at TEXT,
+                last_failed_at TEXT,
+                UNIQUE (patient_id, stage, record)
+            );
+            CREATE INDEX IF NOT EXISTS dead_letters_priority ON dead_letters (priority, id);
+            """)
+            if migrate:
+                self.connection.execute(
+                    "INSERT INTO dead_letters (id, patient_id, stage, location_id, payload, error_class, error, priority, attempts, first_failed_at, last_failed_at) "
+                    "SELECT id, patient_id, stage, location_id, payload, error_class, error, priority, attempts, first_failed_at, last_failed_at "
+                    "FROM dead_letters_by_patient"
+                )
+                self.connection.execute("DROP TABLE dead_letters_by_patient")
+        # Patients with dead letters, so resolving the patients that never failed costs no query
+        self.patient_ids = {row[0] for row in self.connection.execute("SELECT DISTINCT patient_id FROM dead_letters")}
+
+    def add(self, patient_id, stage, payload, error, location_id=None, record=''):
+        """Record a failure of a patient, or of one `record` of a patient, at a stage, counting one more attempt if it failed there before."""
+        self.add_many([(patient_id, payload)], stage, error, location_id, record)
+
+    def add_many(self, patients, stage, error, location_id=None, record=''):
+        """Record the same failure of an iterable of (patient_id, payload) pairs, e.g. a failed batch."""
+        now = _now()
+        rows = [
+            (str(patient_id), stage, record, str(location_id) if location_id is not None else None, zlib.compress(json.dumps(payload, separators=(',', ':')).encode()),
+             error_class(error), str(error) if error else 'import failed', error_priority(error), now, now)
+            for patient_id, payload in patients
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO dead_letters (patient_id, stage, record, location_id, payload, error_class, error, priority, attempts, first_failed_at, last_failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT (patient_id, stage, record) DO UPDATE SET location_id = COALESCE(excluded.location_id, location_id), payload = excluded.payload, "
+                "error_class = excluded.error_class, error = excluded.error, priority = excluded.priority, attempts = attempts + 1, "
+                "last_failed_at = excluded.last_failed_at",
+                rows
+            )
+            self.patient_ids.update(row[0] for row in rows)
+
+    def resolve(self, patient_ids, stages):
+        """Delete the dead letters of the given stages of patients that got past them, except those of their single records."""
+        placeholder = ', '.join(['?'] * len(stages))
+        self._delete(
+            patient_ids, f"DELETE FROM dead_letters WHERE patient_id = ? AND stage IN ({placeholder}) AND record = ''",
+            lambda patient_id: [patient_id] + list(stages)
+        )
+
+    def resolve_records(self, patient_id, stage, records):
+        """Delete the dead letters of single records of a patient that got past a stage."""
+        records = list(records)
+        if records:
+            placeholder = ', '.join(['?'] * len(records))
+            self._delete([patient_id], f"DELETE FROM dead_letters WHERE patient_id = ? AND stage = ? AND record IN ({placeholder})",
+                         lambda patient_id: [patient_id, stage] + records)
+
+    def _delete(self, patient_ids, query, params):
+        """Run a DELETE query once per patient with dead letters among `patient_ids`, with `params(patient_id)`."""
+        patient_ids = [str(patient_id) for patient_id in patient_ids if str(patient_id) in self.patient_ids]
+        if not patient_ids:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(query, [params(patient_id) for patient_id in patient_ids])
+            remaining = {
+                patient_id for patient_id in patient_ids
+                if self.connection.execute("SELECT 1 FROM dead_letters WHERE patient_id = ?", (patient_id,)).fetchone()
+            }
+            self.patient_ids -= set(patient_ids) - remaining
+
+    def _filter(self, stages=None, error_classes=None, max_attempts=None):
+        conditions, params = [], []
+        if stages:
+            conditions.append(f"stage IN ({', '.join(['?'] * len(stages))})")
+            params.extend(stages)
+        if error_classes:
+            conditions.append(f"error_class IN ({', '.join(['?'] * len(error_classes))})")
+            params.extend(error_classes)
+        if max_attempts:
+            conditions.append("attempts < ?")
+            params.append(max_attempts)
+        return (f"WHERE {' AND '.join(conditions)}" if conditions else ''), params
+
+    def summary(self):
+        """Return (stage, error_class, count, attempts) rows, one per stage and error class, in replay order."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT stage, error_class, COUNT(*), MAX(attempts) FROM dead_letters GROUP BY stage, error_class ORDER BY MIN(priority), COUNT(*) DESC"
+            ).fetchall()
+
+    def count(self, stages=None, error_classes=None, max_attempts=None):
+        """Count the dead letters of the given stages and error classes with fewer than `max_attempts` attempts."""
+        where, params = self._filter(stages, error_classes, max_attempts)
+        with self.lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM dead_letters {where}", params).fetchone()[0]
+
+    def iter_batches(self, batch_size=100, stages=None, error_classes=None, max_attempts=None):
+        """Yield lists of up to `batch_size` (patient_id, stage, location_id, payload, record) tuples, by priority then age.
+
+        `record` is '' for the dead letters of whole patients.
+
+        The dead letters are read as of the start of the iteration, so those recorded again while
+        replaying are not yielded twice. Only one batch is held in memory.
+        """
+        where, params = self._filter(stages, error_classes, max_attempts)
+        with self.lock:
+            ids = [row[0] for row in self.connection.execute(f"SELECT id FROM dead_letters {where} ORDER BY priority, id", params)]
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT patient_id, stage, location_id, payload, record FROM dead_letters WHERE id IN ({', '.join(['?'] * len(chunk))}) ORDER BY priority, id", chunk
+                ).fetchall()
+            yield [(patient_id, stage, location_id, json.loads(zlib.decompress(payload)), record) for patient_id, stage, location_id, payload, record in rows]
+
+    def close(self):
+        """Close the dead-letter store."""
+        self.connection.close()
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
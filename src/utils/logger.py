@@ -1,20 +1,102 @@
+import atexit
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-def setup_logger(log_file):
-    """Sets up a logger for the application."""
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        filename=log_file,
-        filemode='a'
-    )
+# Attributes every LogRecord has; anything else on a record was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
 
+# The handlers records are finally written by, and the listeners feeding them
+_handlers = []
+_listeners = []
+_payload_sample_rate = 0.0
+
+class StructuredFormatter(logging.Formatter):
+    """Format records as one JSON object per line, with the fields passed through `extra` as keys."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logger(log_file, level='INFO', max_bytes=50 * 1024 * 1024, backup_count=5, log_format='text', payload_sample_rate=0.0):
+    """Sets up a logger for the application.
+
+    Records are put on a queue by the logging threads and written to the console and to
+    `log_file` by a background listener, so the sync never waits on disk writes. The file is
+    rotated once it reaches `max_bytes`, keeping `backup_count` old files. With `log_format`
+    'json', each line is a JSON object.
+    """
+    global _payload_sample_rate
+    _payload_sample_rate = payload_sample_rate
+    os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+    formatter = StructuredFormatter() if log_format == 'json' else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+    file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    console_handler.setFormatter(formatter)
-    logging.getLogger().addHandler(console_handler)
+    for handler in (file_handler, console_handler):
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+    _handlers[:] = [file_handler, console_handler]
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    _start_listener(log_queue)
 
     logging.info("Logging is set up.")
 
+def _start_listener(log_queue):
+    listener = QueueListener(log_queue, *_handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    if len(_listeners) == 1:
+        # Flush the records still queued when the application exits
+        atexit.register(stop_logger)
+
+def stop_logger():
+    """Write out the queued records and stop the background listeners."""
+    while _listeners:
+        _listeners.pop().stop()
+
+def worker_log_queue():
+    """Return a queue worker processes can log to, written by the handlers of this process, or None if logging is not set up."""
+    if not _handlers:
+        return None
+    log_queue = multiprocessing.Queue(-1)
+    _start_listener(log_queue)
+    return log_queue
+
+def setup_worker_logger(log_queue, level=None):
+    """Send the records of a worker process to the queue returned by `worker_log_queue` in the parent process."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    if level is not None:
+        root.setLevel(level)
+
+def log_payload(message, record_id, payload):
+    """Log the payload of one record at DEBUG level, for a sample of the records only.
+
+    Payloads hold patient data, so they are only logged when DEBUG is enabled and then only for a
+    `payload_sample_rate` fraction of the records. The payload is not serialised otherwise.
+    """
+    if _payload_sample_rate <= 0 or not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    if random.random() < _payload_sample_rate:
+        logging.debug("%s %s: %s", message, record_id, json.dumps(payload, separators=(',', ':'), default=str))
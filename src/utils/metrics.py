@@ -0,0 +1,196 @@
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Counts of observed values per bucket, with their sum, as Prometheus histograms keep them."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, plus one for the values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate a quantile by linear interpolation within its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+class Metrics:
+    """Thread-safe registry of counters and latency histograms, each identified by a name and labels.
+
+    Latencies are named `*_seconds`; the failures of the same calls are counted in the matching
+    `*_errors_total` counter, with the same labels.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time a block into histogram `name`, counting it in the matching errors counter if it raises."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment(_errors_name(name), **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator timing every call of a function with `timer`."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def drain(self):
+        """Return the recorded metrics and reset them, e.g. to send them from a worker process to its parent."""
+        with self.lock:
+            state = (self.counters, self.histograms)
+            self.counters, self.histograms = {}, {}
+        return state
+
+    def merge(self, state):
+        """Add the metrics returned by `drain` to this registry."""
+        counters, histograms = state
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in histograms.items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+
+    def to_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        declared = set()
+        with self.lock:
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            counters = sorted(self.counters.items())
+            # Render under the lock, so every histogram is consistent with itself
+            for (name, labels), histogram in histograms:
+                if name not in declared:
+                    lines.append(f"# TYPE {name} histogram")
+                    declared.add(name)
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_path):
+        """Write the metrics to a Prometheus text file, e.g. for the node exporter's textfile collector."""
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        temporary_path = f"{file_path}.tmp"
+        with open(temporary_path, 'w') as file:
+            file.write(self.to_prometheus())
+        os.replace(temporary_path, file_path)
+
+    def serve_prometheus(self, port, host='0.0.0.0'):
+        """Serve the metrics on http://host:port/metrics from a background thread. Returns the server."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def summary_table(self):
+        """Format the latency histograms as a table, the calls taking the most time in total first."""
+        with self.lock:
+            rows = [
+                (name, labels, histogram.count, self.counters.get((_errors_name(name), labels), 0), histogram.sum,
+                 histogram.quantile(0.5), histogram.quantile(0.95))
+                for (name, labels), histogram in self.histograms.items()
+            ]
+        rows.sort(key=lambda row: row[4], reverse=True)
+        header = ('metric', 'calls', 'errors', 'error %', 'total s', 'mean ms', 'p50 ms', 'p95 ms')
+        table = [header] + [
+            (f"{name}{_format_labels(labels)}", str(count), str(errors), f"{100.0 * errors / count:.1f}" if count else '0.0',
+             f"{total:.2f}", f"{1000 * total / count:.1f}" if count else '0.0', f"{1000 * p50:.1f}", f"{1000 * p95:.1f}")
+            for name, labels, count, errors, total, p50, p95 in rows
+        ]
+        widths = [max(len(row[column]) for row in table) for column in range(len(header))]
+        return '\n'.join(
+            '  '.join(cell.ljust(width) if column == 0 else cell.rjust(width) for column, (cell, width) in enumerate(zip(row, widths)))
+            for row in table
+        )
+
+def _errors_name(name):
+    return name[:-len('_seconds')] + '_errors_total' if name.endswith('_seconds') else name + '_errors_total'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+# The registry every component records into
+METRICS = Metrics()
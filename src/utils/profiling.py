@@ -0,0 +1,223 @@
+import heapq
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+class SamplingProfiler:
+    """Sample the stacks of every thread of the process at a fixed interval.
+
+    Unlike cProfile, which only sees the thread it was enabled in and slows every call down, the
+    sampler covers the extraction, transformation and upload workers alike at a small, constant
+    cost. The samples are written as collapsed stacks, one `thread;frame;...;frame count` line
+    per distinct stack, the input of flamegraph.pl, speedscope and most flame graph viewers.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                # Number-less thread names, so the workers of a pool add up to one tower
+                stack.append(re.sub(r'[-_]\d+', '', names.get(thread_id, 'thread')))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def write_collapsed(self, file_path):
+        """Write the samples as collapsed stacks to `file_path`."""
+        with open(file_path, 'w') as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+class PatientTimings:
+    """Time spent on each patient and encounter, recorded while profiling is enabled.
+
+    Keeps the time of every stage per patient, with its encounter and observation counts, and
+    the `top` slowest encounters, so a report can single out the patients and encounters that
+    dominate a run, such as those with thousands of observations.
+    """
+
+    def __init__(self, top=25):
+        self.enabled = False
+        self.top = top
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.patients = {}
+            self.slowest_encounters = []
+
+    @contextmanager
+    def timed(self, patient_id, stage):
+        """Add the time of the block to `stage` of a patient, if enabled."""
+        if not self.enabled:
+            yield
+            return
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started_at
+            with self.lock:
+                patient = self._patient(patient_id)
+                patient[stage] = patient.get(stage, 0.0) + seconds
+
+    def record_encounter(self, patient_id, encounter_id, observations, seconds):
+        """Record the transformation time and observation count of an encounter."""
+        with self.lock:
+            patient = self._patient(patient_id)
+            patient['encounters'] += 1
+            patient['observations'] += observations
+            entry = (seconds, str(patient_id), str(encounter_id), observations)
+            if len(self.slowest_encounters) < self.top:
+                heapq.heappush(self.slowest_encounters, entry)
+            else:
+                heapq.heappushpop(self.slowest_encounters, entry)
+
+    def drain(self):
+        """Return the recorded timings and reset them, e.g. to send them from a worker process to its parent."""
+        with self.lock:
+            state = (self.patients, self.slowest_encounters)
+            self.patients, self.slowest_encounters = {}, []
+        return state
+
+    def merge(self, state):
+        """Add the timings returned by `drain` to these."""
+        patients, slowest_encounters = state
+        with self.lock:
+            for patient_id, timings in patients.items():
+                patient = self._patient(patient_id)
+                for key, value in timings.items():
+                    patient[key] = patient.get(key, 0) + value
+            for entry in slowest_encounters:
+                if len(self.slowest_encounters) < self.top:
+                    heapq.heappush(self.slowest_encounters, entry)
+                else:
+                    heapq.heappushpop(self.slowest_encounters, entry)
+
+    def _patient(self, patient_id):
+        return self.patients.setdefault(str(patient_id), {'encounters': 0, 'observations': 0})
+
+    def report(self):
+        """Format the slowest patients and encounters as text, flagging those with unusually many observations."""
+        with self.lock:
+            patients = {patient_id: dict(patient) for patient_id, patient in self.patients.items()}
+            encounters = sorted(self.slowest_encounters, reverse=True)
+        if not patients:
+            return "No patient was transformed or uploaded while profiling."
+        stages = sorted({key for patient in patients.values() for key in patient} - {'encounters', 'observations'})
+        for patient in patients.values():
+            patient['total'] = sum(patient.get(stage, 0.0) for stage in stages)
+        obs_per_encounter = [patient['observations'] / patient['encounters'] for patient in patients.values() if patient['encounters']]
+        # An encounter is flagged when it has ten times the observations of the median encounter
+        threshold = 10 * max(statistics.median(obs_per_encounter), 1) if obs_per_encounter else float('inf')
+        totals = {stage: sum(patient.get(stage, 0.0) for patient in patients.values()) for stage in stages}
+        lines = [
+            f"{len(patients)} patients profiled; seconds per stage: " + ', '.join(f"{stage} {seconds:.2f}" for stage, seconds in totals.items()),
+            f"Median observations per encounter: {statistics.median(obs_per_encounter) if obs_per_encounter else 0:.0f}; "
+            f"encounters with more than {threshold:.0f} are flagged.",
+            '',
+            f"Slowest {min(self.top, len(patients))} patients:",
+            _table(
+                ('patient_id', 'total ms') + tuple(f"{stage} ms" for stage in stages) + ('encounters', 'obs', ''),
+                [
+                    (patient_id, f"{1000 * patient['total']:.1f}") + tuple(f"{1000 * patient.get(stage, 0.0):.1f}" for stage in stages)
+                    + (str(patient['encounters']), str(patient['observations']),
+                       'MANY OBS' if patient['encounters'] and patient['observations'] / patient['encounters'] > threshold else '')
+                    for patient_id, patient in heapq.nlargest(self.top, patients.items(), key=lambda item: item[1]['total'])
+                ]
+            ),
+            '',
+            f"Slowest {len(encounters)} encounters (transformation):",
+            _table(
+                ('encounter_id', 'patient_id', 'ms', 'obs', ''),
+                [
+                    (encounter_id, patient_id, f"{1000 * seconds:.1f}", str(observations), 'MANY OBS' if observations > threshold else '')
+                    for seconds, patient_id, encounter_id, observations in encounters
+                ]
+            )
+        ]
+        return '\n'.join(lines)
+
+def _table(header, rows):
+    rows = [header] + rows
+    widths = [max(len(row[column]) for row in rows) for column in range(len(header))]
+    return '\n'.join(
+        '  '.join(cell.ljust(width) if column == 0 else cell.rjust(width) for column, (cell, width) in enumerate(zip(row, widths))).rstrip()
+        for row in rows
+    )
+
+# The timings every component records into while profiling
+PATIENT_TIMINGS = PatientTimings()
+
+class RunProfiler:
+    """Profile a whole run: stack samples of all threads, per-patient timings and, optionally, memory allocations.
+
+    `stop` writes to `output_dir`:
+    - profile.folded, the collapsed stacks of the samples, for a flame graph
+    - patients.txt, the slowest patients and encounters with their observation counts
+    - memory.txt, with `trace_memory`, the lines that allocated the most memory still held at the
+      end, with the peak. Tracing every allocation slows the whole run down, so it is off by default.
+    """
+
+    def __init__(self, output_dir, interval=0.005, trace_memory=False):
+        self.output_dir = output_dir
+        self.sampler = SamplingProfiler(interval)
+        self.trace_memory = trace_memory
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        PATIENT_TIMINGS.reset()
+        PATIENT_TIMINGS.enabled = True
+        if self.trace_memory:
+            tracemalloc.start()
+        self.sampler.start()
+
+    def stop(self):
+        """Stop profiling and write the reports. Returns their paths."""
+        self.sampler.stop()
+        PATIENT_TIMINGS.enabled = False
+        paths = [os.path.join(self.output_dir, 'profile.folded'), os.path.join(self.output_dir, 'patients.txt')]
+        self.sampler.write_collapsed(paths[0])
+        with open(paths[1], 'w') as file:
+            file.write(PATIENT_TIMINGS.report() + '\n')
+        if self.trace_memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            paths.append(os.path.join(self.output_dir, 'memory.txt'))
+            with open(paths[-1], 'w') as file:
+                file.write(f"Traced memory: {current / 1024 / 1024:.1f} MB at the end of the run, {peak / 1024 / 1024:.1f} MB at the peak.\n\n")
+                file.write("Lines holding the most memory at the end of the run:\n")
+                for statistic in snapshot.statistics('lineno')[:25]:
+                    file.write(f"{statistic}\n")
+        return paths
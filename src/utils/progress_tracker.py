@@ -1,38 +1,215 @@
 import json
 import os
+import sqlite3
+import threading
+from datetime import datetime
+
+# States of a patient or encounter in the checkpoint store
+EXTRACTED = 'extracted'
+TRANSFORMED = 'transformed'
+UPLOADED = 'uploaded'
+FAILED = 'failed'
 
 class ProgressTracker:
+    """Crash-safe checkpoint store of the synchronization progress, backed by SQLite in WAL mode.
+
+    Every update is a single-row write in its own transaction instead of a rewrite of the whole
+    progress file, and per-location, per-patient and per-encounter state can be looked up by key.
+    """
+
     def __init__(self, file_path):
         self.file_path = file_path
-        self.progress_data = self._load_progress()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        self._import_legacy_progress()
+
+    def _create_tables(self):
+        """Create the checkpoint tables if they do not exist."""
+        with self.connection:
+            # Stores created before patients were checkpointed per location kept one row per patient
+            primary_key = [row[1] for row in self.connection.execute("PRAGMA table_info(patients)") if row[5]]
+            migrate = primary_key == ['patient_id']
+            if migrate:
+                self.connection.execute("DROP INDEX IF EXISTS patients_location_state")
+                self.connection.execute("ALTER TABLE patients RENAME TO patients_by_id")
+            self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS locations (
+                location_id TEXT PRIMARY KEY,
+                updated_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS patients (
+                location_id TEXT,
+                patient_id TEXT,
+                state TEXT,
+                dhis2_reference TEXT,
+                error TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (location_id, patient_id)
+            );
+            CREATE INDEX IF NOT EXISTS patients_location_state ON patients (location_id, state);
+            CREATE INDEX IF NOT EXISTS patients_patient ON patients (patient_id);
+            CREATE TABLE IF NOT EXISTS encounters (
+                encounter_id INTEGER PRIMARY KEY,
+                patient_id TEXT,
+                location_id TEXT,
+                state TEXT,
+                dhis2_reference TEXT,
+                updated_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS encounters_patient ON encounters (patient_id);
+            CREATE INDEX IF NOT EXISTS encounters_location ON encounters (location_id);
+            """)
+            if migrate:
+                self.connection.execute(
+                    "INSERT INTO patients (location_id, patient_id, state, dhis2_reference, error, updated_at) "
+                    "SELECT location_id, patient_id, state, dhis2_reference, error, updated_at FROM patients_by_id"
+                )
+                self.connection.execute("DROP TABLE patients_by_id")
 
-    def _load_progress(self):
-        """Load the synchronization progress from a file."""
-        if os.path.exists(self.file_path):
-            with open(self.file_path, 'r') as file:
-                return json.load(file)
-        return {}
+    def _import_legacy_progress(self):
+        """Import a legacy progress.json next to the store, so its locations and patients still count as handled."""
+        legacy_path = os.path.splitext(self.file_path)[0] + '.json'
+        if legacy_path == self.file_path or not os.path.exists(legacy_path):
+            return
+        if self.connection.execute("SELECT 1 FROM locations LIMIT 1").fetchone():
+            return
+        with open(legacy_path, 'r') as file:
+            legacy_progress = json.load(file)
+        for location_id, patient_ids in legacy_progress.items():
+            # Older runs stored the last handled patient ID, later ones a list of them
+            if patient_ids is None:
+                patient_ids = []
+            elif not isinstance(patient_ids, list):
+                patient_ids = [patient_ids]
+            self._touch_location(location_id)
+            self.mark_patients(location_id, patient_ids, TRANSFORMED)
+
+    def _execute(self, query, params=()):
+        """Run a write in its own transaction."""
+        with self.lock, self.connection:
+            self.connection.execute(query, params)
+
+    def _executemany(self, query, rows):
+        """Run a batch of writes in one transaction."""
+        with self.lock, self.connection:
+            self.connection.executemany(query, rows)
+
+    def _touch_location(self, location_id):
+        """Record that a location has been handled."""
+        self._execute(
+            "INSERT INTO locations (location_id, updated_at) VALUES (?, ?) "
+            "ON CONFLICT (location_id) DO UPDATE SET updated_at = excluded.updated_at",
+            (str(location_id), _now())
+        )
 
     def reset_progress(self, location_id):
         """Reset the progress for a specific location."""
-        if location_id in self.progress_data:
-            del self.progress_data[location_id]
-            self._save_progress()
+        location_id = str(location_id)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM encounters WHERE location_id = ?", (location_id,))
+            self.connection.execute("DELETE FROM patients WHERE location_id = ?", (location_id,))
+            self.connection.execute("DELETE FROM locations WHERE location_id = ?", (location_id,))
 
     def update_progress(self, key, value, reset=False):
-        """Update the progress for a specific key."""
+        """Record patient `value` as transformed in location `key`, or reset the location."""
         if reset:
             self.reset_progress(key)
         else:
-            self.progress_data[key] = value
-        self._save_progress()
+            self.mark_patients(key, [value], TRANSFORMED)
+
+    def get_progress(self, key, staged=None):
+        """Get the IDs of the patients of location `key` a resume can skip, or None if it was never handled.
+
+        Those are the uploaded patients, and the transformed ones whose payload is still staged
+        for upload, as told by `staged`, a function returning the staged patients among a list of
+        patient IDs such as StagingStore.staged. Any other patient, e.g. one only extracted, or
+        transformed without `staged`, is processed again, as nothing durable holds its payload.
+        """
+        with self.lock:
+            if not self.connection.execute("SELECT 1 FROM locations WHERE location_id = ?", (str(key),)).fetchone():
+                return None
+            rows = self.connection.execute(
+                "SELECT patient_id, state FROM patients WHERE location_id = ? AND state IN (?, ?)", (str(key), UPLOADED, TRANSFORMED)
+            ).fetchall()
+        handled = [patient_id for patient_id, state in rows if state == UPLOADED]
+        transformed = [patient_id for patient_id, state in rows if state == TRANSFORMED]
+        if transformed and staged is not None:
+            handled.extend(staged(transformed))
+        return handled
+
+    def get_location_updated_at(self, location_id):
+        """Get when a location was last handled, as an ISO timestamp, or None if it never was."""
+        with self.lock:
+            row = self.connection.execute("SELECT updated_at FROM locations WHERE location_id = ?", (str(location_id),)).fetchone()
+        return row[0] if row else None
+
+    def mark_patients(self, location_id, patient_ids, state, error=None):
+        """Set the state of several patients of a location."""
+        self._touch_location(location_id)
+        now = _now()
+        self._executemany(
+            "INSERT INTO patients (location_id, patient_id, state, error, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (location_id, patient_id) DO UPDATE SET state = excluded.state, "
+            "error = excluded.error, updated_at = excluded.updated_at",
+            [(str(location_id), str(patient_id), state, error, now) for patient_id in patient_ids]
+        )
+
+    def mark_encounters(self, location_id, patient_id, encounter_ids, state, dhis2_reference=None):
+        """Set the state of several encounters of a patient."""
+        now = _now()
+        self._executemany(
+            "INSERT INTO encounters (encounter_id, patient_id, location_id, state, dhis2_reference, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (encounter_id) DO UPDATE SET patient_id = excluded.patient_id, location_id = excluded.location_id, "
+            "state = excluded.state, dhis2_reference = COALESCE(excluded.dhis2_reference, dhis2_reference), updated_at = excluded.updated_at",
+            [(int(encounter_id), str(patient_id), str(location_id), state, dhis2_reference, now) for encounter_id in encounter_ids]
+        )
+
+    def mark_patient_state(self, patient_id, state, dhis2_reference=None, error=None):
+        """Set the state of a patient and of its encounters, whatever its location, e.g. once it is uploaded."""
+        self.mark_patient_states([patient_id], state, dhis2_reference, error)
+
+    def mark_patient_states(self, patient_ids, state, dhis2_reference=None, error=None):
+        """Set the state of several patients and of their encounters in every location, in one transaction.
+
+        Used for upload results: a staged payload is the patient's, whichever location it was transformed in.
+        """
+        now = _now()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE patients SET state = ?, dhis2_reference = COALESCE(?, dhis2_reference), error = ?, updated_at = ? WHERE patient_id = ?",
+                [(state, dhis2_reference, error, now, str(patient_id)) for patient_id in patient_ids]
+            )
+            self.connection.executemany(
+                "UPDATE encounters SET state = ?, dhis2_reference = COALESCE(?, dhis2_reference), updated_at = ? WHERE patient_id = ?",
+                [(state, dhis2_reference, now, str(patient_id)) for patient_id in patient_ids]
+            )
+
+    def get_patient_state(self, patient_id, location_id=None):
+        """Get the (state, dhis2_reference) of a patient in a location, or in the location it was last handled in, or None if it was never handled."""
+        query, params = "SELECT state, dhis2_reference FROM patients WHERE patient_id = ?", [str(patient_id)]
+        if location_id is not None:
+            query += " AND location_id = ?"
+            params.append(str(location_id))
+        with self.lock:
+            return self.connection.execute(f"{query} ORDER BY updated_at DESC LIMIT 1", params).fetchone()
 
-    def _save_progress(self):
-        """Save the progress data to the file."""
-        with open(self.file_path, 'w') as file:
-            json.dump(self.progress_data, file, indent=4)
+    def get_patients(self, location_id, states):
+        """Get the IDs of the patients of a location in any of the given states."""
+        placeholder = ', '.join(['?'] * len(states))
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT patient_id FROM patients WHERE location_id = ? AND state IN ({placeholder})",
+                [str(location_id)] + list(states)
+            ).fetchall()
+        return {row[0] for row in rows}
 
-    def get_progress(self, key):
-        """Get the progress for a specific key."""
-        return self.progress_data.get(key)
+    def close(self):
+        """Close the checkpoint store."""
+        self.connection.close()
 
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import sqlite3
+import string
+import threading
+from datetime import datetime
+
+_UID_ALPHABET = string.ascii_letters + string.digits
+
+def dhis2_uid(*parts):
+    """Derive a stable DHIS2 UID, a letter followed by 10 letters or digits, from the given parts."""
+    number = int.from_bytes(hashlib.sha256(':'.join(str(part) for part in parts).encode()).digest(), 'big')
+    number, first = divmod(number, len(string.ascii_letters))
+    chars = [string.ascii_letters[first]]
+    for _ in range(10):
+        number, index = divmod(number, len(_UID_ALPHABET))
+        chars.append(_UID_ALPHABET[index])
+    return ''.join(chars)
+
+def payload_hash(payload):
+    """Hash a JSON payload independently of its key order."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str).encode()).hexdigest()
+
+class ReferenceIndex:
+    """Persistent index of the DHIS2 records the OpenMRS patients and encounters were synced to, backed by SQLite.
+
+    Maps patient UUIDs to tracked entity instance UIDs, tracked entity instances to their active
+    enrollment in each program and events to their enrollment, and remembers the hash of every
+    tracked entity instance and event payload DHIS2 accepted, so re-syncs update the same records
+    and skip the ones that did not change. Enrollments and events are indexed once DHIS2 accepted them.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+    def _create_tables(self):
+        """Create the index tables if they do not exist."""
+        with self.connection:
+            self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS tracked_entities (
+                patient_uuid TEXT PRIMARY KEY,
+                tracked_entity_instance TEXT,
+                payload_hash TEXT,
+                synced_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS tracked_entities_instance ON tracked_entities (tracked_entity_instance);
+            CREATE TABLE IF NOT EXISTS events (
+                event TEXT PRIMARY KEY,
+                tracked_entity_instance TEXT,
+                enrollment TEXT,
+                payload_hash TEXT,
+                synced_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS enrollments (
+                tracked_entity_instance TEXT,
+                program TEXT,
+                enrollment TEXT,
+                PRIMARY KEY (tracked_entity_instance, program)
+            );
+            """)
+            # Indexes created before the tracked entity payloads were hashed
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(tracked_entities)")]
+            if 'payload_hash' not in columns:
+                self.connection.execute("ALTER TABLE tracked_entities ADD COLUMN payload_hash TEXT")
+
+    def get_tracked_entity_instances(self, patient_uuids):
+        """Get a dict of patient UUID -> tracked entity instance UID for the indexed patients among `patient_uuids`."""
+        patient_uuids = list(patient_uuids)
+        references = {}
+        with self.lock:
+            # Stay well below SQLite's limit on the number of query parameters
+            for start in range(0, len(patient_uuids), 500):
+                chunk = patient_uuids[start:start + 500]
+                placeholder = ', '.join(['?'] * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT patient_uuid, tracked_entity_instance FROM tracked_entities WHERE patient_uuid IN ({placeholder})", chunk
+                ).fetchall()
+                references.update(rows)
+        return references
+
+    def set_tracked_entity_instances(self, references):
+        """Index a dict of patient UUID -> tracked entity instance UID."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO tracked_entities (patient_uuid, tracked_entity_instance) VALUES (?, ?) "
+                "ON CONFLICT (patient_uuid) DO UPDATE SET tracked_entity_instance = excluded.tracked_entity_instance",
+                list(references.items())
+            )
+
+    def get_enrollments(self, tracked_entity_instance):
+        """Get a dict of program -> UID of the active enrollment of a tracked entity instance in that program."""
+        with self.lock:
+            return dict(self.connection.execute(
+                "SELECT program, enrollment FROM enrollments WHERE tracked_entity_instance = ?", (tracked_entity_instance,)
+            ).fetchall())
+
+    def set_enrollments(self, enrollments):
+        """Index (tracked_entity_instance, program, enrollment) rows, replacing the enrollment known in the program."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO enrollments (tracked_entity_instance, program, enrollment) VALUES (?, ?, ?) "
+                "ON CONFLICT (tracked_entity_instance, program) DO UPDATE SET enrollment = excluded.enrollment",
+                [tuple(enrollment) for enrollment in enrollments]
+            )
+
+    def get_event_enrollments(self, event_uids):
+        """Get a dict of event UID -> enrollment UID for the indexed events among `event_uids`."""
+        event_uids = list(event_uids)
+        enrollments = {}
+        with self.lock:
+            for start in range(0, len(event_uids), 500):
+                chunk = event_uids[start:start + 500]
+                placeholder = ', '.join(['?'] * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT event, enrollment FROM events WHERE event IN ({placeholder}) AND enrollment IS NOT NULL", chunk
+                ).fetchall()
+                enrollments.update(rows)
+        return enrollments
+
+    def get_synced_tracked_entity_hash(self, tracked_entity_instance):
+        """Get the hash of the tracked entity instance payload last accepted by DHIS2, or None if it was never synced."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT payload_hash FROM tracked_entities WHERE tracked_entity_instance = ? AND synced_at IS NOT NULL", (tracked_entity_instance,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_synced_event_hashes(self, event_uids):
+        """Get a dict of event UID -> hash of the payload last accepted by DHIS2, for the synced events among `event_uids`."""
+        event_uids = list(event_uids)
+        hashes = {}
+        with self.lock:
+            for start in range(0, len(event_uids), 500):
+                chunk = event_uids[start:start + 500]
+                placeholder = ', '.join(['?'] * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT event, payload_hash FROM events WHERE event IN ({placeholder}) AND payload_hash IS NOT NULL", chunk
+                ).fetchall()
+                hashes.update(rows)
+        return hashes
+
+    def mark_synced(self, tracked_entity_instance, event_hashes, tracked_entity_hash=None, enrollments=None, event_enrollments=None):
+        """Record that DHIS2 accepted a tracked entity instance and the events of a dict of event UID -> payload hash.
+
+        `tracked_entity_hash` is the hash of the tracked entity instance payload, when it was sent,
+        `enrollments` a dict of program -> enrollment UID of the enrollments sent with it and
+        `event_enrollments` a dict of event UID -> enrollment UID of the events.
+        """
+        now = _now()
+        event_enrollments = event_enrollments or {}
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE tracked_entities SET payload_hash = COALESCE(?, payload_hash), synced_at = ? WHERE tracked_entity_instance = ?",
+                (tracked_entity_hash, now, tracked_entity_instance)
+            )
+            self.connection.executemany(
+                "INSERT INTO enrollments (tracked_entity_instance, program, enrollment) VALUES (?, ?, ?) "
+                "ON CONFLICT (tracked_entity_instance, program) DO UPDATE SET enrollment = excluded.enrollment",
+                [(tracked_entity_instance, program, enrollment) for program, enrollment in (enrollments or {}).items()]
+            )
+            self.connection.executemany(
+                "INSERT INTO events (event, tracked_entity_instance, enrollment, payload_hash, synced_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (event) DO UPDATE SET enrollment = COALESCE(excluded.enrollment, enrollment), "
+                "payload_hash = excluded.payload_hash, synced_at = excluded.synced_at",
+                [(event_uid, tracked_entity_instance, event_enrollments.get(event_uid), event_hash, now) for event_uid, event_hash in event_hashes.items()]
+            )
+
+    def close(self):
+        """Close the index."""
+        self.connection.close()
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
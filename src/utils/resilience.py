@@ -0,0 +1,123 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+class CircuitOpenError(Exception):
+    """Raised when a call is refused because the circuit breaker is open."""
+
+class AdaptiveRateLimiter:
+    """Token bucket limiting the request rate, adapting the rate to how the server copes.
+
+    The rate grows by about one request per second every second while responses are faster than
+    `target_latency`, is cut by 10% for every slower response and halved when the server throttles
+    (429 or 503), the way TCP congestion control probes for the capacity of a link.
+    """
+
+    def __init__(self, rate=10, min_rate=0.5, max_rate=50, target_latency=2.0):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.target_latency = target_latency
+        self.tokens = 1.0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be sent. Callers queue up fairly: each reserves the next token."""
+        with self.lock:
+            now = time.monotonic()
+            # At most one second worth of requests can be sent in a burst
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def record(self, latency, throttled=False):
+        """Adapt the rate to the latency of a response, or to the server throttling the client."""
+        with self.lock:
+            if throttled:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0.0)
+                logging.warning(f"DHIS2 is throttling requests, lowering the rate to {self.rate:.2f} requests/s.")
+            elif latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            else:
+                self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+
+class CircuitBreaker:
+    """Stop calling a server that keeps failing, and probe it again after a cool-down.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls are refused for
+    `reset_timeout` seconds. Then a single probe call is let through: the circuit closes again if
+    it succeeds and re-opens if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        """Return whether a call may be made now."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                logging.info("Probing DHIS2 after the circuit breaker cool-down.")
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds until the circuit lets a call through again."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            if self.state == self.HALF_OPEN:
+                # Wait a little for the probe in flight to settle the state
+                return 1.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logging.info("DHIS2 is healthy again, closing the circuit breaker.")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                logging.error(f"DHIS2 failed {self.failures} calls in a row, pausing calls for {self.reset_timeout} seconds.")
+
+def backoff_delay(attempt, base=1.0, maximum=60.0):
+    """Exponential backoff with full jitter: a random delay of up to base * 2^attempt seconds."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header, given in seconds or as an HTTP date. Returns None if it is missing or invalid."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
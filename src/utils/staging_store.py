@@ -0,0 +1,169 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+from utils.progress_tracker import UPLOADED, FAILED
+
+# Upload statuses of a staged payload, besides UPLOADED and FAILED; rejected payloads failed validation and are not retried
+PENDING = 'pending'
+REJECTED = 'rejected'
+
+class StagingStore:
+    """Transformed patient payloads waiting to be uploaded to DHIS2, with their upload status, backed by SQLite.
+
+    Replaces the one pretty-printed JSON file per patient of the patients_to_sync directory:
+    payloads are stored as compact, optionally zlib-compressed JSON rows, looked up by status
+    through an index and read back in batches, in the order they were staged.
+    """
+
+    def __init__(self, file_path, compress=True):
+        self.file_path = file_path
+        self.compress = compress
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS staged_patients (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id TEXT UNIQUE,
+                payload BLOB,
+                compressed INTEGER,
+                status TEXT,
+                dhis2_reference TEXT,
+                error TEXT,
+                updated_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS staged_patients_status ON staged_patients (status, id);
+            """)
+
+    def _encode(self, payload):
+        data = json.dumps(payload, separators=(',', ':')).encode()
+        return zlib.compress(data) if self.compress else data
+
+    @staticmethod
+    def _decode(data, compressed):
+        return json.loads(zlib.decompress(data) if compressed else data)
+
+    def stage(self, patient_id, payload):
+        """Stage the payload of a patient for upload, replacing the one staged before."""
+        self.stage_many([(patient_id, payload)])
+
+    def stage_many(self, patients):
+        """Stage the payloads of an iterable of (patient_id, payload) pairs in one transaction."""
+        now = _now()
+        rows = [(str(patient_id), self._encode(payload), int(self.compress), PENDING, now) for patient_id, payload in patients]
+        with self.lock, self.connection:
+            # Restaging moves a patient to the end of the queue, like rewriting its file did
+            self.connection.executemany("DELETE FROM staged_patients WHERE patient_id = ?", [row[:1] for row in rows])
+            self.connection.executemany(
+                "INSERT INTO staged_patients (patient_id, payload, compressed, status, updated_at) VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def mark(self, patient_id, status, dhis2_reference=None, error=None):
+        """Set the upload status of a staged patient."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE staged_patients SET status = ?, dhis2_reference = COALESCE(?, dhis2_reference), error = ?, updated_at = ? WHERE patient_id = ?",
+                (status, dhis2_reference, error, _now(), str(patient_id))
+            )
+
+    def count(self, statuses=(PENDING, FAILED)):
+        """Count the staged patients in any of the given statuses."""
+        placeholder = ', '.join(['?'] * len(statuses))
+        with self.lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM staged_patients WHERE status IN ({placeholder})", list(statuses)).fetchone()[0]
+
+    def staged(self, patient_ids, statuses=(PENDING, FAILED)):
+        """Return the set of the patients among `patient_ids` staged in any of the given statuses."""
+        patient_ids = [str(patient_id) for patient_id in patient_ids]
+        placeholder = ', '.join(['?'] * len(statuses))
+        staged = set()
+        with self.lock:
+            # Stay well below SQLite's limit on the number of query parameters
+            for start in range(0, len(patient_ids), 500):
+                chunk = patient_ids[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT patient_id FROM staged_patients WHERE patient_id IN ({', '.join(['?'] * len(chunk))}) AND status IN ({placeholder})",
+                    chunk + list(statuses)
+                ).fetchall()
+                staged.update(row[0] for row in rows)
+        return staged
+
+    def iter_batches(self, batch_size=100, statuses=(PENDING, FAILED)):
+        """Yield lists of up to `batch_size` (patient_id, payload) pairs in the given statuses, in staging order.
+
+        Only one batch is held in memory, and marking the yielded patients while iterating is safe.
+        """
+        placeholder = ', '.join(['?'] * len(statuses))
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT id, patient_id, payload, compressed FROM staged_patients WHERE status IN ({placeholder}) AND id > ? ORDER BY id LIMIT ?",
+                    list(statuses) + [last_id, batch_size]
+                ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [(patient_id, self._decode(payload, compressed)) for _, patient_id, payload, compressed in rows]
+
+    def clear(self, statuses=(PENDING, FAILED)):
+        """Drop the staged patients in any of the given statuses. Returns the IDs of the patients dropped."""
+        placeholder = ', '.join(['?'] * len(statuses))
+        with self.lock, self.connection:
+            rows = self.connection.execute(f"SELECT patient_id FROM staged_patients WHERE status IN ({placeholder})", list(statuses)).fetchall()
+            self.connection.execute(f"DELETE FROM staged_patients WHERE status IN ({placeholder})", list(statuses))
+        return [row[0] for row in rows]
+
+    def import_directory(self, directory):
+        """Move the payload files of the legacy patients_to_sync layout, named {patient_id}.json, into the store.
+
+        Files already uploaded, renamed {entity_id}_{patient_id}.json, are left in place. Returns
+        the number of patients imported.
+        """
+        if not os.path.isdir(directory):
+            return 0
+        filenames = sorted(
+            (filename for filename in os.listdir(directory) if filename.endswith('.json') and filename[:-len('.json')].isdigit()),
+            key=lambda filename: os.path.getctime(os.path.join(directory, filename))
+        )
+        for filename in filenames:
+            file_path = os.path.join(directory, filename)
+            with open(file_path, 'r') as file:
+                self.stage(filename[:-len('.json')], json.load(file))
+            os.remove(file_path)
+        return len(filenames)
+
+    def export_directory(self, directory, statuses=(PENDING, FAILED)):
+        """Write the staged patients in the given statuses to the patients_to_sync file layout.
+
+        Each payload goes to {patient_id}.json, or to {entity_id}_{patient_id}.json once uploaded,
+        so the directory can still be uploaded by DHIS2Connector.process_patient_files. Returns the
+        number of files written.
+        """
+        os.makedirs(directory, exist_ok=True)
+        placeholder = ', '.join(['?'] * len(statuses))
+        with self.lock:
+            references = dict(self.connection.execute(
+                f"SELECT patient_id, dhis2_reference FROM staged_patients WHERE status IN ({placeholder}) AND status = ?", list(statuses) + [UPLOADED]
+            ).fetchall())
+        exported = 0
+        for batch in self.iter_batches(statuses=statuses):
+            for patient_id, payload in batch:
+                filename = f"{references[patient_id]}_{patient_id}.json" if references.get(patient_id) else f"{patient_id}.json"
+                with open(os.path.join(directory, filename), 'w') as file:
+                    json.dump(payload, file, indent=4)
+                exported += 1
+        return exported
+
+    def close(self):
+        """Close the staging store."""
+        self.connection.close()
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
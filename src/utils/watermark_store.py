@@ -0,0 +1,43 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+class WatermarkStore:
+    """Per-location high-water marks of the last successful sync, used by delta runs."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.watermarks = self._load_watermarks()
+
+    def _load_watermarks(self):
+        """Load the watermarks from a file."""
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'r') as file:
+                return json.load(file)
+        return {}
+
+    def get_watermark(self, location_id):
+        """Get the watermark of a location as a datetime, or None if it was never synced."""
+        watermark = self.watermarks.get(str(location_id))
+        return datetime.fromisoformat(watermark) if watermark else None
+
+    def set_watermark(self, location_id, watermark):
+        """Set the watermark of a location and save it."""
+        with self.lock:
+            self.watermarks[str(location_id)] = watermark.isoformat()
+            self._save_watermarks()
+
+    def reset_watermark(self, location_id):
+        """Forget the watermark of a location so that its next run is a full one."""
+        with self.lock:
+            if self.watermarks.pop(str(location_id), None) is not None:
+                self._save_watermarks()
+
+    def _save_watermarks(self):
+        """Save the watermarks, replacing the file atomically so a crash cannot corrupt it."""
+        temp_path = f"{self.file_path}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(self.watermarks, file, indent=4)
+        os.replace(temp_path, self.file_path)
@@ -0,0 +1,37 @@
+import os
+import sys
+import pytest
+
+# The application modules are imported from src/, as when running python src/main.py, and the offline benchmark's fakes from benchmarks/
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(1, os.path.join(ROOT, 'benchmarks'))
+
+from dhis2_stub import DHIS2Stub
+from run_benchmarks import copy_mappings
+from synthetic_openmrs import SyntheticDataset, SyntheticOpenMRSConnector
+from services.sync_service import SyncService
+
+@pytest.fixture
+def dhis2_stub():
+    stub = DHIS2Stub().start()
+    yield stub
+    stub.stop()
+
+@pytest.fixture
+def dataset():
+    return SyntheticDataset(patients=30, encounters_per_patient=2, obs_per_encounter=5)
+
+@pytest.fixture
+def sync_service(tmp_path, dhis2_stub, dataset):
+    """A SyncService whose stores live in tmp_path, extracting from `dataset` and uploading to `dhis2_stub`."""
+    dhis2_config = {'base_url': dhis2_stub.url, 'username': 'admin', 'password': 'district', 'rate_limit': 1000, 'max_rate_limit': 1000, 'backoff_base': 0.01}
+    sync_service = SyncService(
+        {'host': 'synthetic', 'user': '', 'password': '', 'database': ''}, dhis2_config, str(tmp_path / 'progress.db'),
+        reference_index_file=str(tmp_path / 'references.db'), staging_file=str(tmp_path / 'staging.db'),
+        mappings_dir=copy_mappings(str(tmp_path)), dead_letter_file=str(tmp_path / 'dead_letters.db')
+    )
+    # The mapped concepts of the form go first, so every encounter has observations to sync
+    dataset.concept_uuids = list(sync_service.load_form_mappings(dataset.form_id).observations) + dataset.concept_uuids
+    sync_service.openmrs_connector = SyntheticOpenMRSConnector(dataset, metadata=sync_service.openmrs_connector.metadata)
+    return sync_service
@@ -0,0 +1,100 @@
+import sqlite3
+import zlib
+import pytest
+import requests
+from utils.dead_letter_store import DeadLetterStore, EXTRACT, TRANSFORM, UPLOAD, VALIDATION, STAGES, error_class, error_priority
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} error", response=response)
+
+@pytest.fixture
+def store(tmp_path):
+    store = DeadLetterStore(str(tmp_path / 'dead_letters.db'))
+    yield store
+    store.close()
+
+def test_error_class_and_priority():
+    assert error_class(ConnectionError('down')) == 'ConnectionError'
+    assert error_class(None) == 'ImportRejected'
+    assert error_priority(ConnectionError('down')) == 0
+    assert error_priority(http_error(503)) == 0
+    assert error_priority(http_error(429)) == 0
+    assert error_priority(http_error(409)) == 2
+    assert error_priority(None) == 2
+    assert error_priority(RuntimeError('unexpected')) == 1
+
+def test_add_many_counts_attempts_per_patient_and_stage(store):
+    store.add_many([(1, {'encounter_ids': [10]}), (2, {'encounter_ids': [20]})], EXTRACT, ConnectionError('down'), location_id=268)
+    store.add(1, EXTRACT, {'encounter_ids': [10, 11]}, ConnectionError('down again'))
+    store.add(1, UPLOAD, {'orgUnit': 'OrgUnit0001'}, None)
+    assert store.summary() == [(EXTRACT, 'ConnectionError', 2, 2), (UPLOAD, 'ImportRejected', 1, 1)]
+    assert store.count(max_attempts=2) == 2
+    assert store.count(stages=[EXTRACT], error_classes=['ConnectionError']) == 2
+
+def test_iter_batches_orders_by_priority_and_keeps_the_location(store):
+    store.add(1, VALIDATION, {'payload': 1}, ValueError('invalid'))
+    store.add(2, UPLOAD, {'payload': 2}, RuntimeError('unexpected'))
+    store.add(3, EXTRACT, {'encounter_ids': [30]}, ConnectionError('down'), location_id=268)
+    batches = list(store.iter_batches(batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert [entry for batch in batches for entry in batch] == [
+        ('3', EXTRACT, '268', {'encounter_ids': [30]}, ''),
+        ('2', UPLOAD, None, {'payload': 2}, ''),
+        ('1', VALIDATION, None, {'payload': 1}, '')
+    ]
+
+def test_iter_batches_filters(store):
+    store.add(1, UPLOAD, {}, ConnectionError('down'))
+    store.add(2, UPLOAD, {}, ValueError('invalid'))
+    store.add(3, TRANSFORM, {'encounter_ids': []}, ConnectionError('down'))
+    entries = [entry[0] for batch in store.iter_batches(stages=[UPLOAD], error_classes=['ConnectionError']) for entry in batch]
+    assert entries == ['1']
+
+def test_resolve_deletes_only_the_given_stages(store, tmp_path):
+    store.add(1, EXTRACT, {'encounter_ids': [10]}, ConnectionError('down'))
+    store.add(1, UPLOAD, {}, None)
+    store.add(2, UPLOAD, {}, None)
+    store.resolve([1, 3], (EXTRACT, TRANSFORM))
+    assert store.summary() == [(UPLOAD, 'ImportRejected', 2, 1)]
+    store.resolve([1, 2], STAGES)
+    assert store.summary() == []
+    assert store.patient_ids == set()
+    # Resolved dead letters stay resolved when the store is reopened
+    assert DeadLetterStore(store.file_path).count() == 0
+
+def test_records_are_kept_and_resolved_on_their_own(store):
+    store.add(1, VALIDATION, {'event': 'Event000001'}, ValueError('invalid'), record='Event000001')
+    store.add(1, VALIDATION, {'event': 'Event000002'}, ValueError('invalid'), record='Event000002')
+    store.add(1, VALIDATION, {'payload': 1}, ValueError('invalid'))
+    assert store.count(stages=[VALIDATION]) == 3
+    # Resolving the patient leaves the dead letters of its records
+    store.resolve([1], STAGES)
+    assert [entry[4] for batch in store.iter_batches() for entry in batch] == ['Event000001', 'Event000002']
+    store.resolve_records(1, VALIDATION, ['Event000001'])
+    assert [entry[4] for batch in store.iter_batches() for entry in batch] == ['Event000002']
+    store.resolve_records(1, VALIDATION, ['Event000002'])
+    assert store.patient_ids == set()
+
+def test_store_of_one_dead_letter_per_patient_and_stage_is_migrated(tmp_path):
+    file_path = str(tmp_path / 'dead_letters.db')
+    connection = sqlite3.connect(file_path)
+    connection.executescript("""
+    CREATE TABLE dead_letters (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, patient_id TEXT, stage TEXT, location_id TEXT, payload BLOB, error_class TEXT, error TEXT,
+        priority INTEGER, attempts INTEGER, first_failed_at TEXT, last_failed_at TEXT, UNIQUE (patient_id, stage)
+    );
+    CREATE INDEX dead_letters_priority ON dead_letters (priority, id);
+    """)
+    connection.execute(
+        "INSERT INTO dead_letters (patient_id, stage, location_id, payload, error_class, error, priority, attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        ('1', UPLOAD, '268', zlib.compress(b'{"payload":1}'), 'ConnectionError', 'down', 0, 2)
+    )
+    connection.commit()
+    connection.close()
+    store = DeadLetterStore(file_path)
+    assert [entry for batch in store.iter_batches() for entry in batch] == [('1', UPLOAD, '268', {'payload': 1}, '')]
+    store.add(1, UPLOAD, {'payload': 1}, ConnectionError('down'))
+    assert store.summary() == [(UPLOAD, 'ConnectionError', 1, 3)]
+    store.close()
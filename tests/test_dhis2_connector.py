@@ -0,0 +1,145 @@
+import pytest
+import requests
+from connectors.dhis2_connector import DHIS2Connector
+from services.validation_service import ValidationService
+from utils.dead_letter_store import DeadLetterStore, UPLOAD, VALIDATION
+from utils.progress_tracker import ProgressTracker, TRANSFORMED, UPLOADED
+from utils.staging_store import StagingStore
+
+def connector(url, **options):
+    return DHIS2Connector(url, 'admin', 'district', rate_limit=1000, max_rate_limit=1000, backoff_base=0.01, **options)
+
+def payload(patient_id, events=1):
+    return {
+        "trackedEntityType": "j9TllKXZ3jb",
+        "orgUnit": "ou",
+        "attributes": [{"attribute": "name", "value": f"patient {patient_id}"}],
+        "enrollments": [{
+            "program": "program",
+            "enrollmentDate": "2024-01-01",
+            "incidentDate": "2024-01-01",
+            "events": [{"programStage": "stage", "eventDate": "2024-01-01", "dataValues": [{"dataElement": "weight", "value": index}]} for index in range(events)]
+        }]
+    }
+
+def test_upload_patient_posts_the_tracked_entity_instance_with_its_events(dhis2_stub):
+    assert connector(dhis2_stub.url).upload_patient(payload(1, events=2)) == 'stub0000000'
+    assert dhis2_stub.counts['POST /trackedEntityInstances'] == 1
+    assert dhis2_stub.counts['events received'] == 2
+
+def test_process_staged_patients_uploads_and_records_every_patient(dhis2_stub, tmp_path):
+    dhis2_connector = connector(dhis2_stub.url, max_workers=3)
+    dhis2_connector.progress_tracker = ProgressTracker(str(tmp_path / 'progress.db'))
+    dhis2_connector.progress_tracker.mark_patients(268, range(7), TRANSFORMED)
+    staging_store = StagingStore(str(tmp_path / 'staging.db'))
+    staging_store.stage_many((patient_id, payload(patient_id)) for patient_id in range(7))
+    assert dhis2_connector.process_staged_patients(staging_store) == 7
+    assert dhis2_stub.counts['POST /trackedEntityInstances'] == 7
+    assert staging_store.count() == 0
+    assert dhis2_connector.progress_tracker.get_patients(268, [UPLOADED]) == {str(patient_id) for patient_id in range(7)}
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {}
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+class FakeSession:
+    """A session answering every POST with the next of `responses`, and keeping the posted bodies."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.posted = []
+
+    def post(self, url, json=None, timeout=None):
+        self.posted.append(json)
+        return self.responses.pop(0)
+
+def summaries(*statuses, http_status=200):
+    return FakeResponse(http_status, {'response': {'importSummaries': list(statuses)}})
+
+def test_bulk_import_attributes_every_summary_to_its_patient():
+    dhis2_connector = connector('http://dhis2')
+    dhis2_connector.session = FakeSession([summaries(
+        {'status': 'SUCCESS', 'reference': 'A'},
+        {'status': 'ERROR', 'reference': 'B', 'conflicts': [{'object': 'attribute', 'value': 'invalid'}]},
+        {'status': 'SUCCESS', 'reference': 'C', 'enrollments': {'importSummaries': [
+            {'status': 'SUCCESS', 'events': {'importSummaries': [{'status': 'ERROR', 'description': 'invalid event'}]}}
+        ]}},
+        http_status=409
+    )])
+    assert dhis2_connector.upload_patients_bulk([payload(1), payload(2), payload(3)]) == ['A', None, None]
+    assert len(dhis2_connector.session.posted[0]['trackedEntityInstances']) == 3
+
+def test_bulk_import_refuses_a_response_missing_summaries():
+    dhis2_connector = connector('http://dhis2')
+    dhis2_connector.session = FakeSession([summaries({'status': 'SUCCESS', 'reference': 'A'})])
+    with pytest.raises(ValueError, match='Expected 2 import summaries'):
+        dhis2_connector.upload_patients_bulk([payload(1), payload(2)])
+
+def test_bulk_upload_of_staged_patients_records_each_result(tmp_path):
+    dhis2_connector = connector('http://dhis2', import_mode='bulk', batch_size=2)
+    dhis2_connector.dead_letters = DeadLetterStore(str(tmp_path / 'dead_letters.db'))
+    dhis2_connector.session = FakeSession([
+        summaries({'status': 'SUCCESS', 'reference': 'A'}, {'status': 'ERROR', 'description': 'refused'}, http_status=409),
+        summaries({'status': 'SUCCESS', 'reference': 'C'})
+    ])
+    staging_store = StagingStore(str(tmp_path / 'staging.db'))
+    staging_store.stage_many((patient_id, payload(patient_id)) for patient_id in (1, 2, 3))
+    assert dhis2_connector.process_staged_patients(staging_store, max_workers=1) == 2
+    assert [patient_id for batch in staging_store.iter_batches() for patient_id, _ in batch] == ['2']
+    assert dhis2_connector.dead_letters.summary() == [(UPLOAD, 'ImportRejected', 1, 1)]
+
+# The metadata of `payload`: its weight is a number
+SNAPSHOT = {
+    'trackedEntityType': {'id': 'j9TllKXZ3jb', 'trackedEntityTypeAttributes': [{'trackedEntityAttribute': {'id': 'name', 'valueType': 'TEXT'}}]},
+    'programs': [{
+        'id': 'program', 'organisationUnits': [{'id': 'ou'}],
+        'programStages': [{'id': 'stage', 'programStageDataElements': [{'dataElement': {'id': 'weight', 'valueType': 'NUMBER'}}]}]
+    }]
+}
+
+def validated_connector(dhis2_stub, tmp_path):
+    dhis2_connector = connector(dhis2_stub.url)
+    dhis2_connector.validator = ValidationService(SNAPSHOT)
+    dhis2_connector.dead_letters = DeadLetterStore(str(tmp_path / 'dead_letters.db'))
+    return dhis2_connector
+
+def payload_with_invalid_event():
+    data = dict(payload(1, events=2), trackedEntityInstance='Instance001')
+    data['enrollments'][0]['enrollment'] = 'Enrollment1'
+    for index, event in enumerate(data['enrollments'][0]['events']):
+        event['event'] = f"Event00000{index}"
+    data['enrollments'][0]['events'][1]['dataValues'][0]['value'] = 'heavy'
+    return data
+
+def test_events_dropped_by_validation_are_dead_letters_of_their_own(dhis2_stub, tmp_path):
+    dhis2_connector = validated_connector(dhis2_stub, tmp_path)
+    staging_store = StagingStore(str(tmp_path / 'staging.db'))
+    staging_store.stage_many([(1, payload_with_invalid_event())])
+    assert dhis2_connector.process_staged_patients(staging_store) == 1
+    assert dhis2_stub.counts['events received'] == 1
+    # The upload of the rest of the patient does not resolve the dropped event
+    (entry,), = dhis2_connector.dead_letters.iter_batches()
+    patient_id, stage, _, event, record = entry
+    assert (patient_id, stage, record) == ('1', VALIDATION, 'Event000001')
+    assert (event['enrollment'], event['trackedEntityInstance'], event['dataValues']) == ('Enrollment1', 'Instance001', [{'dataElement': 'weight', 'value': 'heavy'}])
+
+def test_rejected_events_are_uploaded_once_fixed(dhis2_stub, tmp_path):
+    dhis2_connector = validated_connector(dhis2_stub, tmp_path)
+    dhis2_connector.reject_invalid([(1, payload_with_invalid_event())])
+    (entry,), = dhis2_connector.dead_letters.iter_batches()
+    event = entry[3]
+    assert dhis2_connector.upload_rejected_events([(1, event)]) == 0
+    assert dhis2_connector.dead_letters.summary() == [(VALIDATION, 'ValueError', 1, 2)]
+    event['dataValues'][0]['value'] = 80
+    assert dhis2_connector.upload_rejected_events([(1, event)]) == 1
+    assert dhis2_stub.counts['POST /events'] == 1
+    assert dhis2_connector.dead_letters.count() == 0
@@ -0,0 +1,76 @@
+import json
+import os
+import time
+import pytest
+from config.mappings import MappingRegistry
+
+def write_json(path, data):
+    with open(path, 'w') as file:
+        json.dump(data, file)
+
+@pytest.fixture
+def mappings_dir(tmp_path):
+    os.makedirs(tmp_path / 'forms')
+    write_json(tmp_path / 'attribute_mappings.json', {})
+    write_json(tmp_path / 'location_mappings.json', {'268': 'OrgUnit0001'})
+    write_json(tmp_path / 'province_mappings.json', {})
+    write_json(tmp_path / 'district_mappings.json', {})
+    write_json(tmp_path / 'forms' / 'form_197_mappings.json', {
+        'dhis2_program_id': 'Program0001', 'dhis2_program_stage_id': 'Stage000001', 'observations': {'concept-1': 'Element0001'}
+    })
+    return str(tmp_path)
+
+def touch_later(path):
+    """Move the mtime of a file forward, so the change is seen whatever the file system's mtime resolution."""
+    later = time.time() + 10
+    os.utime(path, (later, later))
+
+def test_reload_if_changed_picks_up_edits(mappings_dir):
+    registry = MappingRegistry(mappings_dir, check_interval=0)
+    assert registry.get_org_unit_id('268') == 'OrgUnit0001'
+    path = os.path.join(mappings_dir, 'location_mappings.json')
+    write_json(path, {'268': 'OrgUnit0002'})
+    touch_later(path)
+    assert registry.get_org_unit_id('268') == 'OrgUnit0002'
+
+def test_reload_if_changed_keeps_mappings_of_a_broken_file(mappings_dir, caplog):
+    registry = MappingRegistry(mappings_dir, check_interval=0)
+    path = os.path.join(mappings_dir, 'location_mappings.json')
+    with open(path, 'w') as file:
+        file.write('{"268": "OrgUnit00')
+    touch_later(path)
+    assert registry.get_org_unit_id('268') == 'OrgUnit0001'
+    assert registry.get_form(197).program_id == 'Program0001'
+    # The broken file is not reloaded again until it changes
+    caplog.clear()
+    assert registry.get_org_unit_id('268') == 'OrgUnit0001'
+    assert 'Cannot reload' not in caplog.text
+
+def test_reload_if_changed_waits_for_the_check_interval(mappings_dir):
+    registry = MappingRegistry(mappings_dir, check_interval=3600)
+    path = os.path.join(mappings_dir, 'location_mappings.json')
+    write_json(path, {'268': 'OrgUnit0002'})
+    touch_later(path)
+    assert registry.get_org_unit_id('268') == 'OrgUnit0001'
+
+def test_invalid_form_mapping_is_skipped(mappings_dir):
+    write_json(os.path.join(mappings_dir, 'forms', 'form_2_mappings.json'), {'observations': {}})
+    registry = MappingRegistry(mappings_dir)
+    assert registry.get_form(2) is None
+    assert registry.mapped_concept_uuids() == frozenset({'concept-1'})
+
+def test_the_shipped_mappings_load():
+    registry = MappingRegistry(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mappings'))
+    assert registry.get_form(197) is not None
+    assert registry.district_mappings
+
+def test_the_misspelled_district_file_is_still_read(mappings_dir, caplog):
+    os.rename(os.path.join(mappings_dir, 'district_mappings.json'), os.path.join(mappings_dir, 'distric_mappings.json'))
+    registry = MappingRegistry(mappings_dir, check_interval=0)
+    assert 'deprecated' in caplog.text
+    assert registry.get_org_unit_id('268') == 'OrgUnit0001'
+
+def test_a_missing_mapping_file_fails_at_startup(mappings_dir):
+    os.remove(os.path.join(mappings_dir, 'district_mappings.json'))
+    with pytest.raises(Exception, match='Mapping file not found'):
+        MappingRegistry(mappings_dir)
@@ -0,0 +1,36 @@
+import pytest
+from utils.metrics import Metrics
+
+def test_timer_counts_errors_in_the_matching_counter():
+    metrics = Metrics()
+    with metrics.timer('openmrs_query_seconds', query='patients'):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer('openmrs_query_seconds', query='patients'):
+            raise ValueError
+    labels = (('query', 'patients'),)
+    assert metrics.histograms[('openmrs_query_seconds', labels)].count == 2
+    assert metrics.counters[('openmrs_query_errors_total', labels)] == 1
+
+def test_drain_resets_and_merge_adds_the_drained_metrics():
+    worker, parent = Metrics(), Metrics()
+    worker.increment('patients_total', 3)
+    worker.observe('upload_seconds', 0.2)
+    parent.increment('patients_total', 2)
+    parent.observe('upload_seconds', 0.4)
+    parent.merge(worker.drain())
+    assert worker.counters == {} and worker.histograms == {}
+    assert parent.counters[('patients_total', ())] == 5
+    histogram = parent.histograms[('upload_seconds', ())]
+    assert histogram.count == 2 and histogram.sum == pytest.approx(0.6)
+
+def test_to_prometheus_renders_cumulative_buckets_and_escaped_labels():
+    metrics = Metrics()
+    metrics.observe('upload_seconds', 0.003)
+    metrics.increment('failures_total', stage='a "b"')
+    text = metrics.to_prometheus()
+    assert '# TYPE upload_seconds histogram' in text
+    assert 'upload_seconds_bucket{le="0.0025"} 0' in text
+    assert 'upload_seconds_bucket{le="0.005"} 1' in text
+    assert 'upload_seconds_bucket{le="+Inf"} 1' in text
+    assert 'failures_total{stage="a \\"b\\""} 1' in text
@@ -0,0 +1,153 @@
+import datetime
+import mysql.connector
+import pytest
+from connectors.openmrs_connector import OpenMRSConnector, OpenMRSMetadata, VALUE_READERS
+
+ENCOUNTERS = {10: (197, datetime.datetime(2024, 1, 1)), 11: (197, datetime.datetime(2024, 1, 2))}
+# (encounter_id, obs_id, concept_id, value_numeric, value_coded, value_text, value_datetime)
+OBS = [(10, 100, 1, 120.0, None, None, None), (10, 101, 2, None, None, b'note', None), (11, 110, 1, 7.5, None, None, None)]
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, query, params=()):
+        self.connection.queries.append(query)
+        params = list(params)
+        if 'FROM encounter e' in query:
+            self.rows = [(1, 10), (1, 11), (2, 12)]
+        elif 'FROM encounter' in query:
+            self.rows = [(encounter_id,) + ENCOUNTERS[encounter_id] for encounter_id in params if encounter_id in ENCOUNTERS]
+        elif 'FROM obs' in query:
+            self.rows = [row for row in OBS if row[0] in params and row[2] in params[-len(self.connection.concept_ids):]]
+        else:
+            self.rows = []
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, pool=None, connected=True):
+        self.pool = pool
+        self.connected = connected
+        self.queries = []
+        self.concept_ids = (1, 2)
+
+    def cursor(self, **cursor_args):
+        return FakeCursor(self)
+
+    def ping(self, **kwargs):
+        pass
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.free += 1
+            self.pool.idle.append(self)
+
+class FakePool:
+    """A pool of `size` connections, refusing checkouts beyond them as MySQLConnectionPool does."""
+
+    def __init__(self, size):
+        self.pool_size = self.free = size
+        self.idle = []
+
+    def get_connection(self):
+        if not self.free:
+            raise mysql.connector.PoolError("Failed getting connection; pool exhausted")
+        self.free -= 1
+        return self.idle.pop() if self.idle else FakeConnection(self)
+
+    def add_connection(self):
+        raise mysql.connector.PoolError("Failed adding connection; queue is full")
+
+def metadata():
+    metadata = OpenMRSMetadata(frozenset({'concept-1', 'concept-2'}))
+    metadata.concepts = {1: ('concept-1', VALUE_READERS['NM']), 2: ('concept-2', VALUE_READERS['ST'])}
+    metadata.loaded = True
+    return metadata
+
+def connector(pool):
+    return OpenMRSConnector('host', 'user', 'password', 'openmrs', pool=pool, checkout_timeout=0.1, metadata=metadata())
+
+def test_stream_groups_encounters_by_patient_and_raises_when_cut_off():
+    openmrs_connector = connector(FakePool(1))
+    stream_connection = FakeConnection()
+    openmrs_connector._open_connection = lambda: stream_connection
+    assert list(openmrs_connector.stream_patient_encounters_by_location(268, fetch_size=2)) == [(1, [10, 11]), (2, [12])]
+    assert stream_connection.queries[0] == 'SET SESSION net_write_timeout = 3600'
+    stream_connection.connected = False
+    with pytest.raises(mysql.connector.OperationalError, match='cut off'):
+        list(openmrs_connector.stream_patient_encounters_by_location(268))
+
+def test_fetch_encounters_data_needs_a_single_connection():
+    pool = FakePool(1)
+    encounters = connector(pool).fetch_encounters_data([10, 11, 99])
+    assert pool.free == 1
+    assert sorted(encounters) == [10, 11]
+    assert encounters[10]['date_created'] == '2024-01-01T00:00:00'
+    assert [(observation.concept_uuid, observation.value) for observation in encounters[10]['observations']] == [('concept-1', 120), ('concept-2', 'note')]
+    assert [observation.value for observation in encounters[11]['observations']] == [7.5]
+
+def test_reserve_connections_grows_the_pool_before_it_is_created():
+    openmrs_connector = OpenMRSConnector('host', 'user', 'password', 'openmrs', pool_size=10)
+    openmrs_connector.reserve_connections(16)
+    assert openmrs_connector.pool_size == 16
+    openmrs_connector.reserve_connections(64)
+    assert openmrs_connector.pool_size == 32
+
+def test_close_disconnects_idle_connections_and_those_released_later():
+    pool = FakePool(2)
+    openmrs_connector = connector(pool)
+    openmrs_connector.owns_pool = True
+    idle = openmrs_connector._checkout()
+    busy = openmrs_connector._checkout()
+    openmrs_connector._checkin(idle)
+    openmrs_connector.close()
+    assert not idle.connected and busy.connected
+    openmrs_connector._checkin(busy)
+    assert not busy.connected
+    assert openmrs_connector.checked_out == set() and openmrs_connector.orphaned == set()
+
+def test_broken_connection_returned_to_a_full_pool_is_not_replaced():
+    class BrokenConnection(FakeConnection):
+        def close(self):
+            super().close()
+            raise mysql.connector.OperationalError("Lost connection")
+    pool = FakePool(1)
+    openmrs_connector = connector(pool)
+    pool.get_connection = lambda: BrokenConnection(pool)
+    # The broken connection went back to the pool; the pool refuses a replacement and no error escapes
+    openmrs_connector._checkin(openmrs_connector._checkout())
+    assert openmrs_connector.checked_out == set()
+
+def test_observations_are_decoded_with_the_concept_map_of_their_query():
+    openmrs_connector = connector(FakePool(1))
+    query, concept_ids, concepts = openmrs_connector._observations_query("obs.encounter_id = %s")
+    assert concept_ids == [1, 2]
+    # A metadata reload between the query and the reading of its rows does not affect them
+    openmrs_connector.metadata.concepts = {}
+    observations = list(openmrs_connector._read_observations(OBS[:2], concepts))
+    assert [(encounter_id, observation.concept_uuid) for encounter_id, observation in observations] == [(10, 'concept-1'), (10, 'concept-2')]
+
+def test_metadata_is_reloaded_whenever_the_mappings_are():
+    openmrs_metadata = metadata()
+    openmrs_metadata.use_concepts(openmrs_metadata.concept_uuids)
+    assert openmrs_metadata.loaded
+    # Reloaded mappings hand over a new set, even with the same concepts
+    openmrs_metadata.use_concepts(frozenset({'concept-1', 'concept-2'}))
+    assert not openmrs_metadata.loaded
@@ -0,0 +1,34 @@
+import pytest
+import services.pipeline
+from services.pipeline import SyncPipeline
+from synthetic_openmrs import SyntheticOpenMRSConnector
+from utils.progress_tracker import TRANSFORMED, UPLOADED
+
+@pytest.fixture(autouse=True)
+def synthetic_extraction(monkeypatch, dataset):
+    # The extraction workers build their own connectors, on the synthetic dataset here
+    monkeypatch.setattr(services.pipeline, 'OpenMRSConnector', lambda metadata=None, **config: SyntheticOpenMRSConnector(dataset, metadata=metadata))
+
+def test_pipeline_uploads_every_patient(sync_service, dataset, dhis2_stub):
+    stats = SyncPipeline(sync_service, {}, batch_size=7).run(dataset.location_id, dataset.patient_encounters())
+    assert (stats['patients'], stats['transformed'], stats['uploaded'], stats['failed']) == (30, 30, 30, 0)
+    assert dhis2_stub.counts['trackedEntityInstances received'] == 30
+    assert len(sync_service.progress_tracker.get_patients(dataset.location_id, [UPLOADED])) == 30
+    assert sync_service.staging_store.count() == 0
+
+def test_pipeline_without_upload_stages_the_payloads_for_a_resume(sync_service, dataset, dhis2_stub):
+    stats = SyncPipeline(sync_service, {}, batch_size=7, upload=False).run(dataset.location_id, dataset.patient_encounters())
+    assert (stats['transformed'], stats['uploaded']) == (30, 0)
+    assert 'POST /trackedEntityInstances' not in dhis2_stub.counts
+    assert sync_service.staging_store.count() == 30
+    assert len(sync_service.progress_tracker.get_progress(dataset.location_id, sync_service.staging_store.staged)) == 30
+
+def test_patients_checkpointed_transformed_are_staged_when_the_load_stage_fails(sync_service, dataset, monkeypatch):
+    def fail(staging_store, patients):
+        raise RuntimeError("load stage stopped")
+    monkeypatch.setattr(sync_service.dhis2_connector, 'upload_staged', fail)
+    with pytest.raises(RuntimeError):
+        SyncPipeline(sync_service, {}, batch_size=7).run(dataset.location_id, dataset.patient_encounters())
+    transformed = sync_service.progress_tracker.get_patients(dataset.location_id, [TRANSFORMED])
+    assert len(transformed) == 30
+    assert sync_service.staging_store.staged(transformed) == transformed
@@ -0,0 +1,28 @@
+import os
+import tracemalloc
+from utils.profiling import PATIENT_TIMINGS, PatientTimings, RunProfiler
+
+def test_run_profiler_traces_memory_only_when_asked(tmp_path):
+    profiler = RunProfiler(str(tmp_path / 'profile'))
+    profiler.start()
+    try:
+        assert not tracemalloc.is_tracing()
+        assert PATIENT_TIMINGS.enabled
+    finally:
+        paths = profiler.stop()
+    assert sorted(os.path.basename(path) for path in paths) == ['patients.txt', 'profile.folded']
+    profiler = RunProfiler(str(tmp_path / 'profile'), trace_memory=True)
+    profiler.start()
+    paths = profiler.stop()
+    assert not tracemalloc.is_tracing()
+    assert 'memory.txt' in [os.path.basename(path) for path in paths]
+
+def test_merge_adds_the_drained_timings_and_keeps_the_slowest_encounters():
+    worker, parent = PatientTimings(top=2), PatientTimings(top=2)
+    worker.record_encounter(1, 10, 5, 0.3)
+    worker.record_encounter(1, 11, 5, 0.1)
+    parent.record_encounter(1, 12, 2, 0.2)
+    parent.merge(worker.drain())
+    assert worker.patients == {}
+    assert parent.patients['1'] == {'encounters': 3, 'observations': 12}
+    assert sorted(encounter_id for _, _, encounter_id, _ in parent.slowest_encounters) == ['10', '12']
@@ -0,0 +1,58 @@
+import json
+import sqlite3
+from utils.progress_tracker import ProgressTracker, EXTRACTED, TRANSFORMED, UPLOADED, FAILED
+from utils.staging_store import StagingStore, REJECTED
+
+def test_a_patient_is_checkpointed_per_location(tmp_path):
+    progress_tracker = ProgressTracker(str(tmp_path / 'progress.db'))
+    progress_tracker.mark_patients(268, [1], UPLOADED)
+    progress_tracker.mark_patients(300, [1], FAILED, error='boom')
+    assert progress_tracker.get_patients(268, [UPLOADED]) == {'1'}
+    assert progress_tracker.get_patients(300, [FAILED]) == {'1'}
+    assert progress_tracker.get_patient_state(1, 268) == (UPLOADED, None)
+
+def test_resume_skips_uploaded_patients_and_transformed_ones_still_staged(tmp_path):
+    progress_tracker = ProgressTracker(str(tmp_path / 'progress.db'))
+    assert progress_tracker.get_progress(268) is None
+    progress_tracker.mark_patients(268, [1], UPLOADED)
+    progress_tracker.mark_patients(268, [2, 3], TRANSFORMED)
+    progress_tracker.mark_patients(268, [4], EXTRACTED)
+    progress_tracker.mark_patients(268, [5], FAILED)
+    assert progress_tracker.get_progress(268) == ['1']
+    staging_store = StagingStore(str(tmp_path / 'staging.db'))
+    staging_store.stage_many([(3, {}), (4, {})])
+    assert sorted(progress_tracker.get_progress(268, staging_store.staged)) == ['1', '3']
+    staging_store.mark(3, REJECTED)
+    assert progress_tracker.get_progress(268, staging_store.staged) == ['1']
+
+def test_upload_results_update_the_patient_and_its_encounters(tmp_path):
+    progress_tracker = ProgressTracker(str(tmp_path / 'progress.db'))
+    progress_tracker.mark_patients(268, [1, 2], TRANSFORMED)
+    progress_tracker.mark_encounters(268, 1, [10, 11], TRANSFORMED)
+    progress_tracker.mark_patient_states([1], UPLOADED, dhis2_reference='tei')
+    assert progress_tracker.get_patient_state(1) == (UPLOADED, 'tei')
+    assert progress_tracker.get_patient_state(2) == (TRANSFORMED, None)
+    states = progress_tracker.connection.execute("SELECT state, dhis2_reference FROM encounters").fetchall()
+    assert states == [(UPLOADED, 'tei'), (UPLOADED, 'tei')]
+
+def test_a_legacy_progress_file_is_imported_as_transformed(tmp_path):
+    with open(tmp_path / 'progress.json', 'w') as file:
+        json.dump({'268': [1, 2], '300': 3, '400': None}, file)
+    progress_tracker = ProgressTracker(str(tmp_path / 'progress.db'))
+    assert progress_tracker.get_patients(268, [TRANSFORMED]) == {'1', '2'}
+    assert progress_tracker.get_patients(300, [TRANSFORMED]) == {'3'}
+    assert progress_tracker.get_progress(400) == []
+
+def test_a_store_keyed_by_patient_only_is_migrated(tmp_path):
+    file_path = str(tmp_path / 'progress.db')
+    connection = sqlite3.connect(file_path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE patients (patient_id TEXT PRIMARY KEY, location_id TEXT, state TEXT, dhis2_reference TEXT, error TEXT, updated_at TEXT)"
+        )
+        connection.execute("INSERT INTO patients VALUES ('1', '268', 'uploaded', 'tei', NULL, '2024-01-01T00:00:00')")
+    connection.close()
+    progress_tracker = ProgressTracker(file_path)
+    assert progress_tracker.get_patient_state(1, 268) == (UPLOADED, 'tei')
+    progress_tracker.mark_patients(300, [1], TRANSFORMED)
+    assert progress_tracker.get_patients(268, [UPLOADED]) == {'1'}
@@ -0,0 +1,42 @@
+import string
+from utils.reference_index import ReferenceIndex, dhis2_uid, payload_hash
+
+def test_dhis2_uid_is_stable_and_valid():
+    uid = dhis2_uid('trackedEntityInstance', 'patient-uuid')
+    assert uid == dhis2_uid('trackedEntityInstance', 'patient-uuid')
+    assert len(uid) == 11
+    assert uid[0] in string.ascii_letters
+    assert all(char in string.ascii_letters + string.digits for char in uid)
+
+def test_dhis2_uid_depends_on_every_part():
+    assert dhis2_uid('event', 'patient-uuid', 1) != dhis2_uid('event', 'patient-uuid', 2)
+    assert dhis2_uid('event', 'patient-uuid', 1) != dhis2_uid('enrollment', 'patient-uuid', 1)
+
+def test_payload_hash_ignores_key_order():
+    assert payload_hash({'a': 1, 'b': [1, 2]}) == payload_hash({'b': [1, 2], 'a': 1})
+    assert payload_hash({'a': 1}) != payload_hash({'a': 2})
+
+def test_reference_index_persists_tracked_entity_instances(tmp_path):
+    index = ReferenceIndex(str(tmp_path / 'references.db'))
+    index.set_tracked_entity_instances({'patient-uuid': 'Tei00000001'})
+    index.close()
+    assert ReferenceIndex(str(tmp_path / 'references.db')).get_tracked_entity_instances(['patient-uuid', 'other']) == {'patient-uuid': 'Tei00000001'}
+
+def test_reference_index_indexes_enrollments_and_events_once_synced(tmp_path):
+    index = ReferenceIndex(str(tmp_path / 'references.db'))
+    index.set_tracked_entity_instances({'patient-uuid': 'Tei00000001'})
+    index.mark_synced('Tei00000001', {'Event000001': 'event-hash'}, 'tei-hash',
+                      enrollments={'program': 'Enrollment01'}, event_enrollments={'Event000001': 'Enrollment01'})
+    assert index.get_enrollments('Tei00000001') == {'program': 'Enrollment01'}
+    assert index.get_event_enrollments(['Event000001', 'Event000002']) == {'Event000001': 'Enrollment01'}
+    # Events uploaded on their own keep the enrollment they were indexed with
+    index.mark_synced('Tei00000001', {'Event000001': 'new-hash'})
+    assert index.get_event_enrollments(['Event000001']) == {'Event000001': 'Enrollment01'}
+
+def test_reference_index_remembers_synced_hashes(tmp_path):
+    index = ReferenceIndex(str(tmp_path / 'references.db'))
+    index.set_tracked_entity_instances({'patient-uuid': 'Tei00000001'})
+    assert index.get_synced_tracked_entity_hash('Tei00000001') is None
+    index.mark_synced('Tei00000001', {'Event000001': 'event-hash'}, 'tei-hash')
+    assert index.get_synced_tracked_entity_hash('Tei00000001') == 'tei-hash'
+    assert index.get_synced_event_hashes(['Event000001', 'Event000002']) == {'Event000001': 'event-hash'}
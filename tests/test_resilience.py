@@ -0,0 +1,104 @@
+import time
+import pytest
+import requests
+from connectors.dhis2_connector import DHIS2Connector
+from utils.resilience import AdaptiveRateLimiter, CircuitBreaker, CircuitOpenError, backoff_delay, retry_after_seconds
+
+def test_rate_limiter_grows_on_fast_responses_and_backs_off():
+    limiter = AdaptiveRateLimiter(rate=10, min_rate=1, max_rate=11, target_latency=1.0)
+    limiter.record(0.1)
+    assert limiter.rate == 10.1
+    limiter.record(5.0)
+    assert abs(limiter.rate - 9.09) < 1e-9
+    limiter.record(0.1, throttled=True)
+    assert abs(limiter.rate - 4.545) < 1e-9
+    for _ in range(200):
+        limiter.record(0.1)
+    assert limiter.rate == 11
+
+def test_rate_limiter_never_goes_below_the_minimum():
+    limiter = AdaptiveRateLimiter(rate=2, min_rate=1)
+    for _ in range(5):
+        limiter.record(0.1, throttled=True)
+    assert limiter.rate == 1
+
+def test_rate_limiter_paces_requests_beyond_the_burst():
+    limiter = AdaptiveRateLimiter(rate=50, max_rate=50)
+    started_at = time.monotonic()
+    for _ in range(10):
+        limiter.acquire()
+    # The first token is available at once, the nine others come at 50 per second
+    assert time.monotonic() - started_at >= 9 / 50 * 0.9
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert 59 < breaker.retry_after() <= 60
+
+def test_circuit_breaker_probes_after_the_reset_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.retry_after() == 0.0
+
+def test_backoff_delay_is_capped():
+    assert all(0 <= backoff_delay(attempt, base=1, maximum=5) <= 5 for attempt in range(10))
+
+def test_retry_after_seconds():
+    assert retry_after_seconds('3') == 3.0
+    assert retry_after_seconds('-1') == 0.0
+    assert retry_after_seconds('Thu, 01 Jan 1970 00:00:00 GMT') == 0.0
+    assert retry_after_seconds('soon') is None
+    assert retry_after_seconds(None) is None
+
+PAYLOAD = {"trackedEntityType": "j9TllKXZ3jb", "orgUnit": "ou", "attributes": [{"attribute": "name", "value": "patient"}]}
+
+def connector(url, **options):
+    return DHIS2Connector(url, 'admin', 'district', rate_limit=1000, max_rate_limit=1000, backoff_base=0.01, **options)
+
+def failing_requests(stub, failures):
+    """Make `stub` answer its next `failures` requests with its error status."""
+    remaining = [failures]
+    def delay_and_fail():
+        remaining[0] -= 1
+        return remaining[0] >= 0
+    stub._delay_and_fail = delay_and_fail
+
+def test_upload_is_retried_on_503_until_it_succeeds(dhis2_stub):
+    failing_requests(dhis2_stub, 2)
+    assert connector(dhis2_stub.url).upload_patient(PAYLOAD) == 'stub0000000'
+    assert dhis2_stub.counts['POST /trackedEntityInstances'] == 3
+    assert dhis2_stub.counts['errors injected'] == 2
+
+def test_post_without_uids_is_not_retried_on_502(dhis2_stub):
+    # DHIS2 may have created the records before the gateway failed, so a retry could duplicate them
+    dhis2_stub.error_status = 502
+    failing_requests(dhis2_stub, 1)
+    with pytest.raises(requests.HTTPError):
+        connector(dhis2_stub.url).upload_patient(PAYLOAD)
+    assert dhis2_stub.counts['POST /trackedEntityInstances'] == 1
+
+def test_circuit_breaker_stops_calls_after_consecutive_failures(dhis2_stub):
+    failing_requests(dhis2_stub, 2)
+    dhis2_connector = connector(dhis2_stub.url, max_retries=1, circuit_failures=2, circuit_reset=60)
+    with pytest.raises(requests.HTTPError):
+        dhis2_connector.upload_patient(PAYLOAD)
+    assert dhis2_connector.circuit_breaker.state == CircuitBreaker.OPEN
+    dhis2_connector.max_retries = 0
+    with pytest.raises(CircuitOpenError):
+        dhis2_connector.upload_patient(PAYLOAD)
+    assert dhis2_stub.counts['POST /trackedEntityInstances'] == 2
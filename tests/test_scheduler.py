@@ -0,0 +1,59 @@
+import json
+import pytest
+import services.pipeline
+import services.scheduler
+from services.scheduler import LocationScheduler
+from synthetic_openmrs import SyntheticOpenMRSConnector
+from utils.progress_tracker import UPLOADED
+from utils.watermark_store import WatermarkStore
+
+@pytest.fixture(autouse=True)
+def synthetic_extraction(monkeypatch, dataset):
+    # Every location and extraction worker builds its own connector, on the synthetic dataset here
+    def connector(metadata=None, **config):
+        return SyntheticOpenMRSConnector(dataset, metadata=metadata)
+    monkeypatch.setattr(services.scheduler, 'OpenMRSConnector', connector)
+    monkeypatch.setattr(services.pipeline, 'OpenMRSConnector', connector)
+
+@pytest.fixture
+def watermark_store(tmp_path):
+    return WatermarkStore(str(tmp_path / 'watermarks.json'))
+
+def scheduler(sync_service, watermark_store):
+    return LocationScheduler(sync_service, {}, watermark_store, batch_size=7)
+
+def test_run_uploads_each_location_and_sets_its_watermark(sync_service, dataset, dhis2_stub, watermark_store, tmp_path):
+    location_id = str(dataset.location_id)
+    summary_file = str(tmp_path / 'summary.json')
+    summary = scheduler(sync_service, watermark_store).run([location_id], summary_file=summary_file)
+    assert (summary['patients'], summary['uploaded'], summary['failed']) == (30, 30, 0)
+    assert summary['locations'][0]['status'] == 'ok'
+    assert dhis2_stub.counts['trackedEntityInstances received'] == 30
+    assert watermark_store.get_watermark(location_id) is not None
+    with open(summary_file) as file:
+        assert json.load(file)['uploaded'] == 30
+
+def test_unmapped_location_fails_without_stopping_the_others(sync_service, dataset, watermark_store):
+    summary = scheduler(sync_service, watermark_store).run(['999999', str(dataset.location_id)])
+    by_location = {location['location_id']: location for location in summary['locations']}
+    assert by_location['999999']['status'] == 'failed'
+    assert by_location[str(dataset.location_id)]['uploaded'] == 30
+    assert watermark_store.get_watermark('999999') is None
+
+def test_resume_uploads_the_patients_staged_by_a_run_without_upload(sync_service, dataset, dhis2_stub, watermark_store):
+    location_id = str(dataset.location_id)
+    summary = scheduler(sync_service, watermark_store).run([location_id], upload=False)
+    assert (summary['patients'], summary['uploaded']) == (30, 0)
+    # Staged payloads may still be cleared, so the watermark is left
+    assert watermark_store.get_watermark(location_id) is None
+    summary = scheduler(sync_service, watermark_store).run([location_id])
+    # The staged patients are uploaded before the run and skipped by it
+    assert summary['patients'] == 0
+    assert dhis2_stub.counts['trackedEntityInstances received'] == 30
+    assert sync_service.staging_store.count() == 0
+    assert len(sync_service.progress_tracker.get_patients(location_id, [UPLOADED])) == 30
+
+def test_locations_never_synced_are_scheduled_first(sync_service, dataset, watermark_store):
+    location_id = str(dataset.location_id)
+    scheduler(sync_service, watermark_store).run([location_id])
+    assert scheduler(sync_service, watermark_store).order_locations([location_id, '999999']) == ['999999', location_id]
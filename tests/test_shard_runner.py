@@ -0,0 +1,53 @@
+import multiprocessing
+import pytest
+import services.shard_runner
+from services.shard_runner import ShardedRunner
+from services.sync_service import SyncService
+from synthetic_openmrs import SyntheticOpenMRSConnector
+from utils.metrics import METRICS
+from utils.profiling import PATIENT_TIMINGS
+from utils.progress_tracker import TRANSFORMED
+
+# The workers see the synthetic connector patched in below only when they are forked
+pytestmark = pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason="needs forked worker processes")
+
+@pytest.fixture(autouse=True)
+def synthetic_workers(monkeypatch, tmp_path, dataset):
+    def worker_service(openmrs_config, dhis2_config, progress_tracker_file, dead_letter_file):
+        worker = SyncService(openmrs_config, dhis2_config, progress_tracker_file, reference_index_file=str(tmp_path / 'references.db'),
+                             staging_file=str(tmp_path / 'worker_staging.db'), mappings_dir=str(tmp_path / 'mappings'), dead_letter_file=dead_letter_file)
+        worker.openmrs_connector = SyntheticOpenMRSConnector(dataset, metadata=worker.openmrs_connector.metadata)
+        return worker
+    monkeypatch.setattr(services.shard_runner, 'SyncService', worker_service)
+
+def runner(sync_service, tmp_path):
+    openmrs_config = {'host': 'synthetic', 'user': '', 'password': '', 'database': '', 'pool_size': 10}
+    dhis2_config = {'base_url': sync_service.dhis2_connector.base_url, 'username': 'admin', 'password': 'district'}
+    return ShardedRunner(sync_service, openmrs_config, dhis2_config, str(tmp_path / 'progress.db'), processes=2, shard_size=8, batch_size=4)
+
+def test_sharded_run_stages_and_checkpoints_every_patient(sync_service, dataset, tmp_path):
+    sharded_runner = runner(sync_service, tmp_path)
+    # Each worker runs one query at a time
+    assert sharded_runner.openmrs_config['pool_size'] == 1
+    stats = sharded_runner.run({dataset.location_id: dataset.patient_encounters()})
+    assert (stats['patients'], stats['transformed'], stats['failed']) == (30, 30, 0)
+    assert sync_service.staging_store.count() == 30
+    assert len(sync_service.progress_tracker.get_patients(dataset.location_id, [TRANSFORMED])) == 30
+
+def test_sharded_run_returns_the_patient_timings_of_the_workers(sync_service, dataset, tmp_path):
+    PATIENT_TIMINGS.reset()
+    PATIENT_TIMINGS.enabled = True
+    try:
+        runner(sync_service, tmp_path).run({dataset.location_id: dataset.patient_encounters()})
+        patients, _ = PATIENT_TIMINGS.drain()
+    finally:
+        PATIENT_TIMINGS.enabled = False
+    assert len(patients) == 30
+    assert all(patient['encounters'] == 2 and patient['transform'] > 0 for patient in patients.values())
+
+def test_sharded_run_does_not_merge_the_parent_metrics_back(sync_service, dataset, tmp_path):
+    METRICS.drain()
+    METRICS.increment('shard_test_total', 5)
+    runner(sync_service, tmp_path).run({dataset.location_id: dataset.patient_encounters()})
+    counters, _ = METRICS.drain()
+    assert counters[('shard_test_total', ())] == 5
@@ -0,0 +1,56 @@
+import json
+import os
+import pytest
+from utils.progress_tracker import UPLOADED, FAILED
+from utils.staging_store import StagingStore, PENDING, REJECTED
+
+@pytest.fixture(params=[True, False], ids=['compressed', 'plain'])
+def store(request, tmp_path):
+    store = StagingStore(str(tmp_path / 'staging.db'), compress=request.param)
+    yield store
+    store.close()
+
+def test_iter_batches_returns_payloads_in_staging_order(store):
+    store.stage_many((patient_id, {'patient': patient_id}) for patient_id in range(1, 6))
+    batches = list(store.iter_batches(2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [payload for batch in batches for _, payload in batch] == [{'patient': patient_id} for patient_id in range(1, 6)]
+
+def test_restaging_replaces_the_payload_and_requeues_it(store):
+    store.stage_many([(1, {'version': 1}), (2, {'version': 1})])
+    store.stage(1, {'version': 2})
+    assert [(patient_id, payload) for batch in store.iter_batches() for patient_id, payload in batch] == [('2', {'version': 1}), ('1', {'version': 2})]
+
+def test_marked_patients_leave_the_upload_queue(store):
+    store.stage_many((patient_id, {}) for patient_id in range(1, 5))
+    store.mark(1, UPLOADED, dhis2_reference='Tei00000001')
+    store.mark(2, REJECTED, error='invalid')
+    store.mark(3, FAILED, error='timeout')
+    assert store.count() == 2
+    assert store.count((PENDING,)) == 1
+    assert [patient_id for batch in store.iter_batches() for patient_id, _ in batch] == ['3', '4']
+
+def test_clear_returns_the_dropped_patients(store):
+    store.stage_many((patient_id, {}) for patient_id in range(1, 4))
+    store.mark(1, UPLOADED)
+    assert sorted(store.clear()) == ['2', '3']
+    assert store.count() == 0
+    assert store.count((UPLOADED,)) == 1
+
+def test_directory_round_trip(store, tmp_path):
+    legacy_dir = tmp_path / 'patients_to_sync'
+    os.makedirs(legacy_dir)
+    for patient_id in (7, 8):
+        with open(legacy_dir / f"{patient_id}.json", 'w') as file:
+            json.dump({'patient': patient_id}, file)
+    assert store.import_directory(str(legacy_dir)) == 2
+    assert os.listdir(legacy_dir) == []
+    store.mark(7, UPLOADED, dhis2_reference='Tei00000007')
+    assert store.export_directory(str(tmp_path / 'export'), statuses=(PENDING, UPLOADED)) == 2
+    assert sorted(os.listdir(tmp_path / 'export')) == ['8.json', 'Tei00000007_7.json']
+
+def test_staged_returns_the_patients_waiting_for_upload(store):
+    store.stage_many((patient_id, {}) for patient_id in range(1, 5))
+    store.mark(1, UPLOADED)
+    store.mark(2, FAILED, error='timeout')
+    assert store.staged([1, 2, 3, 99]) == {'2', '3'}
@@ -0,0 +1,112 @@
+import pytest
+import requests
+from utils.dead_letter_store import EXTRACT
+from utils.progress_tracker import FAILED
+
+def transform(sync_service, dataset, patient_encounters=None):
+    patient_encounters = patient_encounters or list(dataset.patient_encounters())
+    patients_data, encounters_data = sync_service.extract_patient_batch(patient_encounters)
+    return sync_service.transform_patient_batch(patient_encounters, dataset.location_id, patients_data, encounters_data)
+
+def test_patients_are_looked_up_in_dhis2_once_per_batch(sync_service, dataset, dhis2_stub):
+    results = transform(sync_service, dataset)
+    assert all(results.values())
+    assert dhis2_stub.counts['GET /trackedEntityInstances.json'] == 1
+    # Transforming the same patients again looks none of them up
+    transform(sync_service, dataset)
+    assert dhis2_stub.counts['GET /trackedEntityInstances.json'] == 1
+
+def test_transform_requires_the_batch_lookup(sync_service, dataset):
+    patient_encounters = list(dataset.patient_encounters())[:1]
+    patients_data, encounters_data = sync_service.extract_patient_batch(patient_encounters)
+    (patient_id, encounter_ids), = patient_encounters
+    with pytest.raises(ValueError, match='was not looked up'):
+        sync_service.transform_patient(patient_id, encounter_ids, dataset.location_id, patients_data[int(patient_id)], encounters_data)
+
+def test_enrollments_and_events_are_indexed_once_uploaded(sync_service, dataset, dhis2_stub):
+    payload = next(iter(transform(sync_service, dataset).values()))
+    tracked_entity_instance = payload['trackedEntityInstance']
+    enrollment = payload['enrollments'][0]
+    event_uids = [event['event'] for event in enrollment['events']]
+    # Nothing is indexed before DHIS2 accepted the records
+    assert sync_service.reference_index.get_enrollments(tracked_entity_instance) == {}
+    assert sync_service.reference_index.get_event_enrollments(event_uids) == {}
+    sync_service.dhis2_connector.upload_patient(payload)
+    assert sync_service.reference_index.get_enrollments(tracked_entity_instance) == {enrollment['program']: enrollment['enrollment']}
+    assert sync_service.reference_index.get_event_enrollments(event_uids) == dict.fromkeys(event_uids, enrollment['enrollment'])
+
+def test_failed_upload_indexes_no_enrollment(sync_service, dataset, dhis2_stub):
+    payload = next(iter(transform(sync_service, dataset).values()))
+    dhis2_stub.error_status = 400
+    dhis2_stub.error_rate = 1.0
+    with pytest.raises(requests.HTTPError):
+        sync_service.dhis2_connector.upload_patient(payload)
+    assert sync_service.reference_index.get_enrollments(payload['trackedEntityInstance']) == {}
+
+def test_patient_synced_unchanged_is_not_sent_again(sync_service, dataset, dhis2_stub):
+    patient_encounters = list(dataset.patient_encounters())[:1]
+    payload = next(iter(transform(sync_service, dataset, patient_encounters).values()))
+    entity_id = sync_service.dhis2_connector.upload_patient(payload)
+    payload = next(iter(transform(sync_service, dataset, patient_encounters).values()))
+    assert sync_service.dhis2_connector.upload_patient(payload) == entity_id
+    assert dhis2_stub.counts['POST /trackedEntityInstances'] == 1
+    assert 'POST /events' not in dhis2_stub.counts
+
+def test_only_the_changed_events_of_a_synced_patient_are_sent(sync_service, dataset, dhis2_stub):
+    patient_encounters = list(dataset.patient_encounters())[:1]
+    sync_service.dhis2_connector.upload_patient(next(iter(transform(sync_service, dataset, patient_encounters).values())))
+    payload = next(iter(transform(sync_service, dataset, patient_encounters).values()))
+    payload['enrollments'][0]['events'][0]['dataValues'].append({'dataElement': 'changed', 'value': '1'})
+    assert sync_service.dhis2_connector.upload_patient(payload)
+    assert dhis2_stub.counts['POST /trackedEntityInstances'] == 1
+    # The two events nested in the first upload, then the changed one alone
+    assert dhis2_stub.counts['POST /events'] == 1
+    assert dhis2_stub.counts['events received'] == 3
+
+def test_bulk_upload_skips_the_patients_synced_unchanged(sync_service, dataset, dhis2_stub):
+    sync_service.dhis2_connector.import_mode = 'bulk'
+    payloads = list(transform(sync_service, dataset).values())
+    assert all(sync_service.dhis2_connector.upload_patients_bulk(payloads))
+    payloads = list(transform(sync_service, dataset).values())
+    assert all(sync_service.dhis2_connector.upload_patients_bulk(payloads))
+    assert dhis2_stub.counts['POST /trackedEntityInstances'] == 1
+
+def test_encounters_of_a_program_share_one_enrollment(sync_service, dataset):
+    payload = next(iter(transform(sync_service, dataset).values()))
+    enrollment, = payload['enrollments']
+    assert len(enrollment['events']) == 2
+    assert enrollment['enrollment']
+
+def test_new_events_join_the_active_enrollment_found_in_dhis2(sync_service, dataset):
+    patient_encounters = list(dataset.patient_encounters())[:1]
+    payload = next(iter(transform(sync_service, dataset, patient_encounters).values()))
+    program = payload['enrollments'][0]['program']
+    sync_service.reference_index.set_enrollments([(payload['trackedEntityInstance'], program, 'Active00001')])
+    payload = next(iter(transform(sync_service, dataset, patient_encounters).values()))
+    enrollment, = payload['enrollments']
+    assert enrollment['enrollment'] == 'Active00001'
+    assert len(enrollment['events']) == 2
+
+def test_events_synced_in_their_own_enrollment_stay_in_it(sync_service, dataset):
+    patient_encounters = list(dataset.patient_encounters())[:1]
+    payload = next(iter(transform(sync_service, dataset, patient_encounters).values()))
+    first_event, second_event = payload['enrollments'][0]['events']
+    # As synced before events were grouped, with an enrollment per encounter
+    event_hashes = {first_event['event']: 'hash1', second_event['event']: 'hash2'}
+    sync_service.reference_index.mark_synced(payload['trackedEntityInstance'], event_hashes, event_enrollments={
+        first_event['event']: 'Legacy00001', second_event['event']: 'Legacy00002'
+    })
+    payload = next(iter(transform(sync_service, dataset, patient_encounters).values()))
+    assert [(enrollment['enrollment'], [event['event'] for event in enrollment['events']]) for enrollment in payload['enrollments']] == [
+        ('Legacy00001', [first_event['event']]), ('Legacy00002', [second_event['event']])
+    ]
+
+def test_failed_extraction_fails_the_batch_as_dead_letters(sync_service, dataset, monkeypatch):
+    def extract_patient_batch(patient_encounters, openmrs_connector=None):
+        raise ConnectionError('OpenMRS is down')
+    monkeypatch.setattr(sync_service, 'extract_patient_batch', extract_patient_batch)
+    patient_encounters = list(dataset.patient_encounters())[:3]
+    results = sync_service.process_patient_batch(patient_encounters, dataset.location_id)
+    assert results == {patient_id: {} for patient_id, _ in patient_encounters}
+    assert sync_service.dead_letters.summary() == [(EXTRACT, 'ConnectionError', 3, 1)]
+    assert sync_service.progress_tracker.get_patients(dataset.location_id, [FAILED]) == {str(patient_id) for patient_id, _ in patient_encounters}
@@ -0,0 +1,99 @@
+import json
+import pytest
+from services.validation_service import ValidationService
+
+SNAPSHOT = {
+    'trackedEntityType': {
+        'id': 'TeType00001',
+        'trackedEntityTypeAttributes': [{'mandatory': True, 'trackedEntityAttribute': {'id': 'Attribute01', 'valueType': 'INTEGER_POSITIVE'}}]
+    },
+    'programs': [{
+        'id': 'Program0001',
+        'organisationUnits': [{'id': 'OrgUnit0001'}],
+        'programTrackedEntityAttributes': [{'mandatory': True, 'trackedEntityAttribute': {'id': 'Attribute02', 'valueType': 'TEXT'}}],
+        'programStages': [{
+            'id': 'Stage000001',
+            'programStageDataElements': [
+                {'compulsory': True, 'dataElement': {'id': 'Element0001', 'valueType': 'NUMBER'}},
+                {'dataElement': {'id': 'Element0002', 'valueType': 'TEXT', 'optionSet': {'options': [{'code': 'random'}, {'code': 'fasting'}]}}}
+            ]
+        }]
+    }]
+}
+
+def event(event_date='2024-01-02T00:00:00', number=120, option='random'):
+    return {
+        'programStage': 'Stage000001', 'eventDate': event_date,
+        'dataValues': [{'dataElement': 'Element0001', 'value': number}, {'dataElement': 'Element0002', 'value': option}]
+    }
+
+def payload(attribute='5', org_unit='OrgUnit0001', events=None):
+    return {
+        'trackedEntityType': 'TeType00001', 'orgUnit': org_unit,
+        'attributes': [{'attribute': 'Attribute01', 'value': attribute}, {'attribute': 'Attribute02', 'value': 'text'}],
+        'enrollments': [{
+            'program': 'Program0001', 'orgUnit': org_unit, 'enrollmentDate': '2024-01-01T00:00:00', 'incidentDate': '2024-01-01T00:00:00',
+            'events': events if events is not None else [event()]
+        }]
+    }
+
+@pytest.fixture
+def validator():
+    return ValidationService(SNAPSHOT)
+
+def test_valid_payload_passes(validator):
+    assert validator.validate_dhis2_data(payload()) == ([], payload(), [])
+
+def test_invalid_attribute_value_rejects_the_payload(validator):
+    errors, _, _ = validator.validate_dhis2_data(payload(attribute='-3'))
+    assert errors == ["attribute Attribute01: value '-3' is not a valid INTEGER_POSITIVE"]
+
+def test_missing_mandatory_attribute_rejects_the_payload(validator):
+    data = payload()
+    data['attributes'] = data['attributes'][:1]
+    errors, _, _ = validator.validate_dhis2_data(data)
+    assert errors == ['missing mandatory attributes Attribute02']
+
+def test_unassigned_org_unit_rejects_the_payload(validator):
+    errors, _, _ = validator.validate_dhis2_data(payload(org_unit='OrgUnit0009'))
+    assert errors == ['program Program0001 is not assigned to org unit OrgUnit0009']
+
+def test_invalid_event_is_dropped_from_a_copy_of_the_payload(validator):
+    invalid = event(event_date=None, number='abc', option='other')
+    data = payload(events=[event(), invalid])
+    data['trackedEntityInstance'] = 'Instance001'
+    data['enrollments'][0]['enrollment'] = 'Enrollment1'
+    errors, valid_payload, rejected_events = validator.validate_dhis2_data(data)
+    assert errors == []
+    assert valid_payload['enrollments'][0]['events'] == [event()]
+    # The payload itself is left whole
+    assert data['enrollments'][0]['events'] == [event(), invalid]
+    # The dropped event carries its enrollment and patient, to be uploaded on its own
+    standalone = dict(
+        invalid, program='Program0001', orgUnit='OrgUnit0001', enrollment='Enrollment1', trackedEntityInstance='Instance001',
+        enrollmentDate='2024-01-01T00:00:00', incidentDate='2024-01-01T00:00:00'
+    )
+    assert rejected_events == [(standalone, [
+        'invalid eventDate None',
+        "data element Element0001: value 'abc' is not a valid NUMBER",
+        "data element Element0002: value 'other' is not an option of the option set"
+    ])]
+
+def test_missing_compulsory_data_element_drops_the_event(validator):
+    incomplete = {'programStage': 'Stage000001', 'eventDate': '2024-01-02T00:00:00', 'dataValues': [{'dataElement': 'Element0002', 'value': 'random'}]}
+    _, valid_payload, rejected_events = validator.validate_dhis2_data(payload(events=[incomplete]))
+    assert [errors for _, errors in rejected_events] == [['missing compulsory data elements Element0001']]
+    # The enrollment is still sent, without an empty events list
+    assert 'events' not in valid_payload['enrollments'][0]
+    assert validator.validate_event(rejected_events[0][0]) == ['missing compulsory data elements Element0001']
+
+def test_validate_batch_writes_the_reject_report(tmp_path):
+    report_file = str(tmp_path / 'rejected.jsonl')
+    validator = ValidationService(SNAPSHOT, report_file)
+    valid, rejected, dropped = validator.validate_batch([(1, payload()), (2, payload(attribute='-3')), (3, payload(events=[event(number='abc')]))])
+    assert [patient_id for patient_id, _ in valid] == [1, 3]
+    assert [patient_id for patient_id, _ in rejected] == [2]
+    assert [(patient_id, errors) for patient_id, _, errors in dropped] == [(3, ["data element Element0001: value 'abc' is not a valid NUMBER"])]
+    with open(report_file) as file:
+        report = [json.loads(line) for line in file]
+    assert [(entry['patient_id'], entry['record']) for entry in report] == [('2', 'trackedEntityInstance'), ('3', 'event')]